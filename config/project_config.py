@@ -15,7 +15,7 @@ hosp_files = ["patients", "admissions", "diagnoses_icd", "d_icd_diagnoses",
 icu_files = ["icustays", "chartevents", "d_items", "procedureevents", "inputevents"]
 
 mimic_iv_data_sources = [{"name": "transfers", "datatype": "categorical", "time_col": "intime",
-                          "value_col": None, "label_col": "careunit"},
+                          "end_col": "outtime", "value_col": None, "label_col": "careunit"},
 
                          {"name": "vitals", "datatype": "discrete", "time_col": "charttime", "value_col": "valuenum",
                           "label_col": "label"},
@@ -38,15 +38,67 @@ mimic_iv_data_sources = [{"name": "transfers", "datatype": "categorical", "time_
                          {"name": "icu_procedures", "datatype": "continuous", "start_col": "starttime",
                           "end_col": "endtime", "value_col": None,  "label_col": "label"}]
 
+# Time grid anchors: which episode a grid starts/ends at.
+# "source" is the admission dictionary entry (or a table of anchor_tables, e.g. icu_tables, filtered to the admission)
+# holding the anchor rows, "id_col" identifies one grid.
+grid_anchors = {"admission": {"source": "admission", "id_col": "hadm_id",
+                              "start_col": "admittime", "end_col": "dischtime"},
+
+                "icu_stay": {"source": "icustays", "id_col": "stay_id",
+                             "start_col": "intime", "end_col": "outtime"}}
+
+# BigQuery request limits per operation type: rate in calls per second, burst calls allowed back to back.
+# Rate limit errors slow a bucket down (see utils/rate_limiter.py).
+bigquery_rate_limits = {"query": {"rate": 2.0, "burst": 10},
+                        "metadata": {"rate": 10.0, "burst": 20}}
+# On-disk cache of BigQuery SELECT results (utils/query_cache.py), bump dataset_version after a new dataset release
+bigquery_query_cache = {"path": join(DATA_PATH, "bq_cache"),
+                        "ttl_seconds": 7 * 24 * 60 * 60,
+                        "max_bytes": 5 * 1024 ** 3,
+                        "dataset_version": "mimic-iv-2.2",
+                        "enabled": True}
+# Budget guard and statistics of BigQuery queries (utils/query_stats.py).
+# max_bytes_scanned: queries whose dry-run estimate is larger are refused, None disables the dry run.
+# stats_log_path: JSON lines file receiving one record per query, None keeps records in memory only.
+bigquery_query_budget = {"max_bytes_scanned": None,
+                         "stats_log_path": None}
+# Declarative cohort definitions compiled by src/cohort_definition.py, criteria left out are not applied.
+# Keys: icd_prefixes, icd_version, min_age, max_age, admission_types, require_icu_stay, min_los_days, max_los_days
+cohort_definitions = {"sepsis": {"icd_prefixes": ["A41"], "icd_version": 10},
+                      "adult_icu": {"min_age": 18, "require_icu_stay": True}}
+# Bulk export of extracted tables to Snowflake (utils/snowflake_utils.py): Parquet chunks of chunk_rows rows
+# are staged with max_parallel_puts concurrent PUTs and loaded with COPY INTO.
+snowflake_export = {"config_path": join(CONFIG_PATH, "snowflake_config.yaml"),
+                    "chunk_rows": 1_000_000,
+                    "max_parallel_puts": 4,
+                    "compression": "snappy"}
+# Offline BigQuery stand-in (utils/bq_emulator.py): simulated job latency and quota limits used by
+# eda_scripts/mimic_eda_bq/benchmark_bq_emulator.py, None disables a limit.
+bigquery_emulator = {"latency_seconds": 0.5,
+                     "seconds_per_gib": 2.0,
+                     "max_queries_per_second": 5.0,
+                     "max_concurrent_jobs": 8,
+                     "use_result_cache": True}
+
+# Compact pandas dtypes applied to BigQuery results: ids fit int32, measurements float32, unit-like strings
+# as category. Label columns stay object since the pipeline rewrites and groups by them.
+# Integer columns containing NULLs keep their default dtype.
+bigquery_compact_dtypes = {"subject_id": "int32", "hadm_id": "int32", "stay_id": "int32", "itemid": "int32",
+                           "seq_num": "int32", "icd_version": "int32", "pharmacy_id": "int32",
+                           "anchor_age": "int32", "hospital_expire_flag": "int32",
+                           "valuenum": "float32", "rate": "float32",
+                           "valueuom": "category", "rateuom": "category", "dose_unit_rx": "category",
+                           "route": "category", "fluid": "category"}
+
 
 patients_columns = ["hadm_id", "race", "insurance", "gender",
                         "anchor_age", "dod", "admission_type", "hospital_expire_flag"]
-transfers_columns = ['hadm_id', 'intime', 'outtime', 'icuunit']
+transfers_columns = ['hadm_id', 'intime', 'outtime', 'careunit']
 diagnoses_icd_columns = ["hadm_id", "seq_num", "icd_code", "icd_version"]
 d_icd_diagnoses_columns = ["icd_code", "icd_version", "long_title"]
 procedureevents_columns = ["hadm_id", "starttime", "endtime", "itemid", "value", "valueuom"]
 d_items_columns = ["hadm_id", "label", "category"]
-procedures_icd_columns = ["hadm_id", "seq_num", "icd_code", "icd_version"]
+procedures_icd_columns = ["hadm_id", "seq_num", "chartdate", "icd_code", "icd_version"]
 d_icd_procedures_columns = ["icd_code", "icd_version", "long_title"]
 prescriptions_columns = ["hadm_id", "starttime", "stoptime", "drug", "dose_val_rx", "dose_unit_rx", "route"]
 emar_columns = ["hadm_id", "charttime", "medication", "pharmacy_id"]
@@ -56,6 +108,10 @@ d_labitems_columns = [ "label", "fluid", "category "]
 icustays_columns = ["hadm_id", "stay_id", "intime", "outtime"]
 chartevents_columns = ["charttime", "itemid", "value", "valuenum", "valueuom"]
 
+# Age groups of the demographics analysis, right-inclusive bins as pd.cut (the SQL builders use the same edges)
+age_group_bins = [0, 18, 30, 50, 65, 80, 100]
+age_group_labels = ["<18", "18-29", "30-49", "50-64", "65-79", "80+"]
+
 
 service_codes_dict = {'CMED': 'Cardiac Medical',
                       'CSURG': 'Cardiac Surgery',
@@ -0,0 +1,63 @@
+import time
+from os.path import join
+from pathlib import Path
+from utils import bq_utils
+from utils.bq_emulator import EmulatedBigQueryClient
+from config.project_config import DATA_PATH, bigquery_emulator
+
+mimic4_path = join(Path(__file__).parent.parent.parent,
+                   DATA_PATH,
+                   "mimic-iv-clinical-database-demo-2.2")
+
+# Extraction modes of extract_admissions_data_bq compared by the benchmark
+extraction_modes = {"concurrent": {"materialize_cohort": False},
+                    "session cohort": {"materialize_cohort": True},
+                    "single job": {"single_job": True}}
+
+
+def benchmark_extraction_modes(hadm_ids: list | None,
+                               repeats: int = 2,
+                               use_local_cache: bool = False,
+                               **emulator_kwargs) -> list:
+    """
+    Run every extraction mode against the emulated BigQuery client and collect timings.
+    The first repeat of a mode runs cold, later repeats hit the emulated BigQuery result cache
+    (and the local result cache when use_local_cache is True). Rate limiter buckets are reset before every run.
+    :param hadm_ids: list of hospital admission IDs, None for all hospital admissions.
+    :param repeats: Runs per mode.
+    :param use_local_cache: Keep the local on-disk result cache enabled.
+    :param emulator_kwargs: EmulatedBigQueryClient arguments overriding config bigquery_emulator.
+    :return: List of dictionaries with mode, run, seconds, rows, jobs, BigQuery cache hits and quota errors.
+    """
+    bq_utils.bq_query_cache.enabled = use_local_cache
+    results = []
+    for mode, kwargs in extraction_modes.items():
+        client = EmulatedBigQueryClient(mimic4_path, **{**bigquery_emulator, **emulator_kwargs})
+        bq_utils.bq_query_cache.clear()
+        for run in range(repeats):
+            bq_utils.clear_schema_cache()
+            bq_utils.bq_query_stats.clear()
+            bq_utils.bq_rate_limiter.reset()
+            start = time.perf_counter()
+            data = bq_utils.extract_admissions_data_bq(client, client.project, "mimic_iv", hadm_ids,
+                                                       return_as_cohort=True, **kwargs)
+            summary = bq_utils.bq_query_stats.summary()
+            results.append({"mode": mode,
+                            "run": run,
+                            "seconds": round(time.perf_counter() - start, 3),
+                            "rows": sum(len(df) for df in data.values()),
+                            "jobs": summary["bigquery_jobs"],
+                            "bigquery_cache_hits": summary["bigquery_cache_hits"],
+                            "quota_errors": client.rate_limited})
+    return results
+
+
+def main():
+    results = benchmark_extraction_modes(hadm_ids=None)
+    for result in results:
+        print(result)
+    bq_utils.print_extraction_stats()
+
+
+if __name__ == '__main__':
+    main()
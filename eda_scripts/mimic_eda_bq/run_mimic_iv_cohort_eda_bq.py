@@ -56,6 +56,25 @@ def analyze_multiple_admissions_bq(project_id: str,
     return results_dict
 
 
+def analyze_cohort_aggregates_bq(project_id: str,
+                                 dataset_id: str,
+                                 hadm_ids: list | None,
+                                 results_path: str = results_path) -> dict:
+    """
+    Readmission, mortality, age and length of stay analyses computed in BigQuery,
+    without downloading the cohort events.
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param hadm_ids: list of hospital admission IDs, None for all hospital admissions.
+    :param results_path: str Folder to save results.
+    :returns: Dictionary with the aggregated tables.
+    """
+    client = get_bq_client(project_id)
+    analytics = bq_utils.get_cohort_analytics_bq(client, project_id, dataset_id, hadm_ids)
+    local_cohort_analysis_utils.run_cohort_analytics_plots(analytics, results_path)
+    return analytics
+
+
 def analyze_services(client,
                      project_id,
                      dataset_id, ):
@@ -1,16 +1,16 @@
 from os.path import join
 from pathlib import Path
-from utils.bq_utils import get_bq_client, extract_admissions_data_bq
+import pandas as pd
+from utils.bq_utils import (get_bq_client, extract_admissions_data_bq, get_binned_time_series_bq, get_valid_columns,
+                            get_admissions_bq, get_diagnoses_bq)
 from utils import data_utils, local_timeseries_utils
-from config.project_config import DATA_PATH
+from config.project_config import DATA_PATH, mimic_iv_data_sources
 
 mimic4_path = join(Path(__file__).parent.parent.parent,
                    DATA_PATH,
                    "mimic-iv-clinical-database-demo-2.2")
 results_path = join(Path(__file__).parent.parent.parent, "results")
 
-# TODO build timeseries utils in BigQuery, currently use local timeseries_utils
-
 
 def analyze_single_admission_bq(project_id: str,
                                 dataset_id: str,
@@ -18,7 +18,8 @@ def analyze_single_admission_bq(project_id: str,
                                 time_resolution_hours: int = 1,
                                 observation_window_hours: int | None = None,
                                 save_csv: bool = True,
-                                results_path: str = results_path) -> dict:
+                                results_path: str = results_path,
+                                bin_in_bigquery: bool = True) -> dict:
     """
     Analyze single patient admission with time-series binning and visualization.
     :param project_id: BigQuery project name
@@ -28,26 +29,50 @@ def analyze_single_admission_bq(project_id: str,
     :param observation_window_hours: Max hours to analyze (None for full stay).
     :param save_csv: Whether to save patients tables to csv files.
     :param results_path: Folder to save results.
+    :param bin_in_bigquery: Bin the sources in BigQuery and download only the admission row, its diagnoses
+        and the binned tables, otherwise extract the raw events and bin them with local_timeseries_utils.
     :returns: Dictionary containing patient admission analysis and time-series data.
     """
 
     # Initialize the client
     client = get_bq_client(project_id)
 
-    results_dict = extract_admissions_data_bq(client,
-                                              project_id,
-                                              dataset_id,
-                                              hadm_id,
-                                              return_as_cohort=False)
-    results = results_dict[hadm_id]
+    if bin_in_bigquery:
+        # Static data only, the events are binned server-side
+        available_demographics = get_valid_columns(client, project_id, dataset_id, "patients")
+        admissions, _ = get_admissions_bq(client, project_id, dataset_id, list(available_demographics), [hadm_id])
+        static_data = {"admission": admissions,
+                       "diagnoses": get_diagnoses_bq(client, project_id, dataset_id, [hadm_id])}
+        results = data_utils.split_admissions_by_id_list(static_data, admissions)[hadm_id]
 
-    ts_results, messages = local_timeseries_utils.generate_single_admission_time_series_data(
-        data_dict=results,
-        time_resolution_hours=time_resolution_hours,
-        observation_window_hours=observation_window_hours)
-    for m in messages:
-        if m is not None:
-            print(m)
+        binned = get_binned_time_series_bq(client,
+                                           project_id,
+                                           dataset_id,
+                                           [hadm_id],
+                                           time_resolution_hours=time_resolution_hours,
+                                           observation_window_hours=observation_window_hours)
+        time_grid = local_timeseries_utils.create_time_grid(results, time_resolution_hours, observation_window_hours)
+        # Same keys as generate_single_admission_time_series_data, the BigQuery grid starts at the recorded admittime
+        ts_results = {"admit_time": pd.to_datetime(results["admittime"]),
+                      "discharge_time": pd.to_datetime(results["dischtime"]),
+                      "time_grid": time_grid}
+        for src in mimic_iv_data_sources:
+            ts_results[src["name"]] = local_timeseries_utils.binned_to_ts(binned[src["name"]], time_grid,
+                                                                          src["datatype"])
+    else:
+        results_dict = extract_admissions_data_bq(client,
+                                                  project_id,
+                                                  dataset_id,
+                                                  hadm_id,
+                                                  return_as_cohort=False)
+        results = results_dict[hadm_id]
+        ts_results, messages = local_timeseries_utils.generate_single_admission_time_series_data(
+            data_dict=results,
+            time_resolution_hours=time_resolution_hours,
+            observation_window_hours=observation_window_hours)
+        for m in messages:
+            if m is not None:
+                print(m)
 
     for key in ts_results.keys():
         results[key] = ts_results[key]
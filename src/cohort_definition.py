@@ -1,18 +1,156 @@
-# Build parametrized cohort queries
-# example for sepsis_code = A41%
-from utils.bq_utils import execute_query
+# Declarative cohort definitions, compiled into parameterized BigQuery SQL (query_builder.build_cohort_definition_query)
+# and into vectorized pandas filters over the local MIMIC-IV tables.
+# example: define_cohort_bq(client, project_id, dataset_id, {"icd_prefixes": ["A41"], "min_age": 18})
+import pandas as pd
+from google.cloud import bigquery
+from utils import query_builder
+from utils.bq_utils import materialize_cohort_table
+from config.project_config import cohort_definitions
+
+# Criteria of a cohort definition and their defaults (None: criterion not applied)
+COHORT_DEFINITION_DEFAULTS = {"icd_prefixes": None,
+                              "icd_version": None,
+                              "min_age": None,
+                              "max_age": None,
+                              "admission_types": None,
+                              "require_icu_stay": False,
+                              "min_los_days": None,
+                              "max_los_days": None}
+
+# BigQuery parameter types of the criteria passed as query parameters
+COHORT_PARAMETER_TYPES = {"icd_prefixes": "STRING",
+                          "icd_version": "INT64",
+                          "min_age": "INT64",
+                          "max_age": "INT64",
+                          "admission_types": "STRING",
+                          "min_los_days": "FLOAT64",
+                          "max_los_days": "FLOAT64"}
+
+
+def validate_cohort_definition(definition: dict) -> dict:
+    """
+    Check a cohort definition and fill in the criteria it leaves out.
+    :param definition: Dictionary of criteria, see COHORT_DEFINITION_DEFAULTS.
+    :return: Complete cohort definition.
+    """
+    unknown = set(definition) - set(COHORT_DEFINITION_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown cohort criteria: {sorted(unknown)}")
+    definition = {**COHORT_DEFINITION_DEFAULTS, **definition}
+    for key in ["icd_prefixes", "admission_types"]:
+        if isinstance(definition[key], str):
+            definition[key] = [definition[key]]
+        if definition[key] is not None:
+            if not definition[key]:
+                raise ValueError(f"{key} is empty, use None to leave the criterion out")
+            definition[key] = sorted(map(str, definition[key]))
+    for lower, upper in [("min_age", "max_age"), ("min_los_days", "max_los_days")]:
+        if definition[lower] is not None and definition[upper] is not None and definition[lower] > definition[upper]:
+            raise ValueError(f"{lower} ({definition[lower]}) is larger than {upper} ({definition[upper]})")
+    if definition["icd_version"] is not None and definition["icd_prefixes"] is None:
+        raise ValueError("icd_version is only used together with icd_prefixes")
+    return definition
+
+
+def cohort_definition_parameters(definition: dict, prefix: str = "") -> list:
+    """
+    Query parameters of the criteria set in a validated cohort definition.
+    :param definition: Validated cohort definition.
+    :param prefix: Parameter name prefix (see build_cohort_definition_query parameter_prefix).
+    :return: list of BigQuery query parameters.
+    """
+    parameters = []
+    for key, parameter_type in COHORT_PARAMETER_TYPES.items():
+        value = definition[key]
+        if value is None:
+            continue
+        if isinstance(value, list):
+            parameters.append(bigquery.ArrayQueryParameter(prefix + key, parameter_type, value))
+        else:
+            parameters.append(bigquery.ScalarQueryParameter(prefix + key, parameter_type, value))
+    return parameters
+
+
+def define_cohort_bq(client: bigquery.Client,
+                     project_id: str,
+                     dataset_id: str,
+                     definition: dict,
+                     destination: str | None = None,
+                     expiration_hours: int | None = None) -> dict:
+    """
+    Select the admissions of a cohort definition in BigQuery and materialize them as a table
+    clustered by hadm_id, reused by downstream extractions (extract_admissions_data_bq(cohort=...)).
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param definition: Cohort definition, see COHORT_DEFINITION_DEFAULTS.
+    :param destination: project.dataset.table for a regular table, None for a session temp table.
+    :param expiration_hours: Expiration of a regular table, None keeps it.
+    :return: Cohort dictionary (see bq_utils.materialize_cohort_table).
+    """
+    definition = validate_cohort_definition(definition)
+    query = query_builder.build_cohort_definition_query(project_id, dataset_id, definition)
+    return materialize_cohort_table(client,
+                                    None,
+                                    destination=destination,
+                                    expiration_hours=expiration_hours,
+                                    hadm_ids_query=query,
+                                    query_parameters=cohort_definition_parameters(definition))
+
+
+def define_cohort_local(hosp_tables: dict, icu_tables: dict, definition: dict) -> list:
+    """
+    Select the admissions of a cohort definition from the local MIMIC-IV tables (see data_utils.load_mimic_data),
+    with the same criteria as build_cohort_definition_query.
+    :param hosp_tables: Dictionary of hospital data.
+    :param icu_tables: Dictionary of ICU data.
+    :param definition: Cohort definition, see COHORT_DEFINITION_DEFAULTS.
+    :return: Sorted list of hadm_ids.
+    """
+    definition = validate_cohort_definition(definition)
+    admissions = hosp_tables["admissions"]
+    keep = pd.Series(True, index=admissions.index)
+
+    if definition["icd_prefixes"] is not None:
+        diagnoses = hosp_tables["diagnoses_icd"]
+        if definition["icd_version"] is not None:
+            diagnoses = diagnoses[diagnoses["icd_version"] == definition["icd_version"]]
+        matches = diagnoses["icd_code"].astype(str).str.startswith(tuple(definition["icd_prefixes"]))
+        keep &= admissions["hadm_id"].isin(diagnoses.loc[matches, "hadm_id"])
+
+    ages = admissions["subject_id"].map(hosp_tables["patients"].set_index("subject_id")["anchor_age"])
+    if definition["min_age"] is not None:
+        keep &= ages >= definition["min_age"]
+    if definition["max_age"] is not None:
+        keep &= ages <= definition["max_age"]
+
+    if definition["admission_types"] is not None:
+        keep &= admissions["admission_type"].isin(definition["admission_types"])
+    if definition["require_icu_stay"]:
+        keep &= admissions["hadm_id"].isin(icu_tables["icustays"]["hadm_id"])
+
+    los_days = (pd.to_datetime(admissions["dischtime"]) -
+                pd.to_datetime(admissions["admittime"])).dt.total_seconds() / 86400
+    if definition["min_los_days"] is not None:
+        keep &= los_days >= definition["min_los_days"]
+    if definition["max_los_days"] is not None:
+        keep &= los_days <= definition["max_los_days"]
+
+    return sorted(admissions.loc[keep, "hadm_id"].unique().tolist())
 
 
 def define_sepsis_cohort(client,
                          project_id,
                          dataset_id,
-                         condition_code: int = 'A41%',
-                         output_table: str = 'sepsis_cohort'):
-    query = f"""
-    CREATE OR REPLACE TABLE `{output_table}` AS
-    SELECT ...
-    FROM `{project_id}.{dataset_id}.admissions` a
-    JOIN `{project_id}.{dataset_id}.diagnoses_icd` d ON a.hadm_id = d.hadm_id
-    WHERE d.icd_code LIKE {condition_code} 
-    """
-    execute_query(client, query)
\ No newline at end of file
+                         condition_code: str = 'A41%',
+                         output_table: str = 'sepsis_cohort') -> dict:
+    """
+    Materialize the sepsis cohort (config cohort_definitions["sepsis"]) with condition_code as ICD prefix.
+    :param condition_code: ICD code prefix, a trailing % (LIKE pattern) is accepted.
+    :param output_table: Output table, a plain name is created in project_id.dataset_id.
+    :return: Cohort dictionary (see bq_utils.materialize_cohort_table).
+    """
+    if "." not in output_table:
+        output_table = f"{project_id}.{dataset_id}.{output_table}"
+    definition = {**cohort_definitions["sepsis"], "icd_prefixes": [condition_code.rstrip("%")]}
+    return define_cohort_bq(client, project_id, dataset_id, definition, destination=output_table)
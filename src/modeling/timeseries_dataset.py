@@ -0,0 +1,54 @@
+# PyTorch dataset over cohort time series exported with utils.tensor_export_utils.export_cohort_tensors.
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from utils.tensor_export_utils import load_cohort_tensors
+
+
+class CohortTimeSeriesDataset(Dataset):
+    """
+    Streams fixed-shape (bin, feature) admissions from memory-mapped .npy files.
+    Arrays are opened copy-on-write, so tensors are created with torch.from_numpy without
+    copying the mapped pages: an int index or a slice is zero-copy, a list of indices
+    is one gathered read per array.
+
+    For batched reads, disable automatic batching and sample index lists, e.g.
+    DataLoader(dataset, batch_size=None, sampler=BatchSampler(SequentialSampler(dataset), 64, False)).
+    """
+
+    def __init__(self, export_dir: str, labels: dict | None = None):
+        """
+        :param export_dir: Folder written by export_cohort_tensors.
+        :param labels: Optional {hadm_id: label} returned as "label".
+        """
+        self.arrays, self.index = load_cohort_tensors(export_dir, mmap_mode="c")
+        self.hadm_ids = np.asarray(self.index["hadm_ids"])
+        self.lengths = np.asarray(self.index["lengths"])
+        self.labels = None
+        if labels is not None:
+            self.labels = np.asarray([labels[h] for h in self.hadm_ids])
+
+    def __len__(self):
+        return len(self.hadm_ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            idx = np.asarray(idx)
+            # Read the memmap with sorted indices (sequential), then restore the requested order
+            order = np.argsort(idx, kind="stable")
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            sample = {name: torch.from_numpy(np.asarray(array[idx[order]])[inverse])
+                      for name, array in self.arrays.items()}
+        else:
+            sample = {name: torch.from_numpy(np.asarray(array[idx])) for name, array in self.arrays.items()}
+        sample["hadm_id"] = torch.as_tensor(self.hadm_ids[idx])
+        sample["length"] = torch.as_tensor(self.lengths[idx])
+        if self.labels is not None:
+            sample["label"] = torch.as_tensor(self.labels[idx])
+        return sample
+
+    def offset(self, hadm_id: int) -> int:
+        """Row of an admission in the exported arrays."""
+        return self.index["offsets"][str(hadm_id)]
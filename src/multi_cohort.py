@@ -0,0 +1,113 @@
+# Shared-scan execution of several cohort definitions: every event table is read once for the union of
+# the cohorts, rows are tagged with a cohort membership bitset (bit i: cohort i) and split per cohort.
+# example: cohorts, membership = extract_cohorts_local(hosp, icu, {"sepsis": {...}, "aki": {...}})
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+from utils import query_builder
+from utils.bq_utils import execute_query, materialize_cohort_table, extract_admissions_data_bq
+from utils.data_utils import extract_admissions_data
+from src.cohort_definition import validate_cohort_definition, cohort_definition_parameters, define_cohort_local
+
+# cohort_mask is an int64 bitset
+MAX_COHORTS = 63
+
+
+def _validate_definitions(definitions: dict) -> dict:
+    if not definitions:
+        raise ValueError("No cohort definitions given")
+    if len(definitions) > MAX_COHORTS:
+        raise ValueError(f"At most {MAX_COHORTS} cohorts can be evaluated together, got {len(definitions)}")
+    return {name: validate_cohort_definition(definition) for name, definition in definitions.items()}
+
+
+def cohort_membership(cohort_hadm_ids: dict) -> pd.DataFrame:
+    """
+    Membership bitsets of admissions in several cohorts.
+    :param cohort_hadm_ids: Dictionary {cohort name: list of hadm_ids}, bit i is the i-th cohort.
+    :return: DataFrame with hadm_id and cohort_mask (int64), one row per admission in any cohort.
+    """
+    masks = {}
+    for bit, hadm_ids in enumerate(cohort_hadm_ids.values()):
+        for hadm_id in hadm_ids:
+            masks[hadm_id] = masks.get(hadm_id, 0) | (1 << bit)
+    membership = pd.DataFrame({"hadm_id": list(masks), "cohort_mask": np.fromiter(masks.values(), dtype=np.int64)})
+    return membership.sort_values("hadm_id", ignore_index=True)
+
+
+def tag_cohort_membership(admissions_data: dict, membership: pd.DataFrame) -> dict:
+    """
+    Add the cohort_mask column to every source of a cohort extraction.
+    :param admissions_data: Dictionary {source: DataFrame with hadm_id}, as returned with return_as_cohort=True.
+    :param membership: hadm_id, cohort_mask from cohort_membership or build_cohort_membership_query.
+    :return: Dictionary of tagged DataFrames.
+    """
+    masks = membership.set_index("hadm_id")["cohort_mask"].astype(np.int64)
+    # reindex keeps int64 for admissions in no cohort (map would go through float64 and lose the low bits)
+    return {name: df.assign(cohort_mask=masks.reindex(df["hadm_id"], fill_value=0).to_numpy())
+            for name, df in admissions_data.items()}
+
+
+def split_by_cohort(tagged_data: dict, cohort_names: list) -> dict:
+    """
+    Per-cohort outputs of a tagged extraction.
+    :param tagged_data: Dictionary {source: DataFrame with cohort_mask}.
+    :param cohort_names: Cohort names in bit order.
+    :return: Dictionary {cohort name: {source: DataFrame}}, as a separate extraction of each cohort would return.
+    """
+    cohorts = {}
+    for bit, name in enumerate(cohort_names):
+        cohorts[name] = {}
+        for source, df in tagged_data.items():
+            rows = (df["cohort_mask"].to_numpy() >> bit) & 1 == 1
+            cohorts[name][source] = df.loc[rows].drop(columns="cohort_mask").reset_index(drop=True)
+    return cohorts
+
+
+def extract_cohorts_local(hosp_tables: dict, icu_tables: dict, definitions: dict) -> tuple[dict, pd.DataFrame]:
+    """
+    Extract several cohorts from the local tables with one extract_admissions_data pass over their union.
+    :param hosp_tables: Dictionary of hospital data.
+    :param icu_tables: Dictionary of ICU data.
+    :param definitions: Dictionary {cohort name: cohort definition}, see cohort_definition.COHORT_DEFINITION_DEFAULTS.
+    :return: Dictionary {cohort name: {source: DataFrame}}, membership DataFrame (hadm_id, cohort_mask).
+    """
+    definitions = _validate_definitions(definitions)
+    membership = cohort_membership({name: define_cohort_local(hosp_tables, icu_tables, definition)
+                                    for name, definition in definitions.items()})
+    admissions_data = extract_admissions_data(hosp_tables, icu_tables, membership["hadm_id"].tolist(),
+                                              return_as_cohort=True)
+    tagged = tag_cohort_membership(admissions_data, membership)
+    return split_by_cohort(tagged, list(definitions)), membership
+
+
+def extract_cohorts_bq(client: bigquery.Client,
+                       project_id: str,
+                       dataset_id: str,
+                       definitions: dict,
+                       cohort_destination: str | None = None,
+                       **extract_kwargs) -> tuple[dict, pd.DataFrame]:
+    """
+    Extract several cohorts from BigQuery: the definitions are evaluated in one membership query,
+    the union is materialized once as the cohort table and every source query scans its table once for it.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param definitions: Dictionary {cohort name: cohort definition}, see cohort_definition.COHORT_DEFINITION_DEFAULTS.
+    :param cohort_destination: project.dataset.table for the union cohort table, None for a session temp table
+    (the source queries then run one at a time, as a session runs one query at a time).
+    :param extract_kwargs: Further extract_admissions_data_bq arguments (max_workers, schema_cache_path, ...).
+    :return: Dictionary {cohort name: {source: DataFrame}}, membership DataFrame (hadm_id, cohort_mask).
+    """
+    definitions = _validate_definitions(definitions)
+    query = query_builder.build_cohort_membership_query(project_id, dataset_id, list(definitions.values()))
+    parameters = [parameter for i, definition in enumerate(definitions.values())
+                  for parameter in cohort_definition_parameters(definition, prefix=f"c{i}_")]
+    membership = execute_query(client, query, bigquery.QueryJobConfig(query_parameters=parameters)).to_dataframe()
+    membership["cohort_mask"] = membership["cohort_mask"].astype(np.int64)
+
+    cohort = materialize_cohort_table(client, membership["hadm_id"].tolist(), destination=cohort_destination)
+    admissions_data = extract_admissions_data_bq(client, project_id, dataset_id, None, return_as_cohort=True,
+                                                 cohort=cohort, **extract_kwargs)
+    tagged = tag_cohort_membership(admissions_data, membership)
+    return split_by_cohort(tagged, list(definitions)), membership
@@ -0,0 +1,122 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+# bq_utils imports its sibling modules without the utils package prefix
+ROOT = Path(__file__).parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "utils")]
+
+
+def _timestamps(values) -> pd.Series:
+    return pd.Series(values).dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _events(rng, admissions: pd.DataFrame, max_per_admission: int, make_row) -> pd.DataFrame:
+    """Random events per admission, event times spread over the stay (a few before admittime)."""
+    rows = []
+    for adm in admissions.itertuples():
+        for _ in range(rng.integers(1, max_per_admission)):
+            t = adm.admittime + (adm.dischtime - adm.admittime) * rng.uniform(-0.05, 1.0)
+            rows.append(make_row(adm, t))
+    return pd.DataFrame(rows)
+
+
+def write_demo_tables(path: Path, n_subjects: int = 6, n_admissions: int = 8, seed: int = 0):
+    """
+    Write a tiny MIMIC-IV-shaped dataset to <path>/{hosp,icu}/<table>.csv.gz, with the columns read by
+    query_builder and data_utils. Some prescriptions have no stoptime, the last admission has no ICU stay.
+    """
+    rng = np.random.default_rng(seed)
+    subjects = np.arange(10000, 10000 + n_subjects)
+    hadm_ids = np.arange(20000000, 20000000 + n_admissions)
+    admittime = (pd.Timestamp("2150-01-01") + pd.to_timedelta(rng.integers(0, 3650, n_admissions), "D")
+                 + pd.to_timedelta(rng.integers(0, 1440, n_admissions), "min"))
+    dischtime = admittime + pd.to_timedelta(rng.integers(12 * 60, 5 * 24 * 60, n_admissions), "min")
+    admissions = pd.DataFrame({"subject_id": np.resize(subjects, n_admissions), "hadm_id": hadm_ids,
+                               "admittime": admittime, "dischtime": dischtime})
+
+    hosp = {"patients": pd.DataFrame({"subject_id": subjects,
+                                      "gender": rng.choice(["F", "M"], n_subjects),
+                                      "anchor_age": rng.integers(18, 91, n_subjects),
+                                      "anchor_year": 2150,
+                                      "anchor_year_group": "2008 - 2010",
+                                      "dod": None}),
+            "admissions": admissions.assign(admittime=_timestamps(admittime),
+                                            dischtime=_timestamps(dischtime),
+                                            deathtime=None,
+                                            admission_type=np.resize(["EW EMER.", "ELECTIVE", "URGENT"], n_admissions),
+                                            insurance="Medicare",
+                                            race="WHITE",
+                                            hospital_expire_flag=0),
+            "d_icd_diagnoses": pd.DataFrame({"icd_code": ["A419", "N179", "I10"],
+                                             "icd_version": 10,
+                                             "long_title": ["Sepsis, unspecified organism", "Acute kidney failure",
+                                                            "Essential hypertension"]}),
+            "diagnoses_icd": pd.DataFrame({"subject_id": admissions["subject_id"], "hadm_id": hadm_ids,
+                                           "seq_num": 1, "icd_code": rng.choice(["A419", "N179", "I10"], n_admissions),
+                                           "icd_version": 10}),
+            "d_labitems": pd.DataFrame({"itemid": [50912, 50983], "label": ["Creatinine", "Sodium"],
+                                        "fluid": "Blood", "category": "Chemistry"}),
+            "labevents": _events(rng, admissions, 8, lambda adm, t: {
+                "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "itemid": rng.choice([50912, 50983]),
+                "charttime": t, "value": "100", "valuenum": round(rng.normal(100, 20), 1), "valueuom": "mg/dL",
+                "ref_range_lower": 80.0, "ref_range_upper": 120.0, "flag": rng.choice(["abnormal", None])}),
+            "services": pd.DataFrame({"subject_id": admissions["subject_id"], "hadm_id": hadm_ids,
+                                      "transfertime": _timestamps(admittime), "prev_service": None,
+                                      "curr_service": "MED"}),
+            "transfers": pd.DataFrame({"subject_id": admissions["subject_id"], "hadm_id": hadm_ids,
+                                       "transfer_id": np.arange(n_admissions), "eventtype": "admit",
+                                       "careunit": "Medicine", "intime": _timestamps(admittime),
+                                       "outtime": _timestamps(dischtime)}),
+            "prescriptions": _events(rng, admissions, 5, lambda adm, t: {
+                "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "starttime": t,
+                "stoptime": t + pd.Timedelta(hours=float(rng.uniform(1, 30))) if rng.random() > 0.3 else pd.NaT,
+                "drug": rng.choice(["Heparin", "Insulin"]), "dose_val_rx": rng.choice(["5000", "25"]),
+                "dose_unit_rx": "UNIT", "route": "IV"}),
+            "d_icd_procedures": pd.DataFrame({"icd_code": ["3893"], "icd_version": 9,
+                                              "long_title": ["Venous catheterization"]}),
+            "procedures_icd": pd.DataFrame({"subject_id": admissions["subject_id"], "hadm_id": hadm_ids,
+                                            "seq_num": 1, "chartdate": admittime.strftime("%Y-%m-%d"),
+                                            "icd_code": "3893", "icd_version": 9}),
+            "emar": _events(rng, admissions, 4, lambda adm, t: {
+                "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "charttime": t,
+                "medication": rng.choice(["Heparin", "Insulin"]), "pharmacy_id": int(rng.integers(1, 100))})}
+
+    hosp["labevents"].insert(0, "labevent_id", np.arange(len(hosp["labevents"])))
+
+    stays = admissions.assign(stay_id=30000000 + np.arange(n_admissions), first_careunit="MICU",
+                              intime=admittime, outtime=dischtime, los=(dischtime - admittime) / pd.Timedelta(days=1))
+    icu = {"icustays": stays.iloc[:-1][["subject_id", "hadm_id", "stay_id", "first_careunit", "intime", "outtime", "los"]],
+           "d_items": pd.DataFrame({"itemid": [220045, 225158, 225792],
+                                    "label": ["Heart Rate", "NaCl 0.9%", "Invasive Ventilation"],
+                                    "abbreviation": ["HR", "NaCl", "Vent"],
+                                    "category": ["Routine Vital Signs", "Fluids", "Ventilation"]}),
+           "chartevents": _events(rng, admissions, 12, lambda adm, t: {
+               "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "stay_id": 30000000, "charttime": t,
+               "itemid": 220045, "value": "90", "valuenum": round(rng.normal(90, 10), 1), "valueuom": "bpm"}),
+           "inputevents": _events(rng, admissions, 4, lambda adm, t: {
+               "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "stay_id": 30000000, "starttime": t,
+               "endtime": t + pd.Timedelta(hours=float(rng.uniform(0.5, 20))), "itemid": 225158,
+               "rate": round(rng.uniform(1, 100), 1), "rateuom": "mL/hour"}),
+           "procedureevents": _events(rng, admissions, 3, lambda adm, t: {
+               "subject_id": adm.subject_id, "hadm_id": adm.hadm_id, "stay_id": 30000000, "starttime": t,
+               "endtime": t + pd.Timedelta(hours=float(rng.uniform(0.5, 20))), "itemid": 225792,
+               "value": float(rng.integers(1, 100)), "valueuom": "min"})}
+
+    for module, tables in (("hosp", hosp), ("icu", icu)):
+        Path(path, module).mkdir(parents=True, exist_ok=True)
+        for name, df in tables.items():
+            df = df.copy()
+            for col in df.columns:
+                if pd.api.types.is_datetime64_any_dtype(df[col]):
+                    df[col] = _timestamps(df[col])
+            df.to_csv(Path(path, module, f"{name}.csv.gz"), index=False, compression="gzip")
+
+
+@pytest.fixture(scope="session")
+def mimic_demo_path(tmp_path_factory) -> Path:
+    path = tmp_path_factory.mktemp("mimic_demo")
+    write_demo_tables(path)
+    return path
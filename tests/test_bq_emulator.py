@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("duckdb")
+
+from utils import bq_utils, data_utils
+from utils.bq_emulator import EmulatedBigQueryClient
+from utils.long_format_utils import cohort_events_to_long
+from config.project_config import mimic_iv_data_sources
+
+PROJECT_ID, DATASET_ID = "emulated", "mimic_iv"
+HADM_IDS = [20000000 + i for i in range(8)]
+CONTINUOUS_SOURCES = [src["name"] for src in mimic_iv_data_sources if src["datatype"] == "continuous"]
+
+
+@pytest.fixture
+def client(mimic_demo_path, monkeypatch):
+    monkeypatch.setattr(bq_utils.bq_query_cache, "enabled", False)
+    return EmulatedBigQueryClient(str(mimic_demo_path))
+
+
+def row_counts(data: dict) -> dict:
+    return {name: len(df) for name, df in data.items()}
+
+
+@pytest.mark.parametrize("mode", [{"materialize_cohort": False},
+                                  {"materialize_cohort": True, "materialize_min_size": 1},
+                                  {"single_job": True}],
+                         ids=["concurrent", "session", "single_job"])
+def test_extraction_modes_return_the_same_cohort(client, mode):
+    expected = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS, return_as_cohort=True,
+                                                   materialize_cohort=False)
+    data = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS, return_as_cohort=True,
+                                               **mode)
+    assert row_counts(data) == row_counts(expected)
+    assert sorted(data["admission"]["hadm_id"]) == HADM_IDS
+    if mode.get("materialize_cohort"):
+        assert client.sessions
+
+    by_hadm_id = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS,
+                                                     return_as_cohort=False, **mode)
+    assert sorted(by_hadm_id) == HADM_IDS
+    assert sum(len(admission["vitals"]) for admission in by_hadm_id.values()) == len(data["vitals"])
+
+
+def test_session_cohort_queries_run_one_at_a_time(mimic_demo_path, monkeypatch):
+    monkeypatch.setattr(bq_utils.bq_query_cache, "enabled", False)
+    bq_utils.bq_rate_limiter.reset()
+    # Jobs take long enough to overlap when submitted together, the emulated session then rejects them
+    client = EmulatedBigQueryClient(str(mimic_demo_path), latency_seconds=0.2)
+    data = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS, return_as_cohort=True,
+                                               materialize_min_size=1, max_workers=8)
+    assert len(client.sessions) == 1
+    assert sorted(data["admission"]["hadm_id"]) == HADM_IDS
+
+
+def active_bins(df, labels) -> set:
+    return set(zip(df["hadm_id"].astype(int), df["bin"].astype(int), labels))
+
+
+@pytest.mark.parametrize("time_resolution_hours, observation_window_hours", [(1, None), (4, 48)])
+def test_binned_continuous_sources_match_local(client, time_resolution_hours, observation_window_hours):
+    # Local binning of the same events, so only the binning is compared
+    cohort = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS, return_as_cohort=True,
+                                                 materialize_cohort=False)
+    # Intervals without an end time are dropped on both paths
+    assert cohort["prescription_medications"]["stoptime"].isna().any()
+
+    # Intervals starting before admittime (emergency department) are active from bin 0 on both paths
+    windows = data_utils.adjust_cohort_admittimes(cohort)
+    assert (windows["adjusted_admittime"] < windows["admittime"]).any()
+    long_df, features = cohort_events_to_long(cohort, time_resolution_hours, observation_window_hours)
+    long_df = long_df.merge(features, on="feature_id")
+    binned = bq_utils.get_binned_time_series_bq(client, PROJECT_ID, DATASET_ID, HADM_IDS,
+                                                time_resolution_hours, observation_window_hours)
+
+    for name in CONTINUOUS_SOURCES:
+        bq = binned[name]
+        names = data_utils.clean_column_names(bq["label"])
+        local = long_df[long_df["source"] == name]
+        assert active_bins(bq, bq["label"].map(names)) == active_bins(local, local["feature"]), name
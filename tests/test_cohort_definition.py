@@ -0,0 +1,60 @@
+import pytest
+
+bigquery = pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("duckdb")
+
+from utils import bq_utils, query_builder
+from utils.bq_emulator import EmulatedBigQueryClient
+from utils.data_utils import load_mimic_data
+from src.cohort_definition import validate_cohort_definition, cohort_definition_parameters, define_cohort_local
+
+PROJECT_ID, DATASET_ID = "emulated", "mimic_iv"
+
+DEFINITIONS = {"all": {},
+               "sepsis": {"icd_prefixes": ["A41"], "icd_version": 10},
+               "renal_or_hypertension": {"icd_prefixes": ["N17", "I1"]},
+               "icd9_only": {"icd_prefixes": ["A41"], "icd_version": 9},
+               "age": {"min_age": 25, "max_age": 79},
+               "admission_type": {"admission_types": ["ELECTIVE", "URGENT"]},
+               "icu": {"require_icu_stay": True},
+               "los": {"min_los_days": 1.0, "max_los_days": 3.5},
+               "combined": {"icd_prefixes": "N17", "min_age": 20, "require_icu_stay": True, "max_los_days": 4.5}}
+
+
+@pytest.fixture(scope="module")
+def mimic_tables(mimic_demo_path) -> tuple:
+    return load_mimic_data(str(mimic_demo_path))
+
+
+@pytest.fixture
+def client(mimic_demo_path, monkeypatch):
+    monkeypatch.setattr(bq_utils.bq_query_cache, "enabled", False)
+    return EmulatedBigQueryClient(str(mimic_demo_path))
+
+
+def select_bq(client, definition: dict) -> list:
+    definition = validate_cohort_definition(definition)
+    query = query_builder.build_cohort_definition_query(PROJECT_ID, DATASET_ID, definition)
+    job_config = bigquery.QueryJobConfig(query_parameters=cohort_definition_parameters(definition))
+    return sorted(bq_utils.execute_query(client, query, job_config).to_dataframe()["hadm_id"].tolist())
+
+
+@pytest.mark.parametrize("name", DEFINITIONS)
+def test_local_and_bq_select_the_same_admissions(client, mimic_tables, name):
+    hosp_tables, icu_tables = mimic_tables
+    local = define_cohort_local(hosp_tables, icu_tables, DEFINITIONS[name])
+    assert local == select_bq(client, DEFINITIONS[name])
+    if name == "all":
+        assert len(local) == len(hosp_tables["admissions"])
+    elif name != "icd9_only":
+        # Every criterion filters out part of the demo admissions
+        assert 0 < len(local) < len(hosp_tables["admissions"])
+
+
+@pytest.mark.parametrize("definition", [{"min_age": 80, "max_age": 20},
+                                        {"icd_version": 10},
+                                        {"admission_types": []},
+                                        {"min_los": 1}])
+def test_invalid_definitions_are_rejected(definition):
+    with pytest.raises(ValueError):
+        validate_cohort_definition(definition)
@@ -0,0 +1,33 @@
+import warnings
+from utils.data_utils import clean_column_names
+
+PREFIX = "Sodium Chloride 0.9% Flush 10 mL Syringe for Intravenous Use"
+
+
+def test_names_without_collisions_are_plain_truncations():
+    long_label = "x" * 60
+    mapping = clean_column_names(["Heart Rate", "Heart Rate", long_label, None])
+    assert mapping == {"Heart Rate": "Heart_Rate", long_label: "x" * 50}
+
+
+def test_colliding_truncations_get_distinct_stable_names():
+    labels = [f"{PREFIX} A", f"{PREFIX} B", "Heart Rate"]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        mapping = clean_column_names(labels)
+        reversed_mapping = clean_column_names(labels[::-1])
+    assert mapping[f"{PREFIX} A"] != mapping[f"{PREFIX} B"]
+    assert all(len(name) <= 50 for name in mapping.values())
+    assert mapping["Heart Rate"] == "Heart_Rate"
+    assert mapping == reversed_mapping
+
+
+def test_assigned_names_are_kept_and_new_collisions_suffixed():
+    first = clean_column_names([f"{PREFIX} A"])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        second = clean_column_names([f"{PREFIX} A", f"{PREFIX} B"], assigned=first)
+    assert list(second) == [f"{PREFIX} B"]
+    assert second[f"{PREFIX} B"] != first[f"{PREFIX} A"]
+    # A label normalizing like an assigned one shares its column
+    assert clean_column_names([f" {PREFIX} A"], assigned=first) == {f" {PREFIX} A": first[f"{PREFIX} A"]}
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.feature_store import FeatureStore
+
+HOURS = [0.0, 1.0, 2.0, 3.0, 4.0]
+HEART_RATE = [80.0, np.nan, 90.0, np.nan, 100.0]
+
+
+def binned_admission(hours: list, heart_rate: list) -> dict:
+    time_grid = pd.DataFrame({"time_point": pd.Timestamp("2150-01-01") + pd.to_timedelta(hours, "h"),
+                              "hours_from_admission": hours})
+    return {"time_grid": time_grid, "vitals": time_grid.assign(Heart_Rate=heart_rate)}
+
+
+@pytest.fixture
+def store() -> FeatureStore:
+    store = FeatureStore()
+    store.add_admission(1, binned_admission(HOURS, HEART_RATE), sources=["vitals"])
+    store.add_admission(2, binned_admission(HOURS[:2], [np.nan, 60.0]), sources=["vitals"])
+    return store
+
+
+def expected_as_of(hadm_id: int, t: float, window_hours: float) -> dict:
+    """Scan of the bins ending at or before t (bin i ends at hour i + 1)."""
+    values = HEART_RATE if hadm_id == 1 else [np.nan, 60.0]
+    visible = [v for h, v in zip(HOURS, values) if h + 1 <= t]
+    in_window = [v for h, v in zip(HOURS, values) if t - window_hours < h + 1 <= t and not np.isnan(v)]
+    observed = [v for v in visible if not np.isnan(v)]
+    return {"vitals__Heart_Rate_last": observed[-1] if observed else np.nan,
+            "vitals__Heart_Rate_sum": float(sum(in_window)),
+            "vitals__Heart_Rate_count": len(in_window),
+            "vitals__Heart_Rate_mean": np.mean(in_window) if in_window else np.nan}
+
+
+def test_batch_as_of_matches_a_scan_of_visible_bins(store):
+    queries = pd.DataFrame({"hadm_id": [1, 2, 1, 1, 2, 1, 1],
+                            "hours": [0.5, 1.0, 1.0, 2.9, 2.0, 3.0, 10.0]},
+                           index=[5, 5, 3, 2, 1, 0, 0])
+    result = store.batch_as_of(queries, window_hours=2.0)
+    assert result.index.tolist() == queries.index.tolist()
+    for i, query in enumerate(queries.itertuples()):
+        expected = expected_as_of(query.hadm_id, query.hours, 2.0)
+        pd.testing.assert_series_equal(result.iloc[i][list(expected)], pd.Series(expected), check_names=False,
+                                       check_dtype=False)
+
+
+def test_nan_hour_sees_no_bins(store):
+    features = store.as_of(1, np.nan, window_hours=24)
+    assert np.isnan(features["vitals__Heart_Rate_last"])
+    assert features["vitals__Heart_Rate_count"] == 0
+    assert np.isnan(features["vitals__Heart_Rate_mean"])
+
+
+def test_unknown_admission_raises(store):
+    with pytest.raises(KeyError):
+        store.as_of(3, 1.0)
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.data_utils import clean_column_name
+from utils.interval_index import EventIntervalIndex
+from utils.local_timeseries_utils import continuous_to_ts
+
+ORIGIN = pd.Timestamp("2150-01-01")
+
+
+@pytest.fixture
+def events() -> pd.DataFrame:
+    """Random intervals around a 24 h grid: some start before it, end after it, have no end or no length."""
+    rng = np.random.default_rng(0)
+    n = 200
+    start = ORIGIN + pd.to_timedelta(rng.uniform(-6, 30, n), "h").round("min")
+    end = start + pd.to_timedelta(rng.choice([0.0, 0.5, 3.0, 12.0], n), "h")
+    end = end.where(rng.random(n) > 0.1, pd.NaT)
+    return pd.DataFrame({"starttime": start, "endtime": end,
+                         "label": rng.choice(["Heparin", "Insulin", "NaCl 0.9%"], n),
+                         "rate": rng.integers(1, 100, n).astype(float)})
+
+
+@pytest.fixture
+def time_grid() -> pd.DataFrame:
+    time_points = pd.date_range(ORIGIN, periods=24, freq="h")
+    return pd.DataFrame({"time_point": time_points, "hours_from_admission": np.arange(24.0)})
+
+
+def loop_continuous_to_ts(df: pd.DataFrame, time_grid: pd.DataFrame, value_col: str | None) -> pd.DataFrame:
+    """Per-row mask scan replaced by EventIntervalIndex.grid_ranges."""
+    ts_df = time_grid.copy()
+    time_points = time_grid["time_point"].to_numpy()
+    ends = df["endtime"].fillna(time_grid["time_point"].iloc[-1] + pd.Timedelta(hours=1))
+    for label in df["label"].unique():
+        ts_df[clean_column_name(label)] = np.zeros(len(time_grid), dtype=np.int8 if value_col is None else float)
+    for row, end in zip(df.itertuples(), ends):
+        mask = (time_points >= row.starttime) & (time_points < end)
+        ts_df.loc[mask, clean_column_name(row.label)] = 1 if value_col is None else getattr(row, value_col)
+    return ts_df
+
+
+def test_grid_ranges_match_the_mask_scan(events, time_grid):
+    default_end = time_grid["time_point"].iloc[-1] + pd.Timedelta(hours=1)
+    index = EventIntervalIndex(events, "starttime", "endtime", "label", default_end=default_end)
+    positions, first, last = index.grid_ranges(time_grid["time_point"])
+    time_points = time_grid["time_point"].to_numpy()
+    for position, lo, hi in zip(positions, first, last):
+        row = events.iloc[position]
+        end = default_end if pd.isna(row["endtime"]) else row["endtime"]
+        covered = np.flatnonzero((time_points >= row["starttime"]) & (time_points < end))
+        assert covered.tolist() == list(range(lo, max(lo, hi)))
+
+
+def test_stab_overlap_and_count_match_a_scan(events):
+    index = EventIntervalIndex(events, "starttime", "endtime", "label")
+    starts = events["starttime"]
+    ends = events["endtime"].fillna(pd.Timestamp.max)
+    times = ORIGIN + pd.to_timedelta(np.arange(-8, 34, 0.5), "h")
+    for t in times:
+        active = np.flatnonzero((starts <= t) & (ends > t))
+        assert sorted(index.stab(t)) == active.tolist()
+        window_end = t + pd.Timedelta(hours=2)
+        overlapping = np.flatnonzero((starts < window_end) & (ends > t))
+        assert sorted(index.overlap(t, window_end)) == overlapping.tolist()
+    assert index.count_active(times).tolist() == [len(index.stab(t)) for t in times]
+
+
+@pytest.mark.parametrize("value_col", [None, "rate"])
+def test_continuous_to_ts_matches_the_mask_scan(events, time_grid, value_col):
+    result = continuous_to_ts(events, time_grid, "starttime", "endtime", "label", value_col)
+    expected = loop_continuous_to_ts(events, time_grid, value_col)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
@@ -0,0 +1,41 @@
+import pandas as pd
+from utils.local_timeseries_utils import generate_anchored_time_series_data, get_anchor_windows
+
+
+def multi_stay_admission() -> tuple[dict, dict]:
+    """Admission with two ICU stays (vitals only in the first) and icu_tables holding another admission's stay."""
+    data_dict = {"hadm_id": 1,
+                 "admittime": pd.Timestamp("2150-01-01 00:00"),
+                 "dischtime": pd.Timestamp("2150-01-05 00:00"),
+                 # Local vitals are the hadm_id merge of icustays and chartevents
+                 "vitals": pd.DataFrame({"hadm_id": 1,
+                                         "stay_id_x": 11,
+                                         "stay_id_y": 11,
+                                         "intime": pd.Timestamp("2150-01-01 06:00"),
+                                         "outtime": pd.Timestamp("2150-01-02 06:00"),
+                                         "charttime": pd.to_datetime(["2150-01-01 07:30", "2150-01-01 09:10"]),
+                                         "label": "Heart Rate",
+                                         "valuenum": [80.0, 100.0]})}
+    icu_tables = {"icustays": pd.DataFrame({"hadm_id": [1, 2, 1],
+                                            "stay_id": [12, 21, 11],
+                                            "intime": ["2150-01-03 00:00", "2150-01-03 00:00", "2150-01-01 06:00"],
+                                            "outtime": ["2150-01-04 00:00", "2150-01-04 00:00", "2150-01-02 06:00"]})}
+    return data_dict, icu_tables
+
+
+def test_icu_stay_anchor_windows_come_from_icustays():
+    data_dict, icu_tables = multi_stay_admission()
+    windows = get_anchor_windows(data_dict, "icu_stay", icu_tables)
+    assert windows["anchor_id"].tolist() == [11, 12]
+    assert windows["start_time"].tolist() == pd.to_datetime(["2150-01-01 06:00", "2150-01-03 00:00"]).tolist()
+
+
+def test_every_icu_stay_gets_a_grid():
+    data_dict, icu_tables = multi_stay_admission()
+    results, messages = generate_anchored_time_series_data(data_dict, 1, None, anchor_tables=icu_tables)
+    assert sorted(results) == [11, 12]
+    assert len(results[11]["time_grid"]) == 25
+    assert len(results[12]["time_grid"]) == 25
+    vitals = results[11]["vitals"].set_index("hours_from_admission")["Heart_Rate"]
+    assert vitals.loc[1.0] == 80.0 and vitals.loc[3.0] == 100.0
+    assert "Heart_Rate" not in results[12].get("vitals", pd.DataFrame()).columns
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+from config.project_config import mimic_iv_data_sources
+from utils.data_utils import load_mimic_data, extract_admissions_data, adjust_cohort_admittimes
+from utils.local_timeseries_utils import generate_single_admission_time_series_data
+from utils.long_format_utils import cohort_events_to_long, StreamingLongFormatBuilder, long_to_wide, long_to_tensor
+from utils.parquet_utils import save_long_events_parquet, read_admission
+
+GRID_COLUMNS = ["time_point", "hours_from_admission"]
+
+
+@pytest.fixture(scope="module")
+def cohort(mimic_demo_path) -> tuple:
+    hosp_tables, icu_tables = load_mimic_data(str(mimic_demo_path))
+    hadm_ids = hosp_tables["admissions"]["hadm_id"].tolist()
+    return (extract_admissions_data(hosp_tables, icu_tables, hadm_ids, return_as_cohort=True),
+            extract_admissions_data(hosp_tables, icu_tables, hadm_ids, return_as_cohort=False))
+
+
+def long_column(wide: pd.DataFrame, column: str) -> np.ndarray:
+    """Column of long_to_wide, "<feature>_present" flags are the observed bins of the feature (1/NaN)."""
+    if column.endswith("_present") and column not in wide:
+        return np.where(wide[column[:-len("_present")]].notna(), 1.0, np.nan)
+    return wide[column].to_numpy(dtype=float) if column in wide else np.full(len(wide), np.nan)
+
+
+def expected_column(df: pd.DataFrame, datatype: str, column: str) -> np.ndarray:
+    """Column of the per-admission pipeline, with 0/1 flags as NaN/1 like the long table."""
+    values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float)
+    flag = datatype != "discrete" or column.endswith("_present")
+    return np.where(values > 0, 1.0, np.nan) if flag else values
+
+
+def test_long_to_wide_matches_the_per_admission_pipeline(cohort):
+    cohort_data, by_hadm_id = cohort
+    long_df, features = cohort_events_to_long(cohort_data, 1)
+    compared = set()
+    for hadm_id, data_dict in by_hadm_id.items():
+        ts_results, _ = generate_single_admission_time_series_data(data_dict, 1, None)
+        n_bins = len(ts_results["time_grid"])
+        wide = long_to_wide(long_df, features, hadm_id, 1, n_bins=n_bins)
+        assert wide["hours_from_admission"].tolist() == ts_results["time_grid"]["hours_from_admission"].tolist()
+        for src in mimic_iv_data_sources:
+            df = ts_results.get(src["name"])
+            if df is None or df.empty:
+                continue
+            for column in df.columns.drop(GRID_COLUMNS, errors="ignore"):
+                np.testing.assert_allclose(long_column(wide, column), expected_column(df, src["datatype"], column),
+                                           rtol=1e-5, err_msg=f"{hadm_id} {column}")
+                compared.add(src["datatype"])
+    assert compared == {"discrete", "continuous", "categorical"}
+
+
+def test_observation_window_only_truncates_bins(cohort):
+    cohort_data, _ = cohort
+    long_df, features = cohort_events_to_long(cohort_data, 1)
+    windowed, windowed_features = cohort_events_to_long(cohort_data, 1, observation_window_hours=24)
+    pd.testing.assert_frame_equal(windowed_features, features)
+    pd.testing.assert_frame_equal(windowed, long_df[long_df["bin"] <= 24].reset_index(drop=True))
+
+
+def test_streamed_batches_match_the_cohort_conversion(cohort):
+    cohort_data, _ = cohort
+    windows = adjust_cohort_admittimes(cohort_data)
+    long_df, features = cohort_events_to_long(cohort_data, 2, windows=windows)
+
+    builder = StreamingLongFormatBuilder(windows, 2, compact_rows=50)
+    for name, df in cohort_data.items():
+        if name in {src["name"] for src in mimic_iv_data_sources}:
+            for batch in np.array_split(np.arange(len(df)), 3):
+                builder.add(name, df.iloc[batch])
+    streamed, streamed_features = builder.result()
+
+    def named(df, feature_table):
+        return (df.merge(feature_table, on="feature_id").drop(columns="feature_id")
+                .sort_values(["hadm_id", "bin", "source", "feature"], ignore_index=True))
+    pd.testing.assert_frame_equal(named(streamed, streamed_features), named(long_df, features),
+                                  check_dtype=False, check_categorical=False)
+
+
+def test_tensor_and_parquet_exports_keep_the_long_rows(cohort, tmp_path):
+    cohort_data, _ = cohort
+    long_df, features = cohort_events_to_long(cohort_data, 4)
+    values, mask, hadm_ids = long_to_tensor(long_df, features)
+    assert mask.sum() == len(long_df)
+    a = np.searchsorted(hadm_ids, long_df["hadm_id"])
+    np.testing.assert_array_equal(values[a, long_df["bin"], long_df["feature_id"]], long_df["value"])
+
+    save_long_events_parquet(long_df, features, str(tmp_path), n_buckets=3)
+    for hadm_id in hadm_ids:
+        rows = read_admission(str(tmp_path), hadm_id, table="events", n_buckets=3)
+        expected = long_df[long_df["hadm_id"] == hadm_id].reset_index(drop=True)
+        pd.testing.assert_frame_equal(rows.sort_values(["bin", "feature_id"], ignore_index=True), expected)
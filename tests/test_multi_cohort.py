@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("duckdb")
+
+from utils import bq_utils
+from utils.bq_emulator import EmulatedBigQueryClient
+from utils.data_utils import load_mimic_data
+from src.multi_cohort import (MAX_COHORTS, cohort_membership, tag_cohort_membership, split_by_cohort,
+                              extract_cohorts_local, extract_cohorts_bq)
+
+PROJECT_ID, DATASET_ID = "emulated", "mimic_iv"
+DEFINITIONS = {"sepsis": {"icd_prefixes": ["A41"]},
+               "renal": {"icd_prefixes": ["N17"], "require_icu_stay": True},
+               "adults_under_60": {"min_age": 18, "max_age": 59}}
+
+
+def test_membership_sets_one_bit_per_cohort():
+    membership = cohort_membership({"a": [3, 1], "b": [2, 3], "c": [], "d": [1]})
+    assert membership["hadm_id"].tolist() == [1, 2, 3]
+    assert membership["cohort_mask"].tolist() == [0b1001, 0b0010, 0b0011]
+    assert membership["cohort_mask"].dtype == np.int64
+
+
+def test_split_returns_each_cohort_rows():
+    cohorts = {f"c{bit}": [bit] for bit in range(MAX_COHORTS)}
+    cohorts["c62"] = [0, 62]
+    membership = cohort_membership(cohorts)
+    # Bit 62 is the highest bit of the int64 mask, admissions in no cohort must not turn it into a float
+    assert membership.set_index("hadm_id").loc[0, "cohort_mask"] == 1 | (1 << 62)
+
+    events = pd.DataFrame({"hadm_id": [0, 0, 62, 5, 99], "value": [1, 2, 3, 4, 5]})
+    tagged = tag_cohort_membership({"events": events}, membership)
+    assert tagged["events"]["cohort_mask"].iloc[-1] == 0
+
+    split = split_by_cohort(tagged, list(cohorts))
+    assert split["c0"]["events"]["value"].tolist() == [1, 2]
+    assert split["c62"]["events"]["value"].tolist() == [1, 2, 3]
+    assert split["c5"]["events"]["value"].tolist() == [4]
+    assert split["c1"]["events"].empty
+    assert list(split["c0"]["events"].columns) == ["hadm_id", "value"]
+
+
+def test_too_many_cohorts_are_rejected():
+    with pytest.raises(ValueError):
+        extract_cohorts_local({}, {}, {f"c{i}": {} for i in range(MAX_COHORTS + 1)})
+
+
+@pytest.fixture
+def client(mimic_demo_path, monkeypatch):
+    monkeypatch.setattr(bq_utils.bq_query_cache, "enabled", False)
+    return EmulatedBigQueryClient(str(mimic_demo_path))
+
+
+def test_bq_and_local_shared_scans_select_the_same_cohorts(client, mimic_demo_path):
+    hosp_tables, icu_tables = load_mimic_data(str(mimic_demo_path))
+    local, local_membership = extract_cohorts_local(hosp_tables, icu_tables, DEFINITIONS)
+    bq, bq_membership = extract_cohorts_bq(client, PROJECT_ID, DATASET_ID, DEFINITIONS, materialize_min_size=1)
+
+    pd.testing.assert_frame_equal(bq_membership.sort_values("hadm_id", ignore_index=True), local_membership,
+                                  check_dtype=False)
+    for name in DEFINITIONS:
+        hadm_ids = sorted(local[name]["admission"]["hadm_id"])
+        assert hadm_ids and sorted(bq[name]["admission"]["hadm_id"]) == hadm_ids, name
+
+        # Splitting the shared scan gives what a separate extraction of the cohort returns
+        separate = bq_utils.extract_admissions_data_bq(client, PROJECT_ID, DATASET_ID, hadm_ids,
+                                                       return_as_cohort=True, materialize_cohort=False)
+        assert {source: len(df) for source, df in bq[name].items()} == \
+               {source: len(df) for source, df in separate.items()}, name
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.parquet_utils import AdmissionParquetWriter, save_admissions_parquet, read_admission, read_dataset
+
+HADM_IDS = [20000000 + i for i in range(12)]
+
+
+def binned_admission(hadm_id: int) -> dict:
+    hours = np.arange(4.0)
+    time_grid = pd.DataFrame({"time_point": pd.Timestamp("2150-01-01") + pd.to_timedelta(hours, "h"),
+                              "hours_from_admission": hours})
+    vitals = time_grid.assign(Heart_Rate=[60.0 + hadm_id % 100, np.nan, 70.0, np.nan])
+    if hadm_id % 2:
+        # Features present in only some admissions give the wide batches different column sets
+        vitals["Resp_Rate"] = 12.0
+    return {"hadm_id": hadm_id,
+            "subject_id": hadm_id - 10000000,
+            "demographics": pd.DataFrame({"gender": ["F"], "age": [40 + hadm_id % 10]}),
+            "primary_diagnosis": "Sepsis",
+            "diagnoses": ["Sepsis", "Essential hypertension"],
+            "time_grid": time_grid,
+            "vitals": vitals}
+
+
+@pytest.mark.parametrize("dynamic_format", ["long", "wide"])
+def test_read_admission_with_non_default_buckets(tmp_path, dynamic_format):
+    admissions = {hadm_id: binned_admission(hadm_id) for hadm_id in HADM_IDS}
+    save_admissions_parquet(admissions, str(tmp_path), dynamic_format=dynamic_format, batch_size=5, n_buckets=5)
+    assert {p.name for p in (tmp_path / "static").iterdir()} == {f"hadm_bucket={b}" for b in range(5)}
+
+    for hadm_id in HADM_IDS:
+        static = read_admission(str(tmp_path), hadm_id, table="static", n_buckets=5)
+        assert static["hadm_id"].tolist() == [hadm_id]
+        assert static["diagnoses"].iloc[0] == "Sepsis, Essential hypertension"
+
+        dynamic = read_admission(str(tmp_path), hadm_id, n_buckets=5)
+        assert set(dynamic["hadm_id"]) == {hadm_id}
+        if dynamic_format == "long":
+            heart_rate = dynamic[dynamic["feature"] == "Heart_Rate"]
+            assert heart_rate["hours_from_admission"].tolist() == [0.0, 2.0]
+            assert set(dynamic["feature"]) == ({"Heart_Rate", "Resp_Rate"} if hadm_id % 2 else {"Heart_Rate"})
+        else:
+            assert dynamic["hours_from_admission"].tolist() == [0.0, 1.0, 2.0, 3.0]
+            assert dynamic["Heart_Rate"].iloc[0] == 60.0 + hadm_id % 100
+
+    assert sorted(read_dataset(str(tmp_path))["hadm_id"]) == HADM_IDS
+
+
+def test_reopened_writer_appends(tmp_path):
+    with AdmissionParquetWriter(str(tmp_path), n_buckets=3) as writer:
+        writer.add_admission(binned_admission(HADM_IDS[0]))
+    with AdmissionParquetWriter(str(tmp_path), n_buckets=3) as writer:
+        writer.add_admission(binned_admission(HADM_IDS[3]))
+    # Both admissions are in bucket hadm_id % 3 == 2, in two files
+    assert len(list((tmp_path / "static" / "hadm_bucket=2").glob("part-*.parquet"))) == 2
+    assert sorted(read_dataset(str(tmp_path))["hadm_id"]) == [HADM_IDS[0], HADM_IDS[3]]
+    assert read_admission(str(tmp_path), HADM_IDS[3], table="static", n_buckets=3)["hadm_id"].tolist() == [HADM_IDS[3]]
@@ -0,0 +1,88 @@
+import os
+import time
+from types import SimpleNamespace
+import pyarrow as pa
+import pytest
+from utils.query_cache import QueryResultCache, CachedQueryResult, is_cacheable_query
+
+QUERY = """SELECT hadm_id, valuenum  -- labs of the cohort
+           FROM `project.mimic_iv.labevents`
+           WHERE hadm_id IN UNNEST(@hadm_ids)"""
+
+
+def job_config(hadm_ids: list, labels: dict | None = None) -> SimpleNamespace:
+    """Job configuration with parameters serialized like bigquery.ArrayQueryParameter.to_api_repr."""
+    parameter = SimpleNamespace(to_api_repr=lambda: {"name": "hadm_ids", "parameterValue": {
+        "arrayValues": [{"value": str(h)} for h in hadm_ids]}})
+    return SimpleNamespace(query_parameters=[parameter], labels=labels)
+
+
+def table(n_rows: int) -> pa.Table:
+    return pa.table({"hadm_id": list(range(n_rows)), "valuenum": [float(i) for i in range(n_rows)]})
+
+
+def test_key_ignores_formatting_but_not_parameters_labels_or_version(tmp_path):
+    cache = QueryResultCache(str(tmp_path), dataset_version="mimic-iv-2.2")
+    key = cache.key(QUERY, job_config([1, 2]))
+    reformatted = "SELECT hadm_id, valuenum FROM `project.mimic_iv.labevents`\nWHERE hadm_id IN UNNEST(@hadm_ids)"
+    assert cache.key(reformatted, job_config([1, 2])) == key
+    assert cache.key(QUERY, job_config([1, 3])) != key
+    assert cache.key(QUERY, job_config([1, 2], labels={"cohort": "sepsis"})) != key
+    assert QueryResultCache(str(tmp_path), dataset_version="mimic-iv-3.1").key(QUERY, job_config([1, 2])) != key
+
+
+def test_put_and_get_round_trip(tmp_path):
+    cache = QueryResultCache(str(tmp_path))
+    key = cache.key(QUERY)
+    assert cache.get(key) is None
+    cache.put(key, table(5))
+    assert cache.get(key).equals(table(5))
+    assert not list(tmp_path.glob("*.tmp"))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+    result = CachedQueryResult(cache.get(key), cache_hit=True)
+    assert result.total_rows == 5 and len(result.to_dataframe()) == 5
+    assert sum(batch.num_rows for batch in result.to_arrow_iterable(max_chunksize=2)) == 5
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = QueryResultCache(str(tmp_path), ttl_seconds=60)
+    cache.put("old", table(3))
+    cache.put("new", table(3))
+    written = time.time() - 120
+    os.utime(tmp_path / "old.parquet", (written, written))
+    assert cache.get("old") is None
+    assert not (tmp_path / "old.parquet").exists()
+    assert cache.get("new") is not None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = QueryResultCache(str(tmp_path))
+    for key in ["a", "b", "c"]:
+        cache.put(key, table(100))
+    size = (tmp_path / "a.parquet").stat().st_size
+    now = time.time()
+    # Last access: b before c before a (a was read after being written)
+    for age, key in [(30, "b"), (20, "c"), (10, "a")]:
+        os.utime(tmp_path / f"{key}.parquet", (now - age, now - 40))
+
+    cache.max_bytes = 3 * size
+    cache.put("d", table(100))
+    assert sorted(p.stem for p in tmp_path.glob("*.parquet")) == ["a", "c", "d"]
+    assert cache.stats()["evictions"] == 1
+
+    # A hit refreshes the access time, c is now the least recently used
+    assert cache.get("a") is not None
+    os.utime(tmp_path / "d.parquet", (now - 5, now - 5))
+    cache.put("e", table(100))
+    assert sorted(p.stem for p in tmp_path.glob("*.parquet")) == ["a", "d", "e"]
+
+
+@pytest.mark.parametrize("query, expected", [(QUERY, True),
+                                             ("WITH x AS (SELECT 1) SELECT * FROM x", True),
+                                             ("CREATE TEMP TABLE cohort AS SELECT 1", False),
+                                             ("SELECT 1; SELECT 2", False),
+                                             ("SELECT 1;", True)])
+def test_only_single_select_statements_are_cacheable(query, expected):
+    assert is_cacheable_query(query) == expected
@@ -0,0 +1,66 @@
+import json
+from types import SimpleNamespace
+import pytest
+from utils.query_stats import QueryStatsLog, QUERY_STATS_COLUMNS
+
+QUERY = "SELECT hadm_id, valuenum FROM `emulated.mimic_iv.labevents` WHERE valuenum > 100"
+
+
+def finished_job(bytes_processed: int, cache_hit: bool = False) -> SimpleNamespace:
+    """Attributes of a finished bigquery.QueryJob read by QueryStatsLog.record."""
+    return SimpleNamespace(job_id="job_1", statement_type="SELECT", total_bytes_processed=bytes_processed,
+                           total_bytes_billed=max(bytes_processed, 10 * 1024 ** 2), slot_millis=250,
+                           cache_hit=cache_hit)
+
+
+def test_records_and_summary(tmp_path):
+    log = QueryStatsLog(str(tmp_path / "stats" / "queries.jsonl"))
+    log.record(QUERY, "dry_run", estimated_bytes=4096)
+    log.record(QUERY, "bigquery", job=finished_job(4096), rows=12, elapsed_seconds=0.5)
+    log.record(QUERY, "bigquery", job=finished_job(0, cache_hit=True), rows=12)
+    log.record(QUERY, "local_cache", rows=12)
+
+    df = log.to_dataframe()
+    assert list(df.columns) == QUERY_STATS_COLUMNS
+    assert df["query_hash"].nunique() == 1
+    assert df["cache_hit"].tolist()[1:] == [False, True, True]
+    assert log.summary() == {"queries": 3,
+                             "bigquery_jobs": 2,
+                             "local_cache_hits": 1,
+                             "bigquery_cache_hits": 1,
+                             "bytes_processed": 4096,
+                             "bytes_billed": 2 * 10 * 1024 ** 2,
+                             "slot_ms": 500}
+
+    with open(tmp_path / "stats" / "queries.jsonl") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["source"] for line in lines] == ["dry_run", "bigquery", "bigquery", "local_cache"]
+    log.clear()
+    assert log.to_dataframe().empty
+
+
+@pytest.fixture
+def bq_utils(monkeypatch, tmp_path):
+    pytest.importorskip("google.cloud.bigquery")
+    pytest.importorskip("duckdb")
+    from utils import bq_utils
+    monkeypatch.setattr(bq_utils, "bq_query_cache", bq_utils.QueryResultCache(str(tmp_path / "cache")))
+    bq_utils.bq_query_stats.clear()
+    return bq_utils
+
+
+def test_budget_guard_refuses_queries_over_budget(bq_utils, mimic_demo_path):
+    from utils.bq_emulator import EmulatedBigQueryClient
+    client = EmulatedBigQueryClient(str(mimic_demo_path))
+    estimate = bq_utils.estimate_query_bytes(client, QUERY)
+    assert estimate > 0
+
+    with pytest.raises(bq_utils.QueryBudgetExceeded):
+        bq_utils.execute_query(client, QUERY, max_bytes_scanned=estimate - 1)
+    assert list(bq_utils.get_query_stats()["source"]) == ["dry_run", "dry_run"]
+
+    rows = bq_utils.execute_query(client, QUERY, max_bytes_scanned=estimate).to_dataframe()
+    # Cached results are served without a dry run, whatever the budget
+    cached = bq_utils.execute_query(client, QUERY, max_bytes_scanned=0).to_dataframe()
+    assert cached.equals(rows)
+    assert list(bq_utils.get_query_stats()["source"]) == ["dry_run", "dry_run", "dry_run", "bigquery", "local_cache"]
@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from utils import rate_limiter
+from utils.rate_limiter import TokenBucket, AdaptiveRateLimiter, is_rate_limit_error
+
+
+class RateLimitError(Exception):
+    code = 429
+
+
+@pytest.fixture
+def clock(monkeypatch) -> SimpleNamespace:
+    """Fake monotonic clock, sleeping advances it instantly."""
+    clock = SimpleNamespace(now=0.0, slept=[])
+
+    def sleep(seconds):
+        clock.slept.append(seconds)
+        clock.now += seconds
+    monkeypatch.setattr(rate_limiter, "time", SimpleNamespace(monotonic=lambda: clock.now, sleep=sleep))
+    return clock
+
+
+def test_burst_then_steady_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    waits = [bucket.acquire() for _ in range(6)]
+    assert waits == [0, 0, 0, 0.5, 0.5, 0.5]
+    assert bucket.throttled_seconds == pytest.approx(1.5)
+
+    # An idle second refills two tokens
+    clock.now += 1.0
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0.5]
+
+
+def test_backoff_halves_and_recovery_is_additive(clock):
+    bucket = TokenBucket(rate=8, burst=1, min_rate=1)
+    for expected in [4, 2, 1, 1]:
+        bucket.backoff()
+        assert bucket.rate == expected
+    assert bucket.retries == 4
+
+    rates = []
+    for _ in range(10):
+        bucket.recover()
+        rates.append(bucket.rate)
+    assert rates[:3] == pytest.approx([1.8, 2.6, 3.4])
+    assert rates[-1] == 8
+
+    # Calls are spaced at the reduced rate
+    bucket.backoff()
+    bucket.acquire()
+    assert bucket.acquire() == pytest.approx(0.25)
+
+
+def test_call_retries_rate_limit_errors(clock):
+    limiter = AdaptiveRateLimiter({"query": {"rate": 4, "burst": 10}}, max_retries=3, base_delay=1.0)
+    responses = [RateLimitError("429"), Exception("403 quotaExceeded: Exceeded rate limits"), "rows"]
+
+    def query():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert limiter.call("query", query) == "rows"
+    bucket = limiter.bucket("query")
+    assert bucket.retries == 2
+    # Halved twice, then one additive step after the success
+    assert bucket.rate == pytest.approx(1 + 0.4)
+    assert all(0 <= delay <= 2 ** attempt for attempt, delay in enumerate(clock.slept))
+    assert limiter.stats()["query"]["retries"] == 2
+
+
+def test_call_raises_other_errors_and_after_max_retries(clock):
+    limiter = AdaptiveRateLimiter({}, max_retries=2, base_delay=0.1)
+    calls = []
+
+    def failing(error):
+        calls.append(error)
+        raise error
+
+    with pytest.raises(ValueError):
+        limiter.call("metadata", failing, ValueError("bad query"))
+    assert len(calls) == 1
+    with pytest.raises(RateLimitError):
+        limiter.call("metadata", failing, RateLimitError())
+    assert len(calls) == 1 + 3
+
+
+def test_limit_decorates_async_functions(clock):
+    limiter = AdaptiveRateLimiter({"query": {"rate": 100, "burst": 5}}, base_delay=0)
+    attempts = []
+
+    @limiter.limit("query")
+    async def query(value):
+        attempts.append(value)
+        if len(attempts) == 1:
+            raise RateLimitError()
+        return value * 2
+
+    assert asyncio.run(query(21)) == 42
+    assert attempts == [21, 21]
+    assert limiter.bucket("query").retries == 1
+
+
+@pytest.mark.parametrize("error, expected", [(RateLimitError(), True),
+                                             (SimpleNamespace(errors=[{"reason": "rateLimitExceeded"}]), True),
+                                             (Exception("Quota exceeded: quotaExceeded"), True),
+                                             (Exception("Syntax error"), False)])
+def test_is_rate_limit_error(error, expected):
+    assert is_rate_limit_error(error) == expected
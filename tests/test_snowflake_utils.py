@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("duckdb")
+
+from utils.snowflake_emulator import EmulatedSnowflakeConnection
+from utils.snowflake_utils import export_cohort_to_snowflake, export_parquet_dataset_to_snowflake
+
+STAGE = "@mimic_stage"
+
+
+def labs(values: list) -> pd.DataFrame:
+    return pd.DataFrame({"hadm_id": range(1, len(values) + 1),
+                         "charttime": pd.date_range("2150-01-01", periods=len(values), freq="h"),
+                         "valuenum": values})
+
+
+def table_values(connection, table_name: str) -> list:
+    cursor = connection.cursor().execute(f"SELECT valuenum FROM {table_name} ORDER BY hadm_id")
+    return [row[0] for row in cursor.fetchall()]
+
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = EmulatedSnowflakeConnection(str(tmp_path / "stages"))
+    yield connection
+    connection.close()
+
+
+def test_rerunning_an_export_loads_nothing(connection, tmp_path):
+    first = export_cohort_to_snowflake(connection, {"labs": labs([1.0, 2.0, 3.0])}, str(tmp_path / "out"), STAGE)
+    second = export_cohort_to_snowflake(connection, {"labs": labs([1.0, 2.0, 3.0])}, str(tmp_path / "out"), STAGE)
+    assert first[0]["rows_loaded"] == 3 and second[0]["skipped"]
+    assert table_values(connection, "labs") == [1.0, 2.0, 3.0]
+
+
+def test_re_extracted_cohort_replaces_the_table(connection, tmp_path):
+    output_dir = str(tmp_path / "out")
+    export_cohort_to_snowflake(connection, {"labs": labs([1.0, 2.0, 3.0])}, output_dir, STAGE)
+    export_cohort_to_snowflake(connection, {"labs": labs([1.0, 5.0, 3.0])}, output_dir, STAGE)
+    assert table_values(connection, "labs") == [1.0, 5.0, 3.0]
+
+    # Back to data loaded before: COPY INTO load metadata must not skip its files
+    export_cohort_to_snowflake(connection, {"labs": labs([1.0, 2.0, 3.0])}, output_dir, STAGE)
+    assert table_values(connection, "labs") == [1.0, 2.0, 3.0]
+    assert len(list((tmp_path / "out" / "labs").glob("part-*.parquet"))) == 1
+
+
+def test_dataset_export_loads_new_parts_and_reloads_changed_ones(connection, tmp_path):
+    folder = tmp_path / "sink" / "labs"
+    folder.mkdir(parents=True)
+    labs([1.0, 2.0]).to_parquet(folder / "part-00000.parquet")
+    export_parquet_dataset_to_snowflake(connection, str(tmp_path / "sink"), STAGE)
+
+    # A batch extracted later is appended
+    labs([1.0, 2.0, 3.0]).iloc[2:].to_parquet(folder / "part-00001.parquet")
+    results = export_parquet_dataset_to_snowflake(connection, str(tmp_path / "sink"), STAGE)
+    assert [result["skipped"] for result in results] == [True, False]
+    assert table_values(connection, "labs") == [1.0, 2.0, 3.0]
+
+    # A re-extracted batch replaces its earlier rows
+    labs([7.0, 8.0]).to_parquet(folder / "part-00000.parquet")
+    export_parquet_dataset_to_snowflake(connection, str(tmp_path / "sink"), STAGE)
+    assert table_values(connection, "labs") == [7.0, 8.0, 3.0]
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.long_format_utils import long_to_tensor
+from utils.tensor_export_utils import export_cohort_tensors, observation_deltas, load_cohort_tensors
+
+HADM_IDS = [20000000 + i for i in range(7)]
+
+
+@pytest.fixture
+def long_events() -> tuple[pd.DataFrame, pd.DataFrame]:
+    rng = np.random.default_rng(0)
+    rows = pd.DataFrame({"hadm_id": rng.choice(HADM_IDS[:-1], 300),
+                         "bin": rng.integers(0, 30, 300),
+                         "feature_id": rng.integers(0, 4, 300),
+                         "value": rng.normal(size=300).round(2)})
+    long_df = rows.drop_duplicates(["hadm_id", "bin", "feature_id"]).sort_values(["hadm_id", "bin", "feature_id"],
+                                                                                 ignore_index=True)
+    features = pd.DataFrame({"feature_id": range(4), "source": "labs",
+                             "feature": ["Creatinine", "Sodium", "Potassium", "Glucose"]})
+    return long_df, features
+
+
+def loop_deltas(mask: np.ndarray, resolution: float) -> np.ndarray:
+    deltas = np.zeros(mask.shape)
+    for a, b, f in np.ndindex(*mask.shape):
+        if b > 0:
+            deltas[a, b, f] = resolution + (0 if mask[a, b - 1, f] else deltas[a, b - 1, f])
+    return deltas
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_export_matches_the_dense_tensor(long_events, tmp_path, chunk_size):
+    long_df, features = long_events
+    # The last admission has no events, the grid is shorter than the longest admission
+    index = export_cohort_tensors(long_df, features, str(tmp_path), 2.0, n_bins=24, hadm_ids=HADM_IDS,
+                                  chunk_size=chunk_size)
+    arrays, loaded = load_cohort_tensors(str(tmp_path))
+    assert loaded == index
+    assert isinstance(arrays["features"], np.memmap)
+    assert arrays["features"].shape == (len(HADM_IDS), 24, 4)
+
+    values, mask, _ = long_to_tensor(long_df, features, hadm_ids=HADM_IDS, n_bins=24)
+    np.testing.assert_array_equal(arrays["mask"], mask)
+    np.testing.assert_array_equal(arrays["features"], np.nan_to_num(values))
+    np.testing.assert_allclose(arrays["deltas"], loop_deltas(mask, 2.0))
+
+    truncated = long_df[long_df["bin"] < 24]
+    expected_lengths = truncated.groupby("hadm_id")["bin"].max().add(1).reindex(HADM_IDS, fill_value=0)
+    assert index["lengths"] == expected_lengths.tolist()
+    assert index["offsets"][str(HADM_IDS[-1])] == len(HADM_IDS) - 1
+
+
+def test_observation_deltas_reset_after_an_observation():
+    mask = np.array([[[1], [0], [0], [1], [0]]], dtype=np.uint8)
+    assert observation_deltas(mask, 4.0)[0, :, 0].tolist() == [0.0, 4.0, 8.0, 12.0, 4.0]
+
+
+def test_dataset_reads_rows_in_request_order(long_events, tmp_path):
+    pytest.importorskip("torch")
+    from src.modeling.timeseries_dataset import CohortTimeSeriesDataset
+
+    long_df, features = long_events
+    export_cohort_tensors(long_df, features, str(tmp_path), 1.0, n_bins=30, hadm_ids=HADM_IDS)
+    dataset = CohortTimeSeriesDataset(str(tmp_path), labels={h: h % 2 for h in HADM_IDS})
+    batch = dataset[[4, 1, 2]]
+    assert batch["hadm_id"].tolist() == [HADM_IDS[4], HADM_IDS[1], HADM_IDS[2]]
+    assert batch["features"][0].numpy().tolist() == dataset[4]["features"].numpy().tolist()
+    assert batch["label"].tolist() == [h % 2 for h in batch["hadm_id"].tolist()]
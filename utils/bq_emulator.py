@@ -0,0 +1,528 @@
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from os.path import join, exists
+import pyarrow as pa
+import duckdb
+# pip install duckdb
+
+# Offline stand-in for the part of google.cloud.bigquery.Client used by bq_utils, backed by DuckDB over
+# the MIMIC-IV demo CSVs. BigQuery SQL built by query_builder is translated to DuckDB (translate_sql),
+# job latency, quota errors and the BigQuery result cache are simulated, so concurrency, caching and
+# rate limiting can be benchmarked without network access:
+#
+#     client = EmulatedBigQueryClient(mimic4_path, latency_seconds=0.5, max_queries_per_second=2)
+#     data = bq_utils.extract_admissions_data_bq(client, "emulated", "mimic_iv", hadm_ids, True)
+
+MIMIC_TABLES = {"hosp": ["patients", "admissions", "diagnoses_icd", "d_icd_diagnoses", "labevents", "d_labitems",
+                         "services", "transfers", "prescriptions", "procedures_icd", "d_icd_procedures", "emar"],
+                "icu": ["icustays", "chartevents", "d_items", "procedureevents", "inputevents"]}
+
+# BigQuery parameter/cast types to DuckDB types
+DUCKDB_TYPES = {"INT64": "BIGINT", "FLOAT64": "DOUBLE", "NUMERIC": "DECIMAL(38, 9)", "STRING": "VARCHAR",
+                "BOOL": "BOOLEAN", "TIMESTAMP": "TIMESTAMP", "DATETIME": "TIMESTAMP", "DATE": "DATE"}
+# DuckDB result types to BigQuery schema field types
+BIGQUERY_TYPES = {"BIGINT": "INTEGER", "INTEGER": "INTEGER", "SMALLINT": "INTEGER", "DOUBLE": "FLOAT",
+                  "FLOAT": "FLOAT", "VARCHAR": "STRING", "BOOLEAN": "BOOLEAN", "TIMESTAMP": "DATETIME",
+                  "DATE": "DATE", "TIME": "TIME"}
+
+
+class EmulatedRateLimitError(Exception):
+    """Quota error shaped like google.api_core.exceptions.TooManyRequests (code 429, rateLimitExceeded)."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.code = 429
+        self.errors = [{"reason": "rateLimitExceeded", "message": message}]
+
+
+class SchemaField:
+    def __init__(self, name: str, field_type: str):
+        self.name = name
+        self.field_type = field_type
+
+    def __repr__(self):
+        return f"SchemaField({self.name!r}, {self.field_type!r})"
+
+
+class EmulatedTable:
+    def __init__(self, table_id: str, schema: list, num_rows: int, num_bytes: int):
+        self.table_id = table_id
+        self.schema = schema
+        self.num_rows = num_rows
+        self.num_bytes = num_bytes
+
+
+class Row(dict):
+    """Result row, readable as row["column"] and row.column like bigquery.Row."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class EmulatedRowIterator:
+    """Query result with the RowIterator methods the pipeline uses."""
+
+    def __init__(self, table: pa.Table, page_size: int = 10_000, job_id: str | None = None):
+        self.table = table
+        self.page_size = page_size
+        self.job_id = job_id
+        self.total_rows = table.num_rows
+
+    def to_arrow(self, create_bqstorage_client: bool = True, **kwargs) -> pa.Table:
+        return self.table
+
+    def to_arrow_iterable(self, bqstorage_client=None, **kwargs):
+        """One record batch per page of page_size rows."""
+        return iter(self.table.to_batches(max_chunksize=self.page_size))
+
+    def to_dataframe(self, **kwargs):
+        return self.table.to_pandas()
+
+    def __iter__(self):
+        return (Row(row) for row in self.table.to_pylist())
+
+
+class SessionInfo:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+
+
+class EmulatedQueryJob:
+    """
+    Finished-on-submit query job: the statement runs when the job is created, result() waits until
+    the simulated latency has passed, so jobs submitted from several threads overlap like real jobs.
+    """
+
+    def __init__(self, query: str, job_id: str, statement_type: str | None = None, parent_job_id: str | None = None):
+        self.query = query
+        self.job_id = job_id
+        self.statement_type = statement_type
+        self.parent_job_id = parent_job_id
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+        self.started = self.created
+        self.ended = self.created
+        self.ready_at = time.monotonic()
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.cache_hit = False
+        self.session_info = None
+        self.table = pa.table({})
+        self.children = []
+        self.error = None
+
+    def result(self, page_size: int | None = None, **kwargs) -> EmulatedRowIterator:
+        wait = self.ready_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if self.error is not None:
+            raise self.error
+        return EmulatedRowIterator(self.table, page_size or 10_000, self.job_id)
+
+    def done(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+
+class EmulatedBigQueryClient:
+    """
+    DuckDB-backed stand-in for bigquery.Client: query (array/scalar parameters, dry runs, sessions,
+    multi-statement scripts with child jobs), get_table, list_jobs(parent_job=...).
+    Tables are loaded from <mimic4_path>/{hosp,icu}/<table>.csv.gz and addressed as `any.any.<table>`.
+    """
+
+    def __init__(self,
+                 mimic4_path: str,
+                 project: str = "emulated",
+                 latency_seconds: float = 0.0,
+                 seconds_per_gib: float = 0.0,
+                 max_queries_per_second: float | None = None,
+                 max_concurrent_jobs: int | None = None,
+                 use_result_cache: bool = True,
+                 page_size: int = 10_000,
+                 tables: list | None = None):
+        """
+        :param mimic4_path: MIMIC-IV demo folder with hosp and icu subfolders.
+        :param project: Project name reported by the client.
+        :param latency_seconds: Fixed latency of every job (submission to result).
+        :param seconds_per_gib: Extra latency per GiB scanned.
+        :param max_queries_per_second: Queries submitted faster fail with EmulatedRateLimitError, None for no limit.
+        :param max_concurrent_jobs: Queries submitted while this many jobs run fail with EmulatedRateLimitError.
+        :param use_result_cache: Emulate the BigQuery 24h result cache (repeated queries are free, cache_hit True).
+        :param page_size: Rows per page of to_arrow_iterable.
+        :param tables: Tables to load, default every MIMIC table found.
+        """
+        self.project = project
+        self.latency_seconds = latency_seconds
+        self.seconds_per_gib = seconds_per_gib
+        self.max_queries_per_second = max_queries_per_second
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.use_result_cache = use_result_cache
+        self.page_size = page_size
+        self.db = duckdb.connect()
+        self.table_bytes = {}
+        self.jobs = {}
+        self.sessions = {}
+        self._session_jobs = {}
+        self.rate_limited = 0
+        self._results = {}
+        self._submitted = []
+        self._job_numbers = itertools.count()
+        self._lock = threading.Lock()
+        self._load_tables(mimic4_path, tables)
+
+    def _load_tables(self, mimic4_path: str, tables: list | None):
+        for module, names in MIMIC_TABLES.items():
+            for name in names:
+                path = join(mimic4_path, module, f"{name}.csv.gz")
+                if (tables is not None and name not in tables) or not exists(path):
+                    continue
+                self.db.execute(f"CREATE TABLE {name} AS SELECT * FROM read_csv_auto('{path}')")
+                self.table_bytes[name] = self.db.execute(f"SELECT * FROM {name}").to_arrow_table().nbytes
+
+    def get_table(self, table_ref) -> EmulatedTable:
+        """Schema and size of a loaded table, table_ref is project.dataset.table (or a TableReference)."""
+        name = str(table_ref).split(".")[-1]
+        if name not in self.table_bytes:
+            raise KeyError(f"Not found: Table {table_ref}")
+        cursor = self.db.cursor()
+        columns = cursor.execute(f"DESCRIBE {name}").fetchall()
+        schema = [SchemaField(column, BIGQUERY_TYPES.get(column_type.split("(")[0], column_type))
+                  for column, column_type, *_ in columns]
+        num_rows = cursor.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        return EmulatedTable(str(table_ref), schema, num_rows, self.table_bytes[name])
+
+    def list_jobs(self, parent_job=None, **kwargs) -> list:
+        """Child jobs of a script (newest first, as the BigQuery API), or all jobs."""
+        if parent_job is None:
+            return list(reversed(self.jobs.values()))
+        parent_id = getattr(parent_job, "job_id", parent_job)
+        return list(reversed(self.jobs[parent_id].children))
+
+    def query(self, query: str, job_config=None, **kwargs) -> EmulatedQueryJob:
+        """
+        Run a query or script. Parameters, dry_run, use_query_cache, create_session and
+        session_id connection properties of job_config are honoured, other settings are ignored.
+        """
+        job = EmulatedQueryJob(query, self._new_job_id())
+        parameters = {p.name: p for p in getattr(job_config, "query_parameters", None) or []}
+        scanned = self.estimate_bytes(query)
+
+        if getattr(job_config, "dry_run", False):
+            job.total_bytes_processed = scanned
+            return job
+
+        self._admit(job)
+        connection, lock = self._connection(job_config, job)
+        statements = split_statements(query)
+        cache_key = json.dumps([query, {name: _parameter_value(p) for name, p in parameters.items()}],
+                               default=str)
+        # As in BigQuery, session queries (temp tables) and scripts are not served from the result cache
+        use_cache = (self.use_result_cache and getattr(job_config, "use_query_cache", True) is not False
+                     and job.session_info is None and not getattr(job_config, "connection_properties", None)
+                     and len(statements) == 1 and statements[0].lstrip().upper().startswith(("SELECT", "WITH")))
+
+        started = time.perf_counter()
+        with self._lock:
+            cached = self._results.get(cache_key) if use_cache else None
+        if cached is not None:
+            job.table, job.cache_hit, scanned = cached, True, 0
+        else:
+            try:
+                with lock:
+                    for statement in statements:
+                        child = self._run_statement(connection, statement, parameters, job)
+                        job.table = child.table
+                        if len(statements) > 1:
+                            job.children.append(child)
+            except duckdb.Error as e:
+                job.error = ValueError(f"Emulated query failed: {e}\n{query[:500]}")
+            # A table may have changed, cached results are invalidated
+            if any(_statement_type(statement) != "SELECT" for statement in statements):
+                with self._lock:
+                    self._results.clear()
+            if use_cache and job.error is None:
+                with self._lock:
+                    self._results[cache_key] = job.table
+
+        job.statement_type = "SCRIPT" if len(statements) > 1 else _statement_type(statements[0])
+        job.total_bytes_processed = scanned
+        job.total_bytes_billed = scanned
+        elapsed = self.latency_seconds + self.seconds_per_gib * scanned / 1024 ** 3
+        job.slot_millis = int((time.perf_counter() - started) * 1000)
+        job.ended = job.started + datetime.timedelta(seconds=elapsed + time.perf_counter() - started)
+        job.ready_at = time.monotonic() + elapsed
+        for i, child in enumerate(job.children):
+            child.started, child.ended, child.ready_at = job.started, job.ended, job.ready_at
+            child.created = job.created + datetime.timedelta(microseconds=i + 1)
+        return job
+
+    def estimate_bytes(self, query: str) -> int:
+        """Bytes of the loaded tables a query reads (whole tables, BigQuery would only count read columns)."""
+        referenced = {name.split(".")[-1] for name in re.findall(r"`([^`]+)`", query)}
+        return sum(self.table_bytes.get(name, 0) for name in referenced)
+
+    def _new_job_id(self) -> str:
+        return f"emulated_job_{next(self._job_numbers)}_{uuid.uuid4().hex[:8]}"
+
+    def _admit(self, job: EmulatedQueryJob):
+        """Simulate the queries/second and concurrent jobs quotas."""
+        now = time.monotonic()
+        with self._lock:
+            self._submitted = [t for t in self._submitted if now - t < 1.0]
+            running = sum(1 for j in self.jobs.values() if not j.done() and j.parent_job_id is None)
+            if self.max_queries_per_second is not None and len(self._submitted) >= self.max_queries_per_second:
+                self.rate_limited += 1
+                raise EmulatedRateLimitError("Exceeded rate limits: too many queries per second (rateLimitExceeded)")
+            if self.max_concurrent_jobs is not None and running >= self.max_concurrent_jobs:
+                self.rate_limited += 1
+                raise EmulatedRateLimitError("Exceeded rate limits: too many concurrent queries (rateLimitExceeded)")
+            self._submitted.append(now)
+            self.jobs[job.job_id] = job
+
+    def _connection(self, job_config, job: EmulatedQueryJob) -> tuple:
+        """DuckDB connection of the job: a session connection (temp tables persist) or a new cursor."""
+        session_id = None
+        for prop in getattr(job_config, "connection_properties", None) or []:
+            if prop.key == "session_id":
+                session_id = prop.value
+        if getattr(job_config, "create_session", False):
+            session_id = uuid.uuid4().hex
+            with self._lock:
+                self.sessions[session_id] = (self.db.cursor(), threading.Lock())
+            job.session_info = SessionInfo(session_id)
+        if session_id is not None:
+            if session_id not in self.sessions:
+                raise ValueError(f"Session {session_id} not found")
+            with self._lock:
+                # As in BigQuery, a session runs one query at a time
+                running = self._session_jobs.get(session_id)
+                if running is not None and not running.done():
+                    raise ValueError(f"Session {session_id} is already running query {running.job_id}")
+                job.ready_at = float("inf")
+                self._session_jobs[session_id] = job
+            return self.sessions[session_id]
+        # A script gets its own connection, its temp tables vanish with it
+        return self.db.cursor(), threading.Lock()
+
+    def _run_statement(self, connection, statement: str, parameters: dict, parent: EmulatedQueryJob):
+        sql, values = translate_sql(statement, parameters)
+        child = EmulatedQueryJob(statement, f"{parent.job_id}_{len(parent.children)}",
+                                 _statement_type(statement), parent.job_id)
+        result = connection.execute(sql, values)
+        child.table = _unique_column_names(result.to_arrow_table()) if result.description else pa.table({})
+        child.total_bytes_processed = self.estimate_bytes(statement)
+        child.total_bytes_billed = child.total_bytes_processed
+        return child
+
+
+def _unique_column_names(table: pa.Table) -> pa.Table:
+    """Rename repeated result columns x, x to x, x_1 as BigQuery does."""
+    names, seen = [], {}
+    for name in table.column_names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(name if count == 0 else f"{name}_{count}")
+    return table.rename_columns(names)
+
+
+def _statement_type(statement: str) -> str:
+    words = re.sub(r"--[^\n]*", " ", statement).split()
+    if not words:
+        return "SCRIPT"
+    if words[0].upper() == "WITH":
+        return "SELECT"
+    if words[0].upper() == "CREATE":
+        return "CREATE_TABLE_AS_SELECT"
+    return words[0].upper()
+
+
+def _parameter_value(parameter):
+    return parameter.values if hasattr(parameter, "values") else parameter.value
+
+
+def split_statements(script: str) -> list:
+    """Split a script on semicolons outside quotes and comments, dropping empty statements."""
+    statements, current, quote, i = [], [], None, 0
+    while i < len(script):
+        char = script[i]
+        if quote is None and script.startswith("--", i):
+            end = script.find("\n", i)
+            end = len(script) if end == -1 else end
+            current.append(script[i:end])
+            i = end
+            continue
+        if quote is None and char in "'\"`":
+            quote = char
+        elif quote == char and script[i - 1] != "\\":
+            quote = None
+        if char == ";" and quote is None:
+            statements.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statements.append("".join(current))
+    return [s for s in statements if re.sub(r"--[^\n]*", "", s).strip()]
+
+
+def translate_sql(query: str, parameters: dict | None = None) -> tuple[str, dict]:
+    """
+    Translate the BigQuery SQL produced by query_builder to DuckDB.
+    :param query: BigQuery statement.
+    :param parameters: Dictionary {name: ScalarQueryParameter | ArrayQueryParameter}.
+    :return: DuckDB statement, dictionary of DuckDB named parameter values.
+    """
+    parameters = parameters or {}
+    sql = re.sub(r"--[^\n]*", "", query)
+
+    # Qualified names: `project.dataset.table` -> table, INFORMATION_SCHEMA views, session temp tables
+    def table_name(match):
+        parts = match.group(1).split(".")
+        if len(parts) >= 2 and parts[-2].upper() == "INFORMATION_SCHEMA":
+            return f"information_schema.{parts[-1].lower()}"
+        return parts[-1]
+    sql = re.sub(r"`([^`]+)`", table_name, sql)
+    sql = re.sub(r"\b_SESSION\.", "", sql)
+
+    # DDL options without a DuckDB equivalent
+    sql = re.sub(r"\bCLUSTER\s+BY\s+[\w\s,]+?(?=\bOPTIONS\b|\bAS\b)", "", sql, flags=re.IGNORECASE)
+    sql = _rewrite_function(sql, "OPTIONS", lambda args: "")
+    sql = re.sub(r"\bCREATE\s+TEMP\s+TABLE\b", "CREATE OR REPLACE TEMP TABLE", sql, flags=re.IGNORECASE)
+
+    # UNNEST in FROM/JOIN: BigQuery value tables become single-column subqueries, join conditions
+    # comparing with the value table (... = hadm_id) read its column
+    sql, aliases = _rewrite_unnest(sql)
+    for alias in aliases:
+        sql = re.sub(rf"=\s*{alias}\b(?!\.)", f"= _unnest_{alias}.{alias}", sql)
+    sql = re.sub(r"\bIN\s+UNNEST\(", "IN (SELECT UNNEST(", sql, flags=re.IGNORECASE)
+    sql = _close_in_unnest(sql)
+
+    # Functions
+    sql = _rewrite_function(sql, "TIMESTAMP_DIFF",
+                            lambda a: f"date_diff('{a[2].strip().lower()}', {a[1]}, {a[0]})")
+    sql = _rewrite_function(sql, "TIMESTAMP_ADD", lambda a: f"({a[0]} + {a[1]})")
+    sql = _rewrite_function(sql, "TIMESTAMP_SUB", lambda a: f"({a[0]} - {a[1]})")
+    sql = _rewrite_function(sql, "TIMESTAMP", lambda a: f"CAST({a[0]} AS TIMESTAMP)")
+    sql = _rewrite_function(sql, "DIV", lambda a: f"({a[0]} // {a[1]})")
+    sql = _rewrite_function(sql, "SAFE_DIVIDE", lambda a: f"({a[0]} / NULLIF({a[1]}, 0))")
+    sql = _rewrite_function(sql, "GENERATE_ARRAY", lambda a: f"generate_series({', '.join(a)})")
+    sql = _rewrite_function(sql, "REGEXP_CONTAINS", lambda a: f"regexp_matches({a[0]}, {a[1]})")
+    # BigQuery CONCAT, GREATEST and LEAST return NULL when an argument is NULL, DuckDB's skip NULLs
+    sql = _rewrite_function(sql, "CONCAT", lambda a: "(" + " || ".join(f"({x})" for x in a) + ")")
+    for name in ("GREATEST", "LEAST"):
+        sql = _rewrite_function(sql, name, lambda a, name=name: (
+            f"(CASE WHEN {' OR '.join(f'({x}) IS NULL' for x in a)} THEN NULL "
+            f"ELSE {name.lower()}({', '.join(a)}) END)"))
+    sql = re.sub(r"\bSAFE_CAST\(", "TRY_CAST(", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bAS\s+(INT64|FLOAT64|STRING|BOOL|NUMERIC|DATETIME)\b",
+                 lambda m: f"AS {DUCKDB_TYPES[m.group(1).upper()]}", sql)
+
+    # Parameters: arrays are cast so empty lists keep their element type
+    values = {}
+    for name, parameter in parameters.items():
+        if not re.search(rf"@{name}\b", sql):
+            continue
+        if hasattr(parameter, "values"):
+            element = DUCKDB_TYPES.get(parameter.array_type, "VARCHAR")
+            sql = re.sub(rf"@{name}\b", f"CAST(${name} AS {element}[])", sql)
+            values[name] = list(parameter.values)
+        else:
+            sql = re.sub(rf"@{name}\b", f"${name}", sql)
+            values[name] = parameter.value
+    return sql, values
+
+
+def _split_arguments(text: str) -> list:
+    """Split function arguments on top-level commas."""
+    args, depth, current, quote = [], 0, [], None
+    for char in text:
+        if quote is None and char in "'\"":
+            quote = char
+        elif quote == char:
+            quote = None
+        elif quote is None and char == "(":
+            depth += 1
+        elif quote is None and char == ")":
+            depth -= 1
+        if char == "," and depth == 0 and quote is None:
+            args.append("".join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    args.append("".join(current).strip())
+    return args
+
+
+def _matching_paren(sql: str, open_index: int) -> int:
+    depth, quote = 0, None
+    for i in range(open_index, len(sql)):
+        char = sql[i]
+        if quote is None and char in "'\"":
+            quote = char
+        elif quote == char:
+            quote = None
+        elif quote is None and char == "(":
+            depth += 1
+        elif quote is None and char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError(f"Unbalanced parentheses in: {sql[open_index:open_index + 200]}")
+
+
+def _rewrite_function(sql: str, name: str, rewrite) -> str:
+    """Replace every NAME(args) call (innermost arguments first) with rewrite(list of argument strings)."""
+    pattern = re.compile(rf"(?<![\w.]){name}\s*\(", re.IGNORECASE)
+    position = 0
+    while True:
+        match = pattern.search(sql, position)
+        if match is None:
+            return sql
+        close = _matching_paren(sql, match.end() - 1)
+        inner = _rewrite_function(sql[match.end():close], name, rewrite)
+        replacement = rewrite(_split_arguments(inner))
+        sql = sql[:match.start()] + replacement + sql[close + 1:]
+        position = match.start() + len(replacement)
+
+
+def _rewrite_unnest(sql: str) -> tuple[str, list]:
+    """FROM/JOIN UNNEST(array) AS alias -> (SELECT UNNEST(array) AS alias) AS _unnest_alias, lateral for joins."""
+    pattern = re.compile(r"\b(FROM|JOIN)\s+UNNEST\(", re.IGNORECASE)
+    alias_pattern = re.compile(r"\)\s+AS\s+(\w+)", re.IGNORECASE)
+    aliases, position = [], 0
+    while True:
+        match = pattern.search(sql, position)
+        if match is None:
+            return sql, aliases
+        close = _matching_paren(sql, match.end() - 1)
+        alias = alias_pattern.match(sql, close)
+        if alias is None:
+            position = match.end()
+            continue
+        keyword, name = match.group(1), alias.group(1)
+        lateral = "" if keyword.upper() == "FROM" else "LATERAL "
+        replacement = f"{keyword} {lateral}(SELECT UNNEST({sql[match.end():close]}) AS {name}) AS _unnest_{name}"
+        sql = sql[:match.start()] + replacement + sql[alias.end():]
+        aliases.append(name)
+        position = match.start() + len(replacement)
+
+
+def _close_in_unnest(sql: str) -> str:
+    """Add the parenthesis closing the subquery opened by the IN UNNEST rewrite."""
+    marker = "IN (SELECT UNNEST("
+    position = 0
+    while True:
+        start = sql.find(marker, position)
+        if start == -1:
+            return sql
+        close = _matching_paren(sql, start + len(marker) - 1)
+        sql = sql[:close + 1] + ")" + sql[close + 1:]
+        position = close + 2
@@ -1,51 +1,424 @@
 from typing import List, Set
+import hashlib
+import json
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 import pandas as pd
-from ratelimiter import RateLimiter
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.api_core import exceptions as google_exceptions
 from google.cloud import bigquery  #, storage
 import query_builder
-from data_utils import split_admissions_by_id_list
+from data_utils import split_admissions_by_id_list, adjust_cohort_admittimes
+from long_format_utils import StreamingLongFormatBuilder
+from rate_limiter import AdaptiveRateLimiter
+from query_cache import QueryResultCache, CachedQueryResult, is_cacheable_query
+from query_stats import QueryStatsLog, QueryBudgetExceeded
+from config.project_config import (bigquery_rate_limits, bigquery_compact_dtypes, bigquery_query_cache,
+                                   bigquery_query_budget, mimic_iv_data_sources)
 
 
 # pip install google-cloud-bigquery, google-cloud-storage
+# pip install google-cloud-bigquery-storage (optional, Arrow downloads via the Storage Read API)
 # Python IS case-sensitive, BQ isn't case-sensitive in column names...
 
+# Tables read by extract_admissions_data_bq, prefetched in one INFORMATION_SCHEMA query
+EXTRACTION_TABLES = ["patients", "admissions", "icustays", "chartevents", "d_items", "labevents", "d_labitems",
+                     "prescriptions", "emar", "inputevents", "procedures_icd", "d_icd_procedures",
+                     "procedureevents", "diagnoses_icd", "d_icd_diagnoses", "transfers"]
+SCHEMA_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Smaller cohorts are sent as the @hadm_ids array, a cohort table costs an extra (session) job
+COHORT_TABLE_MIN_SIZE = 1000
+
+# (project_id, dataset_id, table_name) -> column names, shared by all clients of the process
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+# Set to False after the Storage Read API is refused, later downloads go straight to REST
+_bqstorage_enabled = True
+
+# Shared by all threads, separate buckets keep metadata calls from queueing behind queries
+bq_rate_limiter = AdaptiveRateLimiter(bigquery_rate_limits)
+
+# Results of repeated SELECT queries are read from disk instead of re-running (and re-billing) them
+bq_query_cache = QueryResultCache(**bigquery_query_cache)
+
+# Bytes processed/billed, slot-ms, cache hits and rows of every query, see get_query_stats
+bq_query_stats = QueryStatsLog(bigquery_query_budget["stats_log_path"])
+
 
 def get_bq_client(project_id: str):
     """Create or reuse a BigQuery client."""
     return bigquery.Client(project=project_id)
 
 
-@RateLimiter(max_calls=1, period=5)
-def execute_query(client, query, job_config=None, log=True):
+def execute_query(client, query, job_config=None, log=True, use_cache=True,
+                  max_bytes_scanned: int | None = bigquery_query_budget["max_bytes_scanned"]):
+    """
+    Run a query. SELECT queries are looked up in the on-disk result cache first (keyed by
+    normalized SQL, parameters and dataset version), misses are downloaded once and stored.
+    Every query is recorded in bq_query_stats.
+    :param client: a BigQuery client
+    :param query: sql query
+    :param job_config: query job configuration (parameters)
+    :param log: Print a query preview.
+    :param use_cache: False bypasses the result cache (neither read nor written).
+    :param max_bytes_scanned: Refuse the query (QueryBudgetExceeded) if its dry-run estimate is larger, None to skip the dry run.
+    :return: CachedQueryResult for cacheable queries, else the BigQuery RowIterator.
+    """
+    cacheable = use_cache and bq_query_cache.enabled and is_cacheable_query(query)
+    if cacheable:
+        key = bq_query_cache.key(query, job_config)
+        table = bq_query_cache.get(key)
+        if table is not None:
+            if log:
+                print(f"Cache hit {key[:12]}: {table.num_rows} rows")
+            bq_query_stats.record(query, "local_cache", rows=table.num_rows)
+            return CachedQueryResult(table, cache_hit=True)
+
+    check_query_budget(client, query, job_config, max_bytes_scanned)
+
+    result = _run_query(client, query, job_config, log)
+    if cacheable:
+        table = download_arrow(result)
+        bq_query_cache.put(key, table)
+        return CachedQueryResult(table, cache_hit=False)
+    return result
+
+
+@bq_rate_limiter.limit("query")
+def _run_query(client, query, job_config=None, log=True):
     try:
         if log:
             print(f"Running query:\n{query[:200]}...")  # preview only
         job = client.query(query, job_config=job_config)
         result = job.result()
-        print(f"Query finished in {job.ended - job.started}")
+        elapsed = job.ended - job.started
+        print(f"Query finished in {elapsed}, processed {(job.total_bytes_processed or 0) / 1024 ** 2:.1f} MiB"
+              f"{' (cached)' if job.cache_hit else ''}")
+        bq_query_stats.record(query, "bigquery", job=job, rows=result.total_rows,
+                              elapsed_seconds=elapsed.total_seconds())
         return result
     except Exception as e:
         print(f"Query failed: {e}")
         raise
 
 
+@bq_rate_limiter.limit("query")
+def _run_script(client, script, job_config=None):
+    """Run a multi-statement script and return the finished parent job (results are in its child jobs)."""
+    print(f"Running script of {script.count(';')} statements")
+    job = client.query(script, job_config=job_config)
+    job.result()
+    elapsed = job.ended - job.started
+    print(f"Script finished in {elapsed}, processed {(job.total_bytes_processed or 0) / 1024 ** 2:.1f} MiB")
+    bq_query_stats.record(script, "bigquery", job=job, elapsed_seconds=elapsed.total_seconds())
+    return job
+
+
+def check_query_budget(client: bigquery.Client, query: str, job_config=None,
+                       max_bytes_scanned: int | None = bigquery_query_budget["max_bytes_scanned"]):
+    """
+    Raise QueryBudgetExceeded if the dry-run estimate of a query is above max_bytes_scanned.
+    :param client: a BigQuery client
+    :param query: sql query or script
+    :param job_config: query job configuration (parameters, session)
+    :param max_bytes_scanned: Budget in bytes, None to skip the dry run.
+    """
+    if max_bytes_scanned is None:
+        return
+    estimated_bytes = estimate_query_bytes(client, query, job_config)
+    if estimated_bytes > max_bytes_scanned:
+        raise QueryBudgetExceeded(f"Query would scan {estimated_bytes / 1024 ** 2:.1f} MiB, "
+                                  f"budget is {max_bytes_scanned / 1024 ** 2:.1f} MiB:\n{query[:200]}...")
+
+
+def estimate_query_bytes(client: bigquery.Client, query: str, job_config=None) -> int:
+    """
+    Dry-run a query: BigQuery validates it and returns the bytes it would scan, without running or billing it.
+    :param client: a BigQuery client
+    :param query: sql query
+    :param job_config: query job configuration (parameters, session)
+    :return: Estimated bytes processed.
+    """
+    dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    if job_config is not None:
+        dry_run_config.query_parameters = job_config.query_parameters
+        dry_run_config.connection_properties = job_config.connection_properties
+    job = bq_rate_limiter.call("metadata", client.query, query, job_config=dry_run_config)
+    bq_query_stats.record(query, "dry_run", estimated_bytes=job.total_bytes_processed)
+    return job.total_bytes_processed
+
+
+def get_query_stats() -> pd.DataFrame:
+    """
+    Statistics of the queries run in this process.
+    :return: DataFrame with one row per query (see query_stats.QUERY_STATS_COLUMNS).
+    """
+    return bq_query_stats.to_dataframe()
+
+
+def query_to_dataframe(client: bigquery.Client,
+                       query: str,
+                       job_config=None,
+                       dtypes: dict = bigquery_compact_dtypes,
+                       use_cache: bool = True) -> pd.DataFrame:
+    """
+    Run a query and convert the Arrow result to pandas with compact dtypes.
+    :param client: a BigQuery client
+    :param query: sql query
+    :param job_config: query job configuration (parameters)
+    :param dtypes: Dictionary {column: "int32" | "float32" | "category" | ...}.
+    :param use_cache: False bypasses the result cache.
+    :return: DataFrame with the query result.
+    """
+    rows = execute_query(client, query, job_config, use_cache=use_cache)
+    return arrow_to_compact_dataframe(download_arrow(rows), dtypes)
+
+
+def iter_query_batches(client: bigquery.Client,
+                       query: str,
+                       job_config=None,
+                       dtypes: dict = bigquery_compact_dtypes,
+                       max_queue_batches: int = 4,
+                       bqstorage_client=None):
+    """
+    Stream a query result as compact DataFrames, one per result page (REST) or Arrow record batch
+    (Storage Read API), instead of downloading the whole result first. A background thread downloads
+    and converts the next batches into a bounded queue while the caller processes the current one,
+    so at most max_queue_batches + 1 batches are held in memory.
+    A result in the local cache is streamed from it, misses are not written to the cache.
+    :param client: a BigQuery client
+    :param query: sql query
+    :param job_config: query job configuration (parameters)
+    :param dtypes: Dictionary {column: "int32" | "float32" | "category" | ...}.
+    :param max_queue_batches: Batches downloaded ahead of the consumer.
+    :param bqstorage_client: Optional BigQueryReadClient, None downloads pages over REST.
+    :return: Generator of DataFrames.
+    """
+    table = None
+    if bq_query_cache.enabled and is_cacheable_query(query):
+        table = bq_query_cache.get(bq_query_cache.key(query, job_config))
+    if table is not None:
+        bq_query_stats.record(query, "local_cache", rows=table.num_rows)
+        rows = CachedQueryResult(table, cache_hit=True)
+    else:
+        rows = execute_query(client, query, job_config, use_cache=False)
+
+    batches = queue.Queue(maxsize=max(1, max_queue_batches))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer stopped reading, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+                if stop.is_set():
+                    return
+                put(arrow_to_compact_dataframe(pa.Table.from_batches([batch]), dtypes))
+        except Exception as e:
+            put(e)
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def download_arrow(rows) -> pa.Table:
+    """
+    Download a query result as Arrow record batches through the Storage Read API.
+    Falls back to the REST download when google-cloud-bigquery-storage is not installed
+    or the API is not enabled for the project.
+    :param rows: BigQuery RowIterator (or CachedQueryResult).
+    :return: Arrow table.
+    """
+    global _bqstorage_enabled
+    if _bqstorage_enabled:
+        try:
+            return rows.to_arrow(create_bqstorage_client=True)
+        except (ImportError, ValueError, google_exceptions.GoogleAPICallError) as e:
+            print(f"Storage Read API unavailable, using REST download: {e}")
+            _bqstorage_enabled = False
+    return rows.to_arrow(create_bqstorage_client=False)
+
+
+def arrow_to_compact_dataframe(table: pa.Table, dtypes: dict = bigquery_compact_dtypes) -> pd.DataFrame:
+    """
+    Convert an Arrow table to pandas, casting columns in Arrow first so pandas receives
+    int32/float32 buffers and dictionary-encoded strings (pandas category) instead of
+    int64/float64 and object columns.
+    :param table: Arrow table.
+    :param dtypes: Dictionary {column: "int32" | "float32" | "category" | ...}.
+    :return: DataFrame.
+    """
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        dtype = dtypes.get(name)
+        if dtype == "category":
+            if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+                column = pc.dictionary_encode(column)
+        elif dtype is not None:
+            target = pa.type_for_alias(dtype)
+            numeric = pa.types.is_integer(column.type) or pa.types.is_floating(column.type)
+            # Integer columns with NULLs would come back as float64 anyway
+            nullable_int = pa.types.is_integer(target) and column.null_count > 0
+            if numeric and column.type != target and not nullable_int:
+                column = column.cast(target, safe=pa.types.is_integer(target))
+        columns.append(column)
+    table = pa.Table.from_arrays(columns, names=table.column_names)
+    return table.to_pandas(split_blocks=True, self_destruct=True, coerce_temporal_nanoseconds=True)
+
+
 def get_valid_columns(client: bigquery.Client,
                       project_id: str,
                       dataset_id: str,
                       table_name: str,
+                      cache_path: str | None = None,
+                      ttl_seconds: float = SCHEMA_CACHE_TTL_SECONDS,
                       ) -> Set[str]:
     """Return available column names for a target table.
+    Schemas are memoized per (project, dataset, table) for the lifetime of the process,
+    and optionally kept in a JSON file so later runs skip the metadata call.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
-    :param table_name: BigQuery target table"""
+    :param table_name: BigQuery target table
+    :param cache_path: Optional JSON file with cached schemas.
+    :param ttl_seconds: Max age of a schema read from cache_path."""
+
+    key = (project_id, dataset_id, table_name)
+    with _schema_cache_lock:
+        if key in _schema_cache:
+            return set(_schema_cache[key])
+
+    if cache_path is not None:
+        cached = _read_schema_cache_file(cache_path, ttl_seconds)
+        if key in cached:
+            with _schema_cache_lock:
+                _schema_cache[key] = cached[key]
+            return set(cached[key])
+
+    table = bq_rate_limiter.call("metadata", client.get_table, f"{project_id}.{dataset_id}.{table_name}")
+    columns = frozenset(field.name for field in table.schema)
+    with _schema_cache_lock:
+        _schema_cache[key] = columns
+    if cache_path is not None:
+        _write_schema_cache_file(cache_path, {key: columns})
+    return set(columns)
+
+
+def prefetch_schemas(client: bigquery.Client,
+                     project_id: str,
+                     dataset_id: str,
+                     table_names: List[str] = EXTRACTION_TABLES,
+                     cache_path: str | None = None,
+                     ttl_seconds: float = SCHEMA_CACHE_TTL_SECONDS) -> dict:
+    """
+    Fill the schema cache for several tables with a single INFORMATION_SCHEMA.COLUMNS query
+    instead of one get_table call per table. Tables already cached are not queried.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param table_names: Tables to prefetch.
+    :param cache_path: Optional JSON file with cached schemas.
+    :param ttl_seconds: Max age of a schema read from cache_path.
+    :return: Dictionary {table_name: set of column names} for the found tables.
+    """
+    cached = _read_schema_cache_file(cache_path, ttl_seconds) if cache_path is not None else {}
+    with _schema_cache_lock:
+        for key, columns in cached.items():
+            _schema_cache.setdefault(key, columns)
+        missing = [t for t in table_names if (project_id, dataset_id, t) not in _schema_cache]
 
-    table = client.get_table(f"{project_id}.{dataset_id}.{table_name}")
-    return {field.name for field in table.schema}
+    if missing:
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("table_names", "STRING", missing)]
+        )
+        # Schemas expire after ttl_seconds, not after the longer result cache TTL
+        rows = execute_query(client, query_builder.build_schema_query(project_id, dataset_id), job_config,
+                             use_cache=False)
+        fetched = {}
+        for row in rows:
+            fetched.setdefault((project_id, dataset_id, row["table_name"]), set()).add(row["column_name"])
+        fetched = {key: frozenset(columns) for key, columns in fetched.items()}
+        with _schema_cache_lock:
+            _schema_cache.update(fetched)
+        if cache_path is not None and fetched:
+            _write_schema_cache_file(cache_path, fetched)
+
+    with _schema_cache_lock:
+        return {t: set(_schema_cache[(project_id, dataset_id, t)]) for t in table_names
+                if (project_id, dataset_id, t) in _schema_cache}
+
+
+def clear_schema_cache():
+    """Forget memoized schemas, e.g. after a table was altered."""
+    with _schema_cache_lock:
+        _schema_cache.clear()
+
+
+def _read_schema_cache_file(cache_path: str, ttl_seconds: float) -> dict:
+    """Read non-expired schemas from the JSON cache file."""
+    if not Path(cache_path).exists():
+        return {}
+    try:
+        with open(cache_path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {tuple(name.rsplit(".", 2)): frozenset(entry["columns"]) for name, entry in entries.items()
+            if now - entry["cached_at"] <= ttl_seconds}
+
+
+def _write_schema_cache_file(cache_path: str, schemas: dict):
+    """Merge schemas into the JSON cache file."""
+    with _schema_cache_lock:
+        entries = {}
+        if Path(cache_path).exists():
+            try:
+                with open(cache_path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+        now = time.time()
+        for key, columns in schemas.items():
+            entries[".".join(key)] = {"columns": sorted(columns), "cached_at": now}
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(entries, f)
 
 
 def set_hadm_ids_config(hadm_ids: List[str]):
     """Create ArraQueryParemeter for hadm_ids list."""
+    if isinstance(hadm_ids, int):
+        hadm_ids = [hadm_ids]
+    # Sorted ids give the same parameters, and so the same result cache key, for the same cohort
+    if hadm_ids is not None:
+        hadm_ids = sorted(hadm_ids)
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ArrayQueryParameter("hadm_ids", "INT64", hadm_ids)
@@ -54,78 +427,390 @@ def set_hadm_ids_config(hadm_ids: List[str]):
     return job_config
 
 
+def materialize_cohort_table(client: bigquery.Client,
+                             hadm_ids: list | None,
+                             destination: str | None = None,
+                             expiration_hours: int | None = 24,
+                             hadm_ids_query: str | None = None,
+                             query_parameters: list | None = None) -> dict:
+    """
+    Send the hadm_id list once and keep it server-side as a table clustered by hadm_id,
+    so the extraction queries join it instead of each carrying the @hadm_ids array.
+    Without destination the table is a temp table of a new BigQuery session, only visible
+    to queries running in that session (see cohort_query_config).
+    With hadm_ids_query (e.g. a compiled cohort definition) the admissions are selected server-side
+    instead of uploaded, and the resulting hadm_ids are read back.
+    :param client: a BigQuery client
+    :param hadm_ids: list of hadm_ids, unused with hadm_ids_query.
+    :param destination: project.dataset.table for a regular table (e.g. in a scratch dataset), None for a session temp table.
+    :param expiration_hours: Expiration of a regular table, None keeps it.
+    :param hadm_ids_query: Query returning the hadm_id column to materialize.
+    :param query_parameters: Query parameters of hadm_ids_query.
+    :return: Cohort dictionary with table, session_id, hadm_ids and fingerprint (hash of the sorted hadm_ids).
+    """
+    if hadm_ids_query is None:
+        job_config = set_hadm_ids_config(hadm_ids)
+    else:
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    if destination is None:
+        job_config.create_session = True
+        query = query_builder.build_cohort_table_query("cohort_hadm_ids", temporary=True,
+                                                       hadm_ids_query=hadm_ids_query)
+        table = "_SESSION.cohort_hadm_ids"
+    else:
+        query = query_builder.build_cohort_table_query(destination, temporary=False, expiration_hours=expiration_hours,
+                                                       hadm_ids_query=hadm_ids_query)
+        table = destination
+
+    job = bq_rate_limiter.call("query", client.query, query, job_config=job_config)
+    job.result()
+    session_id = job.session_info.session_id if destination is None else None
+    if hadm_ids_query is not None:
+        read_config = bigquery.QueryJobConfig()
+        if session_id is not None:
+            read_config.connection_properties = [bigquery.ConnectionProperty("session_id", session_id)]
+        # The table content is not part of the query text, so the result cache is bypassed
+        hadm_ids = execute_query(client, f"SELECT hadm_id FROM `{table}`", read_config,
+                                 use_cache=False).to_dataframe()["hadm_id"].tolist()
+    hadm_ids = sorted(set([hadm_ids] if isinstance(hadm_ids, int) else hadm_ids))
+    fingerprint = hashlib.sha256(",".join(map(str, hadm_ids)).encode()).hexdigest()
+    print(f"Materialized cohort of {len(hadm_ids)} admissions in {table}")
+    return {"table": table, "session_id": session_id, "hadm_ids": hadm_ids, "fingerprint": fingerprint}
+
+
+def cohort_query_config(hadm_ids: list, cohort: dict | None = None) -> tuple:
+    """
+    Job configuration and cohort table for a cohort query.
+    :param hadm_ids: list of hadm_ids, used when cohort is None.
+    :param cohort: Materialized cohort from materialize_cohort_table.
+    :return: QueryJobConfig, cohort table name (None when the @hadm_ids parameter is used).
+    """
+    if cohort is None:
+        return set_hadm_ids_config(hadm_ids), None
+    # The fingerprint label keeps result cache keys distinct for different cohorts in the same table
+    job_config = bigquery.QueryJobConfig(labels={"cohort": cohort["fingerprint"][:63]})
+    if cohort["session_id"] is not None:
+        job_config.connection_properties = [bigquery.ConnectionProperty("session_id", cohort["session_id"])]
+    return job_config, cohort["table"]
+
+
+def cohort_max_workers(cohort: dict | None, max_workers: int) -> int:
+    """
+    Max concurrent queries joining a cohort: a session runs one query at a time, so queries on a
+    session temp table are submitted one by one (materialize with a destination table to run them concurrently).
+    :param cohort: Materialized cohort from materialize_cohort_table, or None.
+    :param max_workers: Requested max number of queries running at once.
+    :return: max_workers, 1 for a session cohort.
+    """
+    if cohort is not None and cohort["session_id"] is not None:
+        return 1
+    return max_workers
+
+
 def extract_admissions_data_bq(client: bigquery.Client,
                                project_id: str,
                                dataset_id: str,
                                hadm_ids: int | list | None,
-                               return_as_cohort: bool) -> dict:
+                               return_as_cohort: bool,
+                               schema_cache_path: str | None = None,
+                               max_workers: int = 8,
+                               materialize_cohort: bool = True,
+                               cohort_destination: str | None = None,
+                               single_job: bool = False,
+                               cohort: dict | None = None,
+                               materialize_min_size: int = COHORT_TABLE_MIN_SIZE) -> dict:
     """
     Extract admission data from BigQuery.
+    The cohort is materialized first (for large cohorts), the admissions query then resolves hadm_ids
+    and the independent source queries are submitted together and gathered, so wall-clock time follows
+    the slowest query.
+    With single_job the whole extraction runs as one scripted job instead, see extract_admissions_data_bq_script.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: Can be int for single admission, list for multiple admissions, None for all admissions
     (returns all admissions).
     :param return_as_cohort: Return cohort data as dataframes. If False, return dictionary by admission_id key.
+    :param schema_cache_path: Optional JSON file to persist table schemas between runs.
+    :param max_workers: Max number of queries running at once, 1 runs them sequentially (always 1 with a session cohort).
+    :param materialize_cohort: Upload the hadm_ids once as a cohort table joined by the admissions and source
+    queries (all admissions are selected server-side when hadm_ids is None).
+    :param materialize_min_size: Cohorts with fewer hadm_ids use the @hadm_ids parameter instead of a cohort table.
+    :param cohort_destination: project.dataset.table for the cohort table, None for a session temp table
+    (a session runs one query at a time, a destination table keeps the source queries concurrent).
+    :param single_job: Run all source queries in one multi-statement job (max_workers and the cohort options are unused).
+    :param cohort: Cohort already materialized (materialize_cohort_table, cohort_definition.define_cohort_bq),
+    joined by the source queries instead of materializing hadm_ids again. Its hadm_ids are used when hadm_ids is None.
     :return: Dictionary with hadm_ids keys and admission dictionaries as values.
     """
+    if cohort is not None and hadm_ids is None:
+        hadm_ids = cohort["hadm_ids"]
+
+    if single_job:
+        return extract_admissions_data_bq_script(client, project_id, dataset_id, hadm_ids, return_as_cohort,
+                                                 schema_cache_path=schema_cache_path)
+
+    # One metadata query for all tables, get_valid_columns below is then served from the cache
+    prefetch_schemas(client, project_id, dataset_id, cache_path=schema_cache_path)
 
     # Get available demographics columns
     available_demographics = get_valid_columns(client, project_id, dataset_id, "patients")
 
+    if isinstance(hadm_ids, int):
+        hadm_ids = [hadm_ids]
+    if cohort is None and materialize_cohort and (hadm_ids is None or len(set(hadm_ids)) >= materialize_min_size):
+        hadm_ids_query = query_builder.build_hadm_ids_query(project_id, dataset_id) if hadm_ids is None else None
+        cohort = materialize_cohort_table(client, hadm_ids, destination=cohort_destination,
+                                          hadm_ids_query=hadm_ids_query)
+
     # Get admissions
     admissions, hadm_ids = get_admissions_bq(client,
                                              project_id,
                                              dataset_id,
                                              list(available_demographics),
-                                             hadm_ids)
-    labs, _ = get_labs_bq(client,
-                          project_id,
-                          dataset_id,
-                          hadm_ids)
-    prescriptions_medications, emar_medications, infusions_medications = (get_medications_bq(client,
-                                                                                             project_id,
-                                                                                             dataset_id,
-                                                                                             hadm_ids))
-    admissions_data = {
-        "admission": admissions,
-        "diagnoses": get_diagnoses_bq(client,
-                                      project_id,
-                                      dataset_id, hadm_ids),
-        "vitals": get_vitals_bq(client,
-                                project_id,
-                                dataset_id,
-                                hadm_ids),
-        "labs": labs,
-        "prescription_medications": prescriptions_medications,
-        "emar_medications": emar_medications,
-        "infusion_medications": infusions_medications,
-        "procedures": get_procedures_bq(client,
-                                        project_id,
-                                        dataset_id, hadm_ids),
-        "icu_procedures": get_icu_procedures_bq(client,
-                                                project_id,
-                                                dataset_id,
-                                                hadm_ids),
-        "transfers": get_transfers_bq(client,
-                                      project_id,
-                                      dataset_id,
-                                      hadm_ids)
-    }
+                                             hadm_ids,
+                                             cohort)
+
+    args = (client, project_id, dataset_id, hadm_ids, cohort)
+    tasks = {"diagnoses": (get_diagnoses_bq, args),
+             "vitals": (get_vitals_bq, args),
+             "labs": (lambda *a: get_labs_bq(*a)[0], args),
+             "prescription_medications": (get_prescriptions_bq, args),
+             "emar_medications": (get_emar_bq, args),
+             "infusion_medications": (get_infusions_bq, args),
+             "procedures": (get_procedures_bq, args),
+             "icu_procedures": (get_icu_procedures_bq, args),
+             "transfers": (get_transfers_bq, args)}
+    results, timings = run_queries_concurrently(tasks, max_workers=cohort_max_workers(cohort, max_workers))
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.1f}s")
+    print_extraction_stats()
+
+    admissions_data = {"admission": admissions, **results}
 
     if return_as_cohort:
         return admissions_data
     else:
         admissions_by_hadm_id = split_admissions_by_id_list(admissions_data,
-                                                            hadm_ids)
+                                                            admissions_data["admission"])
         return admissions_by_hadm_id
 
 
+def extract_admissions_data_bq_script(client: bigquery.Client,
+                                      project_id: str,
+                                      dataset_id: str,
+                                      hadm_ids: int | list | None,
+                                      return_as_cohort: bool,
+                                      schema_cache_path: str | None = None,
+                                      max_bytes_scanned: int | None = bigquery_query_budget["max_bytes_scanned"]) -> dict:
+    """
+    Extract admission data with one multi-statement BigQuery job instead of one job per source.
+    The script materializes the cohort and d_items (read by vitals, infusions and ICU procedures)
+    once as temp tables, then every source SELECT joins them and returns its own result set,
+    downloaded from the child jobs. Scripts are not stored in the local result cache.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: Can be int for single admission, list for multiple admissions, None for all admissions.
+    :param return_as_cohort: Return cohort data as dataframes. If False, return dictionary by admission_id key.
+    :param schema_cache_path: Optional JSON file to persist table schemas between runs.
+    :param max_bytes_scanned: Refuse the script (QueryBudgetExceeded) if its dry-run estimate is larger, None to skip.
+    :return: Same dictionary as extract_admissions_data_bq.
+    """
+    prefetch_schemas(client, project_id, dataset_id, cache_path=schema_cache_path)
+    if isinstance(hadm_ids, int):
+        hadm_ids = [hadm_ids]
+
+    cohort_table = "cohort_hadm_ids"
+    if hadm_ids is None:
+        cohort_query = query_builder.build_cohort_table_query(
+            cohort_table, hadm_ids_query=query_builder.build_hadm_ids_query(project_id, dataset_id))
+        job_config = bigquery.QueryJobConfig()
+    else:
+        cohort_query = query_builder.build_cohort_table_query(cohort_table)
+        job_config = set_hadm_ids_config(hadm_ids)
+
+    # Every source joins the cohort temp table, so the admissions query takes its cohort branch for all admissions too
+    source_ids = hadm_ids if hadm_ids is not None else []
+    demographics = list(get_valid_columns(client, project_id, dataset_id, "patients"))
+    diagnoses = get_valid_columns(client, project_id, dataset_id, "diagnoses_icd")
+    diagnoses_descriptions = get_valid_columns(client, project_id, dataset_id, "d_icd_diagnoses")
+    source_queries = {
+        "admission": query_builder.build_admissions_query(project_id, dataset_id, demographics,
+                                                          source_ids, cohort_table),
+        "diagnoses": query_builder.build_diagnoses_query(project_id, dataset_id, diagnoses, diagnoses_descriptions,
+                                                         source_ids, cohort_table)}
+    for src in mimic_iv_data_sources:
+        source_queries[src["name"]] = build_source_events_query(client, project_id, dataset_id, src["name"],
+                                                                source_ids, cohort_table)
+    script = query_builder.build_extraction_script(cohort_query, source_queries,
+                                                   {f"{project_id}.{dataset_id}.d_items": "shared_d_items"})
+
+    check_query_budget(client, script, job_config, max_bytes_scanned)
+    job = _run_script(client, script, job_config)
+
+    # One child job per statement, the SELECT ones are the result sets in source_queries order
+    children = bq_rate_limiter.call("metadata", lambda: list(client.list_jobs(parent_job=job.job_id)))
+    selects = [child for child in sorted(children, key=lambda child: child.created)
+               if child.statement_type == "SELECT"]
+    if len(selects) != len(source_queries):
+        raise RuntimeError(f"Expected {len(source_queries)} result sets, the script returned {len(selects)}")
+
+    admissions_data = {}
+    for name, child in zip(source_queries, selects):
+        admissions_data[name] = arrow_to_compact_dataframe(download_arrow(child.result()))
+        print(f"{name}: {len(admissions_data[name])} rows")
+    print_extraction_stats()
+
+    if return_as_cohort:
+        return admissions_data
+    return split_admissions_by_id_list(admissions_data, admissions_data["admission"])
+
+
+def print_extraction_stats():
+    """Print rate limiter throttling, result cache hits and BigQuery bytes/slot totals of this process."""
+    for operation, stats in bq_rate_limiter.stats().items():
+        print(f"Throttled on {operation}: {stats['throttled_seconds']:.1f}s over {stats['calls']} calls, "
+              f"{stats['retries']} retries")
+    cache_stats = bq_query_cache.stats()
+    print(f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    query_stats = bq_query_stats.summary()
+    print(f"BigQuery: {query_stats['bigquery_jobs']} jobs, {query_stats['bytes_billed'] / 1024 ** 3:.2f} GiB billed, "
+          f"{query_stats['slot_ms'] / 1000:.0f} slot-seconds")
+
+
+def extract_admissions_data_bq_batched(client: bigquery.Client,
+                                       project_id: str,
+                                       dataset_id: str,
+                                       hadm_ids: list | None,
+                                       output_path: str,
+                                       batch_size: int = 5000,
+                                       max_concurrent_batches: int = 4,
+                                       max_retries: int = 2,
+                                       **extract_kwargs) -> dict:
+    """
+    Extract a large cohort batch by batch and stream every source into a Parquet sink,
+    <output_path>/<source>/part-<batch>.parquet, instead of building one DataFrame per source.
+    Batches run concurrently, a failed batch is retried on its own and completed batches are
+    recorded in <output_path>/_manifest.json, so rerunning the same call only extracts what is missing.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids, None for all admissions.
+    :param output_path: Folder of the Parquet sink.
+    :param batch_size: Admissions per batch.
+    :param max_concurrent_batches: Max number of batches extracted at once.
+    :param max_retries: Retries of a failed batch before it is reported as failed.
+    :param extract_kwargs: extract_admissions_data_bq arguments (max_workers, materialize_cohort, ...).
+    :return: Summary dictionary with n_batches, completed and failed batch numbers, and rows per source.
+    """
+    if hadm_ids is None:
+        hadm_ids = query_to_dataframe(client, query_builder.build_hadm_ids_query(project_id, dataset_id))["hadm_id"]
+    hadm_ids = sorted(set(int(h) for h in hadm_ids))
+    batches = [hadm_ids[i:i + batch_size] for i in range(0, len(hadm_ids), batch_size)]
+
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(output_path, "_manifest.json")
+    fingerprint = hashlib.sha256(f"{batch_size}:{','.join(map(str, hadm_ids))}".encode()).hexdigest()
+    manifest = {"fingerprint": fingerprint, "n_batches": len(batches), "completed": {}, "failed": {}}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous.get("fingerprint") == fingerprint:
+            manifest["completed"] = previous["completed"]
+    manifest_lock = threading.Lock()
+
+    def save_manifest():
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def extract_batch(batch_number: int, batch: list) -> dict:
+        for attempt in range(max_retries + 1):
+            try:
+                data = extract_admissions_data_bq(client, project_id, dataset_id, batch,
+                                                  return_as_cohort=True, **extract_kwargs)
+                rows = {}
+                for source, df in data.items():
+                    folder = Path(output_path, source)
+                    folder.mkdir(exist_ok=True)
+                    pq.write_table(pa.Table.from_pandas(df, preserve_index=False),
+                                   folder / f"part-{batch_number:05d}.parquet",
+                                   compression="zstd")
+                    rows[source] = len(df)
+                return rows
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                delay = 2 ** attempt
+                print(f"Batch {batch_number} failed ({e}), retrying in {delay}s ({attempt + 1}/{max_retries})")
+                time.sleep(delay)
+
+    pending = [(i, batch) for i, batch in enumerate(batches) if str(i) not in manifest["completed"]]
+    print(f"Extracting {len(hadm_ids)} admissions in {len(batches)} batches, "
+          f"{len(batches) - len(pending)} already done")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent_batches)) as executor:
+        futures = {executor.submit(extract_batch, i, batch): i for i, batch in pending}
+        for future in as_completed(futures):
+            batch_number = futures[future]
+            with manifest_lock:
+                try:
+                    manifest["completed"][str(batch_number)] = future.result()
+                except Exception as e:
+                    manifest["failed"][str(batch_number)] = str(e)
+                save_manifest()
+                done = len(manifest["completed"])
+            print(f"Batch {batch_number} {'failed' if str(batch_number) in manifest['failed'] else 'done'}: "
+                  f"{done}/{len(batches)} batches, {time.perf_counter() - started:.0f}s")
+
+    rows = {}
+    for batch_rows in manifest["completed"].values():
+        for source, n in batch_rows.items():
+            rows[source] = rows.get(source, 0) + n
+    return {"n_batches": len(batches),
+            "completed": sorted(int(i) for i in manifest["completed"]),
+            "failed": sorted(int(i) for i in manifest["failed"]),
+            "rows": rows}
+
+
+def run_queries_concurrently(tasks: dict, max_workers: int = 8) -> tuple[dict, dict]:
+    """
+    Run independent query functions on a thread pool. BigQuery jobs wait on the network,
+    so threads overlap them without holding the GIL.
+    :param tasks: Dictionary {name: (function, args)}.
+    :param max_workers: Max number of functions running at once.
+    :return: Dictionary {name: result} in tasks order, dictionary {name: seconds} with
+    per-query timings and the total wall-clock time under "total".
+    """
+
+    def timed(function, function_args):
+        started = time.perf_counter()
+        result = function(*function_args)
+        return result, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {name: executor.submit(timed, function, function_args)
+                   for name, (function, function_args) in tasks.items()}
+        try:
+            outputs = {name: future.result() for name, future in futures.items()}
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            raise
+
+    results = {name: result for name, (result, _) in outputs.items()}
+    timings = {name: seconds for name, (_, seconds) in outputs.items()}
+    timings["total"] = time.perf_counter() - started
+    return results, timings
+
+
 def get_admissions_bq(client: bigquery.Client,
                       project_id: str,
                       dataset_id: str,
                       available_demographics: List[str],
-                      hadm_ids: int | list | None) -> tuple:
+                      hadm_ids: int | list | None,
+                      cohort: dict | None = None) -> tuple:
     """
     Extracts single or multiple admissions from BigQuery.
     :param client: a BigQuery client.
@@ -133,14 +818,16 @@ def get_admissions_bq(client: bigquery.Client,
     :param dataset_id: BigQuery dataset name.
     :param available_demographics: list of available columns in the patients table.
     :param hadm_ids: Can be int for single admission, list for multiple admissions, None for all admissions.
+    :param cohort: Materialized cohort joined instead of sending hadm_ids.
     :return: Filtered admission dataframe with single hadm_id or  multiple hadm_ids.
     """
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     admission_query = query_builder.build_admissions_query(project_id,
                                                            dataset_id,
                                                            available_demographics,
-                                                           hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    admissions = execute_query(client, admission_query, job_config).to_dataframe()
+                                                           hadm_ids if cohort is None else cohort["hadm_ids"],
+                                                           cohort_table)
+    admissions = query_to_dataframe(client, admission_query, job_config)
     hadm_ids = admissions["hadm_id"].unique().tolist()
     return admissions, hadm_ids
 
@@ -148,190 +835,423 @@ def get_admissions_bq(client: bigquery.Client,
 def get_vitals_bq(client,
                   project_id,
                   dataset_id,
-                  hadm_ids: list) -> pd.DataFrame:
+                  hadm_ids: list,
+                  cohort: dict | None = None) -> pd.DataFrame:
     """
     Retrieves vital signs from admission data
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: a dataframe with vital signs events
     """
     icustays = get_valid_columns(client, project_id, dataset_id, "icustays")
     chartevents = get_valid_columns(client, project_id, dataset_id, "chartevents")
     d_items = get_valid_columns(client, project_id, dataset_id, "d_items")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     vitals_query = query_builder.build_vitals_query(project_id,
                                                     dataset_id,
                                                     list(icustays),
                                                     list(chartevents),
                                                     list(d_items),
-                                                    hadm_ids)
+                                                    hadm_ids,
+                                                    cohort_table)
 
-    job_config = set_hadm_ids_config(hadm_ids)
-    return execute_query(client, vitals_query, job_config).to_dataframe()
+    return query_to_dataframe(client, vitals_query, job_config)
 
 
 def get_labs_bq(client,
                 project_id,
                 dataset_id,
-                hadm_ids: list) -> tuple:
+                hadm_ids: list,
+                cohort: dict | None = None) -> tuple:
     """
     Retrieves laboratory test results from admission data.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
-    :return: a dataframe with laboratory test events
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :return: a dataframe with laboratory test events, a dataframe with the abnormal (flagged) ones
     """
     labs = get_valid_columns(client, project_id, dataset_id, "labevents")
     descriptions = get_valid_columns(client, project_id, dataset_id, "d_labitems")
-    query = query_builder.build_procedures_query(project_id,
-                                                 dataset_id,
-                                                 list(labs),
-                                                 list(descriptions),
-                                                 hadm_ids)
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
+    query = query_builder.build_labs_query(project_id,
+                                           dataset_id,
+                                           list(labs),
+                                           list(descriptions),
+                                           hadm_ids,
+                                           cohort_table)
 
-    job_config = set_hadm_ids_config(hadm_ids)
-    lab_results = execute_query(client, query, job_config).to_dataframe()
+    lab_results = query_to_dataframe(client, query, job_config)
 
     # Get abnormal labs (flagged as abnormal)
     abnormal_labs = lab_results[lab_results['flag'].notna() & (lab_results['flag'] != '')] if (
             len(labs) > 0) else pd.DataFrame()
 
-    return labs, abnormal_labs
+    return lab_results, abnormal_labs
 
 
 def get_medications_bq(client: bigquery.Client,
                        project_id: str,
                        dataset_id: str,
-                       hadm_ids: list) -> tuple:
+                       hadm_ids: list,
+                       cohort: dict | None = None) -> tuple:
     """
     Retrieves medications from admission data.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: dataframes with prescribed medications, emar records, and infusions medications.
     """
-    prescriptions = get_valid_columns(client, project_id, dataset_id, "prescriptions")
-    emar = get_valid_columns(client, project_id, dataset_id, "emar")
-    infusions = get_valid_columns(client, project_id, dataset_id, "inputevents")
-    inf_descriptions = get_valid_columns(client, project_id, dataset_id, "d_items")
+    return (get_prescriptions_bq(client, project_id, dataset_id, hadm_ids, cohort),
+            get_emar_bq(client, project_id, dataset_id, hadm_ids, cohort),
+            get_infusions_bq(client, project_id, dataset_id, hadm_ids, cohort))
+
 
+def get_prescriptions_bq(client: bigquery.Client,
+                         project_id: str,
+                         dataset_id: str,
+                         hadm_ids: list,
+                         cohort: dict | None = None) -> pd.DataFrame:
+    """
+    Retrieves prescribed medications.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :return: dataframe with prescribed medications.
+    """
+    prescriptions = get_valid_columns(client, project_id, dataset_id, "prescriptions")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     prescriptions_query = query_builder.build_prescriptions_query(project_id,
                                                                   dataset_id,
                                                                   list(prescriptions),
-                                                                  hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    prescriptions_results = execute_query(client, prescriptions_query, job_config).to_dataframe()
+                                                                  hadm_ids,
+                                                                  cohort_table)
+    return query_to_dataframe(client, prescriptions_query, job_config)
 
-    # EMAR (medication administration records)
+
+def get_emar_bq(client: bigquery.Client,
+                project_id: str,
+                dataset_id: str,
+                hadm_ids: list,
+                cohort: dict | None = None) -> pd.DataFrame:
+    """
+    Retrieves EMAR (medication administration records).
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :return: dataframe with emar records.
+    """
+    emar = get_valid_columns(client, project_id, dataset_id, "emar")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     emar_query = query_builder.build_emar_query(project_id,
                                                 dataset_id,
                                                 list(emar),
-                                                hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    emar_results = execute_query(client, emar_query, job_config).to_dataframe()
+                                                hadm_ids,
+                                                cohort_table)
+    return query_to_dataframe(client, emar_query, job_config)
 
-    # Infusions (from ICU)
+
+def get_infusions_bq(client: bigquery.Client,
+                     project_id: str,
+                     dataset_id: str,
+                     hadm_ids: list,
+                     cohort: dict | None = None) -> pd.DataFrame:
+    """
+    Retrieves infusions (from ICU).
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :return: dataframe with infusions medications.
+    """
+    infusions = get_valid_columns(client, project_id, dataset_id, "inputevents")
+    inf_descriptions = get_valid_columns(client, project_id, dataset_id, "d_items")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     infusions_query = query_builder.build_infusions_query(project_id,
                                                           dataset_id,
                                                           list(infusions),
                                                           list(inf_descriptions),
-                                                          hadm_ids)
-
-    job_config = set_hadm_ids_config(hadm_ids)
-    infusions_results = execute_query(client, infusions_query, job_config).to_dataframe()
-
-    return prescriptions_results, emar_results, infusions_results
+                                                          hadm_ids,
+                                                          cohort_table)
+    return query_to_dataframe(client, infusions_query, job_config)
 
 
 def get_procedures_bq(client: bigquery.Client,
                       project_id,
                       dataset_id,
-                      hadm_ids: list) -> pd.DataFrame:
+                      hadm_ids: list,
+                      cohort: dict | None = None) -> pd.DataFrame:
     """Retrieves procedures billed by hospital.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: dataframes with hospital procedures.
     """
     procedures = get_valid_columns(client, project_id, dataset_id, "procedures_icd")
     descriptions = get_valid_columns(client, project_id, dataset_id, "d_icd_procedures")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     query = query_builder.build_procedures_query(project_id,
                                                  dataset_id,
                                                  list(procedures),
                                                  list(descriptions),
-                                                 hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    return execute_query(client, query, job_config).to_dataframe()
+                                                 hadm_ids,
+                                                 cohort_table)
+    return query_to_dataframe(client, query, job_config)
 
 
 def get_icu_procedures_bq(client: bigquery.Client,
                           project_id: str,
                           dataset_id: str,
-                          hadm_ids: list) -> pd.DataFrame:
+                          hadm_ids: list,
+                          cohort: dict | None = None) -> pd.DataFrame:
     """
     Retrieves procedures documented during the ICU stay.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: dataframes with icu procedures.
     """
     procedures = get_valid_columns(client, project_id, dataset_id, "procedureevents")
     descriptions = get_valid_columns(client, project_id, dataset_id, "d_items")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     query = query_builder.build_icu_procedures_query(project_id,
                                                      dataset_id,
                                                      list(procedures),
                                                      list(descriptions),
-                                                     hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    return execute_query(client, query, job_config).to_dataframe()
+                                                     hadm_ids,
+                                                     cohort_table)
+    return query_to_dataframe(client, query, job_config)
 
 
 def get_diagnoses_bq(client: bigquery.Client,
                      project_id: str,
                      dataset_id: str,
-                     hadm_ids: list) -> pd.DataFrame:
+                     hadm_ids: list,
+                     cohort: dict | None = None) -> pd.DataFrame:
     """
     Retrieves hospital diagnoses.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: dataframes with diagnoses.
     """
     diagnoses = get_valid_columns(client, project_id, dataset_id, "diagnoses_icd")
     descriptions = get_valid_columns(client, project_id, dataset_id, "d_icd_diagnoses")
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     query = query_builder.build_diagnoses_query(project_id,
                                                 dataset_id,
                                                 diagnoses,
                                                 descriptions,
-                                                hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    return execute_query(client, query, job_config).to_dataframe()
+                                                hadm_ids,
+                                                cohort_table)
+    return query_to_dataframe(client, query, job_config)
 
 
 def get_transfers_bq(client: bigquery.Client,
                      project_id: str,
                      dataset_id: str,
-                     hadm_ids: list) -> pd.DataFrame:
+                     hadm_ids: list,
+                     cohort: dict | None = None) -> pd.DataFrame:
     """Retrieves transfers between the departments during the hospital stay.
     :param client: a BigQuery client
     :param project_id: BigQuery project name
     :param dataset_id: BigQuery dataset name
     :param hadm_ids: list of hadm_ids
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
     :return: dataframes with icu transfers. """
     available_cols = get_valid_columns(client, project_id, dataset_id, "transfers")
 
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
     query = query_builder.build_transfers_query(project_id,
                                                 dataset_id,
                                                 list(available_cols),
-                                                hadm_ids)
-    job_config = set_hadm_ids_config(hadm_ids)
-    return execute_query(client, query, job_config).to_dataframe()
+                                                hadm_ids,
+                                                cohort_table)
+    return query_to_dataframe(client, query, job_config)
+
+
+def build_source_events_query(client: bigquery.Client,
+                              project_id: str,
+                              dataset_id: str,
+                              source_name: str,
+                              hadm_ids: list,
+                              cohort_table: str | None = None) -> str:
+    """
+    Raw events query of a mimic_iv_data_sources entry.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param source_name: Source name, e.g. "labs".
+    :param hadm_ids: list of hadm_ids
+    :param cohort_table: Materialized cohort table to join instead of the hadm_ids parameter.
+    :return: sql query.
+    """
+    def columns(table):
+        return list(get_valid_columns(client, project_id, dataset_id, table))
+
+    builders = {
+        "transfers": lambda: query_builder.build_transfers_query(
+            project_id, dataset_id, columns("transfers"), hadm_ids, cohort_table),
+        "vitals": lambda: query_builder.build_vitals_query(
+            project_id, dataset_id, columns("icustays"), columns("chartevents"), columns("d_items"),
+            hadm_ids, cohort_table),
+        "labs": lambda: query_builder.build_labs_query(
+            project_id, dataset_id, columns("labevents"), columns("d_labitems"), hadm_ids, cohort_table),
+        "prescription_medications": lambda: query_builder.build_prescriptions_query(
+            project_id, dataset_id, columns("prescriptions"), hadm_ids, cohort_table),
+        "infusion_medications": lambda: query_builder.build_infusions_query(
+            project_id, dataset_id, columns("inputevents"), columns("d_items"), hadm_ids, cohort_table),
+        "emar_medications": lambda: query_builder.build_emar_query(
+            project_id, dataset_id, columns("emar"), hadm_ids, cohort_table),
+        "procedures": lambda: query_builder.build_procedures_query(
+            project_id, dataset_id, columns("procedures_icd"), columns("d_icd_procedures"), hadm_ids, cohort_table),
+        "icu_procedures": lambda: query_builder.build_icu_procedures_query(
+            project_id, dataset_id, columns("procedureevents"), columns("d_items"), hadm_ids, cohort_table)}
+    if source_name not in builders:
+        raise ValueError(f"Unknown source: {source_name}")
+    return builders[source_name]()
+
+
+def get_binned_time_series_bq(client: bigquery.Client,
+                              project_id: str,
+                              dataset_id: str,
+                              hadm_ids: list,
+                              time_resolution_hours: float,
+                              observation_window_hours: float | None = None,
+                              cohort: dict | None = None,
+                              max_workers: int = 8) -> dict:
+    """
+    Bin every source in BigQuery and download only the binned long tables, instead of raw events.
+    The grid follows create_time_grid on admissions.admittime/dischtime (no first-event admittime adjustment).
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids
+    :param time_resolution_hours: Bin width in hours.
+    :param observation_window_hours: Max hours per admission (None for full stay).
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :param max_workers: Max number of queries running at once (1 with a session cohort).
+    :return: Dictionary {"grid": DataFrame (hadm_id, grid_start, n_bins), source name: DataFrame (hadm_id, bin, label, value, n)}.
+    """
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
+    grid_query = query_builder.build_time_grid_query(project_id, dataset_id, time_resolution_hours,
+                                                     observation_window_hours, cohort_table)
+
+    def binned_source(src):
+        events_query = build_source_events_query(client, project_id, dataset_id, src["name"], hadm_ids, cohort_table)
+        query = query_builder.build_binned_source_query(events_query, src, grid_query, time_resolution_hours)
+        return query_to_dataframe(client, query, job_config)
+
+    tasks = {"grid": (query_to_dataframe, (client, grid_query, job_config))}
+    tasks.update({src["name"]: (binned_source, (src,)) for src in mimic_iv_data_sources})
+    results, timings = run_queries_concurrently(tasks, max_workers=cohort_max_workers(cohort, max_workers))
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.1f}s")
+    return results
+
+
+def stream_cohort_to_long(client: bigquery.Client,
+                          project_id: str,
+                          dataset_id: str,
+                          hadm_ids: list,
+                          time_resolution_hours: float,
+                          observation_window_hours: float | None = None,
+                          windows: pd.DataFrame | None = None,
+                          cohort: dict | None = None,
+                          max_queue_batches: int = 4) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Build the long events table (see long_format_utils.cohort_events_to_long) while the source results
+    download: every source query is streamed with iter_query_batches and each batch is binned by a
+    StreamingLongFormatBuilder, so raw events are never held in memory as a whole.
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids
+    :param time_resolution_hours: Bin width in hours.
+    :param observation_window_hours: Max hours per admission (None for full stay).
+    :param windows: Output of adjust_cohort_admittimes, default the admissions admittime/dischtime
+    (no first-event admittime adjustment, it would need all events first).
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :param max_queue_batches: Batches downloaded ahead of the binner.
+    :return: long events DataFrame, features DataFrame (feature_id, source, feature).
+    """
+    job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
+    if windows is None:
+        demographics = list(get_valid_columns(client, project_id, dataset_id, "patients"))
+        admissions = query_to_dataframe(client, query_builder.build_admissions_query(
+            project_id, dataset_id, demographics, hadm_ids, cohort_table), job_config)
+        windows = adjust_cohort_admittimes({"admission": admissions})
+
+    builder = StreamingLongFormatBuilder(windows, time_resolution_hours, observation_window_hours)
+    for src in mimic_iv_data_sources:
+        started = time.perf_counter()
+        query = build_source_events_query(client, project_id, dataset_id, src["name"], hadm_ids, cohort_table)
+        n_batches = 0
+        for batch in iter_query_batches(client, query, job_config, max_queue_batches=max_queue_batches):
+            builder.add(src["name"], batch)
+            n_batches += 1
+        print(f"{src['name']}: {n_batches} batches in {time.perf_counter() - started:.1f}s")
+    return builder.result()
+
+
+def get_cohort_analytics_bq(client: bigquery.Client,
+                            project_id: str,
+                            dataset_id: str,
+                            hadm_ids: list | None = None,
+                            cohort: dict | None = None,
+                            los_resolution_days: float = 0.1,
+                            max_workers: int = 8) -> dict:
+    """
+    Readmission, mortality and demographics analyses computed in BigQuery, only the aggregated tables
+    are downloaded (see local_cohort_analysis_utils.run_cohort_analytics_plots).
+    :param client: a BigQuery client
+    :param project_id: BigQuery project name
+    :param dataset_id: BigQuery dataset name
+    :param hadm_ids: list of hadm_ids, None for all admissions.
+    :param cohort: Materialized cohort from materialize_cohort_table, joined instead of the hadm_ids parameter.
+    :param los_resolution_days: Length of stay bin width in days.
+    :param max_workers: Max number of queries running at once (1 with a session cohort).
+    :return: Dictionary with readmissions, admissions_per_patient, hosp_mortality, icu_mortality
+    (indexed by long_title), hospital_stays and icu_stays DataFrames.
+    """
+    job_config, cohort_table = None, None
+    if hadm_ids is not None or cohort is not None:
+        job_config, cohort_table = cohort_query_config(hadm_ids, cohort)
+    queries = {
+        "readmissions": query_builder.build_readmissions_query(project_id, dataset_id, hadm_ids, cohort_table),
+        "admissions_per_patient": query_builder.build_admissions_per_patient_query(project_id, dataset_id,
+                                                                                   hadm_ids, cohort_table),
+        "hosp_mortality": query_builder.build_mortality_by_diagnosis_query(project_id, dataset_id,
+                                                                           hadm_ids, cohort_table),
+        "icu_mortality": query_builder.build_mortality_by_diagnosis_query(project_id, dataset_id,
+                                                                          hadm_ids, cohort_table, icu=True),
+        "hospital_stays": query_builder.build_stay_distribution_query(project_id, dataset_id, hadm_ids, cohort_table,
+                                                                      los_resolution_days=los_resolution_days),
+        "icu_stays": query_builder.build_stay_distribution_query(project_id, dataset_id, hadm_ids, cohort_table,
+                                                                 icu=True, los_resolution_days=los_resolution_days)}
+    tasks = {name: (query_to_dataframe, (client, query, job_config)) for name, query in queries.items()}
+    results, timings = run_queries_concurrently(tasks, max_workers=cohort_max_workers(cohort, max_workers))
+    print(f"Cohort analytics: {timings['total']:.1f}s")
+    for name in ("hosp_mortality", "icu_mortality"):
+        results[name] = results[name].set_index("long_title")
+    return results
 
 
 def get_services(client: bigquery.Client,
@@ -340,7 +1260,7 @@ def get_services(client: bigquery.Client,
     """For total hospital services."""
     services_query = query_builder.build_services_query(project_id,
                                                         dataset_id)
-    return execute_query(client, services_query).to_dataframe()
+    return query_to_dataframe(client, services_query)
 
 
 # TODO
@@ -3,11 +3,16 @@ from os.path import join
 from zipfile import ZipFile
 import pandas as pd
 from icdmappings import Mapper
-from config.project_config import mimic_iv_data_sources, vitals_keywords
+from config.project_config import mimic_iv_data_sources, vitals_keywords, age_group_bins, age_group_labels
 from utils import med_utils
 import re
+import hashlib
+import warnings
+from functools import lru_cache
 # pip install icd-mappings
 
+COLUMN_NAME_CACHE_SIZE = 65536
+
 
 def extract_zip_file(datadir: Path, filename: str,  verbose: bool = False):
     if not Path(join(datadir, filename.replace(".zip",""))).exists():
@@ -21,9 +26,12 @@ def dataframe_from_csv(path: str, compression: any = "gzip", header=0, index_col
     return pd.read_csv(path, compression=compression, header=header, index_col=index_col)
 
 
-def load_mimic_data(mimic4_path, verbose=False):
+def load_mimic_data(mimic4_path, verbose=False, parse_datetimes=True):
     """
     Load MIMIC-IV data files
+    :param mimic4_path: MIMIC-IV folder with hosp and icu subfolders.
+    :param verbose: Print loaded tables.
+    :param parse_datetimes: Parse time and date columns once at load time (see parse_datetime_columns).
     """
 
     hosp_files = ["patients", "admissions", "diagnoses_icd", "d_icd_diagnoses",
@@ -38,6 +46,8 @@ def load_mimic_data(mimic4_path, verbose=False):
             try:
                 result[filename] = pd.read_csv(join(mimic4_path, f"{source}/{filename}.csv.gz"),
                                                compression="gzip")
+                if parse_datetimes:
+                    result[filename] = parse_datetime_columns(result[filename])
                 if verbose:
                     print(f"Loaded {filename}: {len(content[filename])} rows")
             except FileNotFoundError:
@@ -123,16 +133,10 @@ def split_admissions_by_id_list(admissions_data, hadm_df):
                       "admittime": group["admittime"].iat[0],
                       "dischtime": group["dischtime"].iat[0],
                       "admission": group.copy(),
-                      "vitals": split["vitals"][n],
-                      "labs": split["labs"][n],
-                      "prescription_medications": split["prescription_medications"][n],
-                      "emar_medications": split["emar_medications"][n],
-                      "infusion_medications": split["infusion_medications"][n],
-                      "procedures": split["procedures"][n],
-                      "icu_procedures": split["icu_procedures"][n],
+                      # Event sources present in admissions_data (none when only static data was extracted)
+                      **{name: split[name][n] for name in names if name != "diagnoses"},
                       "primary_diagnosis": diagnoses_dict["primary_diagnosis"],
-                      "diagnoses": diagnoses_dict["diagnoses"],
-                      "transfers": split["transfers"][n]}
+                      "diagnoses": diagnoses_dict["diagnoses"]}
     return results
 
 
@@ -219,41 +223,113 @@ def add_age_group_counts(df: pd.DataFrame, age_column: str) -> tuple[pd.DataFram
     :return: df
     """
     df["age_group"] = pd.cut(df[age_column],
-                             bins=[0, 18, 30, 50, 65, 80, 100],
-                             labels=["<18", "18-29", "30-49", "50-64", "65-79", "80+"])
+                             bins=age_group_bins,
+                             labels=age_group_labels)
     age_group_counts = df["age_group"].value_counts().sort_index()
     return df, age_group_counts
 
 
-def clean_column_name(name, max_len=50):
+@lru_cache(maxsize=COLUMN_NAME_CACHE_SIZE)
+def _normalize_label(name):
     name = name.strip().replace(" ", "_").replace("/", "_").replace("-", "_")
     name = re.sub(r"(\.\d)\d+", r"\1", name)  # round dosages
-    clean = re.sub(r"_{2,}", "_", name)  # Multiple occurrences
+    return re.sub(r"_{2,}", "_", name)  # Multiple occurrences
+
+
+def clean_column_name(name, max_len=50):
+    """Label to column name. Normalization is memoized process-wide, labels repeat across admissions."""
+    clean = _normalize_label(name)
     return f"{clean[:max_len]}"
 
 
+def _hashed_column_name(clean, max_len=50):
+    """Truncated normalized label ending with a short hash of the full label, the same in every call."""
+    suffix = "_" + hashlib.sha1(clean.encode()).hexdigest()[:6]
+    return f"{clean[:max_len - len(suffix)]}{suffix}"
+
+
+def clean_column_names(labels, max_len=50, assigned: dict | None = None) -> dict:
+    """
+    Bulk clean_column_name: normalizes each unique label once.
+    Distinct labels whose names only collide after truncation to max_len end with a short hash of the
+    full label instead of silently overwriting each other's columns, all other names are unchanged.
+    :param labels: Array-like of labels (duplicates and NaN allowed, NaN is skipped).
+    :param max_len: Maximum column name length.
+    :param assigned: Dictionary {label: column name} mapped earlier (e.g. previous batches). Their names are kept,
+        new labels colliding with them are suffixed.
+    :return: Dictionary {label: column name} of the labels not in assigned.
+    """
+    assigned = assigned or {}
+    normalized = {label: _normalize_label(label) for label in pd.unique(pd.Series(labels).dropna())
+                  if label not in assigned}
+    assigned_columns = {_normalize_label(label): column for label, column in assigned.items()}
+
+    by_column = {}
+    for clean in list(assigned_columns) + list(normalized.values()):
+        by_column.setdefault(clean[:max_len], set()).add(clean)
+
+    mapping = {}
+    for label, clean in normalized.items():
+        if clean in assigned_columns:
+            mapping[label] = assigned_columns[clean]
+        elif len(by_column[clean[:max_len]]) > 1:
+            mapping[label] = _hashed_column_name(clean, max_len)
+        else:
+            mapping[label] = clean[:max_len]
+
+    new_names = set(normalized.values())
+    collisions = [sorted(group) for group in by_column.values() if len(group) > 1 and group & new_names]
+    if collisions:
+        warnings.warn(f"Labels truncated to the same column name get a hash suffix: {collisions}")
+    return mapping
+
+
 def date_and_time_to_datetime(df: pd.DataFrame, time_column: str) -> pd.DataFrame:
-    df = df.copy()
     if "time" in time_column:
         df = df.dropna(subset=[time_column])
-        df[time_column] = pd.to_datetime(df[time_column])
+        if not pd.api.types.is_datetime64_any_dtype(df[time_column]):
+            # Columns parsed at load time are not parsed again
+            df = df.copy()
+            df[time_column] = pd.to_datetime(df[time_column])
     if "date" in time_column:
         # Convert to datetime and set fixed time to 12:00
+        df = df.copy()
         df[time_column] = pd.to_datetime(df[time_column]).dt.normalize() + pd.Timedelta(hours=12)
     return df
 
 
-def adjust_admittime_by_first_event(admission_dict):
+def parse_datetime_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parse every time and date column of a table once, so later window filters do not re-parse strings.
+    Date columns keep their raw midnight value; date_and_time_to_datetime still shifts them to 12:00.
+    :param df: Raw MIMIC-IV table.
+    :return: Table with datetime64 time and date columns.
+    """
+    for col in df.columns:
+        if ("time" in col or "date" in col) and df[col].dtype == object:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+    return df
+
+
+def adjust_admittime_by_first_event(admission_dict, interval_indexes: dict | None = None):
     """
     Adjusts admission time if earlier events in the emergency department
     (e.g., medications, vitals, labs, procedures) start before the recorded admit time.
 
     Returns the earliest event time if it is earlier than the recorded admission time.
+    Sources with an interval index (see interval_index.build_interval_indexes) read the earliest start from it.
     """
     recorded_admit_time = pd.to_datetime(admission_dict["admittime"])
+    if interval_indexes is None:
+        interval_indexes = {}
 
     event_times = []
     for src in mimic_iv_data_sources:
+        index = interval_indexes.get(src["name"])
+        if index is not None:
+            if index.earliest_start is not None:
+                event_times.append(index.earliest_start)
+            continue
         df = admission_dict.get(src["name"])
         time_col = src["time_col"] if "time_col" in src.keys() else None
         start_col = src["start_col"] if "start_col" in src.keys() else None
@@ -273,12 +349,52 @@ def adjust_admittime_by_first_event(admission_dict):
     return min(recorded_admit_time, earliest_event_time)
 
 
-def get_admit_discharge_times(data_dict: dict, adjust_start: bool = True) -> tuple:
+def adjust_cohort_admittimes(admissions_data: dict) -> pd.DataFrame:
+    """
+    Cohort version of adjust_admittime_by_first_event: earliest event time per hadm_id across all sources
+    in mimic_iv_data_sources with grouped mins, for all admissions at once.
+    :param admissions_data: Cohort dictionary with "admission" and event sources (return_as_cohort=True).
+    :return: DataFrame with hadm_id, admittime, dischtime, earliest_event_time, adjusted_admittime and
+        qc_failed (invalid admit or discharge time, admittime is then not adjusted).
+    """
+    windows = admissions_data["admission"][["hadm_id", "admittime", "dischtime"]].drop_duplicates(subset=["hadm_id"])
+    windows = windows.assign(admittime=pd.to_datetime(windows["admittime"]),
+                             dischtime=pd.to_datetime(windows["dischtime"]))
+
+    earliest_by_source = []
+    for src in mimic_iv_data_sources:
+        df = admissions_data.get(src["name"])
+        if df is None or df.empty or "hadm_id" not in df.columns:
+            continue
+        for col in {src.get("time_col"), src.get("start_col")} - {None}:
+            if col not in df.columns:
+                continue
+            times = df[col]
+            if not pd.api.types.is_datetime64_any_dtype(times):
+                times = pd.to_datetime(times, errors="coerce")
+            earliest_by_source.append(times.groupby(df["hadm_id"]).min())
+
+    if earliest_by_source:
+        earliest = pd.concat(earliest_by_source, axis=1).min(axis=1).rename("earliest_event_time")
+        windows = windows.merge(earliest, left_on="hadm_id", right_index=True, how="left")
+    else:
+        windows["earliest_event_time"] = pd.NaT
+
+    windows["qc_failed"] = (windows["admittime"].isna() | windows["dischtime"].isna() |
+                            (windows["admittime"] >= windows["dischtime"]))
+    adjusted = windows[["admittime", "earliest_event_time"]].min(axis=1)
+    windows["adjusted_admittime"] = adjusted.where(~windows["qc_failed"], windows["admittime"])
+    return windows.reset_index(drop=True)
+
+
+def get_admit_discharge_times(data_dict: dict, adjust_start: bool = True,
+                              interval_indexes: dict | None = None) -> tuple:
     """
     Sometimes in an emergency department events start before recorded admission time.
     Check and adjust admission and discharge times
     :param data_dict:  Dictionary containing "admit_time" and "discharge_time" as pd.Timestamp.
     :param adjust_start: Whether to adjust admission time to the start of the first event.
+    :param interval_indexes: Optional {source name: EventIntervalIndex} built once for the admission.
     :return admit_time: pd.Timestamp, discharge_time : pd.Timestamp, message: str
     """
     admit_time = pd.to_datetime(data_dict["admittime"])
@@ -290,7 +406,7 @@ def get_admit_discharge_times(data_dict: dict, adjust_start: bool = True) -> tup
 
     if adjust_start:
         # Shift admittime to first event.
-        admit_time = adjust_admittime_by_first_event(data_dict)
+        admit_time = adjust_admittime_by_first_event(data_dict, interval_indexes)
 
     return admit_time, discharge_time, None
 
@@ -343,6 +459,74 @@ def filter_by_time_window_consistency(df: pd.DataFrame, start_window: pd.Timesta
         return df, None
 
 
+def filter_cohort_by_time_window_consistency(admissions_data: dict, windows: pd.DataFrame,
+                                             start_window_col: str = "admittime",
+                                             end_window_col: str = "dischtime") -> tuple[dict, pd.DataFrame]:
+    """
+    Cohort-level filter_by_time_window_consistency: every source is joined with a per-admission window
+    table and filtered/clipped for all admissions in one vectorized pass.
+    Continuous sources adjust start and end, discrete sources adjust start only (as in the per-admission path).
+    :param admissions_data: Cohort dictionary {source name: DataFrame with hadm_id} (return_as_cohort=True).
+    :param windows: DataFrame with hadm_id, window start and window end columns, one row per admission.
+    :param start_window_col: Window start column in windows.
+    :param end_window_col: Window end column in windows.
+    :return: Dictionary with filtered sources, QC DataFrame with dropped and adjusted row counts per source.
+    """
+    windows = windows.drop_duplicates(subset=["hadm_id"]).set_index("hadm_id")
+    window_start = pd.to_datetime(windows[start_window_col])
+    window_end = pd.to_datetime(windows[end_window_col])
+
+    filtered, qc_rows = dict(admissions_data), []
+    for src in mimic_iv_data_sources:
+        if src["datatype"] not in ("continuous", "discrete"):
+            continue
+        df = admissions_data.get(src["name"])
+        if df is None or df.empty:
+            continue
+        start_col = src["start_col"] if src["datatype"] == "continuous" else src["time_col"]
+        end_col = src["end_col"] if src["datatype"] == "continuous" else None
+        qc = {"source": src["name"], "rows_in": len(df)}
+        if start_col not in df.columns or (end_col is not None and end_col not in df.columns):
+            qc["message"] = "QC: failed filter_by_time_window_consistency. Missing event column."
+            qc_rows.append(qc)
+            continue
+
+        df = date_and_time_to_datetime(df, start_col)
+        if end_col is not None:
+            df = date_and_time_to_datetime(df, end_col)
+        qc["dropped_missing_time"] = qc["rows_in"] - len(df)
+
+        starts = df["hadm_id"].map(window_start)
+        ends = df["hadm_id"].map(window_end)
+        has_window = starts.notna()
+        # Ensure event starts later than window
+        valid_start = (df[start_col] >= starts) | df[start_col].isna()
+        valid_times = True if end_col is None else (df[start_col] <= df[end_col]) | df[end_col].isna()
+        keep = has_window & valid_start & valid_times
+        qc["dropped_no_window"] = int((~has_window).sum())
+        qc["dropped_before_window"] = int((has_window & ~valid_start).sum())
+        qc["dropped_invalid_interval"] = int((has_window & valid_start & ~valid_times).sum())
+
+        df, starts, ends = df[keep].copy(), starts[keep], ends[keep]
+        # Shift start_event to start_window if event started before start_window
+        early_start = df[start_col] < starts
+        df.loc[early_start, start_col] = starts[early_start]
+        qc["adjusted_start"] = int(early_start.sum())
+        if end_col is not None:
+            # Shift end_event to end_window if event continued past end_window
+            late_end = df[end_col] > ends
+            df.loc[late_end, end_col] = ends[late_end]
+            qc["adjusted_end"] = int(late_end.sum())
+        else:
+            qc["adjusted_end"] = 0
+
+        qc["rows_out"] = len(df)
+        filtered[src["name"]] = df
+        qc_rows.append(qc)
+
+    return filtered, pd.DataFrame(qc_rows)
+
+
 def filter_dataframe_by_dictionary(keyword_dict: dict, df: pd.DataFrame, columns_to_search: list) -> pd.DataFrame:
     """
     Extracts row which contain keywords from dictionary in specified columns.
@@ -393,23 +577,33 @@ def add_temperature_celsius(df: pd.DataFrame, fahrenheit_column: str) -> pd.Data
     return df
 
 
-def collect_and_save_patient_admission_data(data: dict, results_path: str):
-    """Saves patient data to csv"""
-    subject_id, hadm_id = data["subject_id"], data["hadm_id"]
-    static_df = data["demographics"]
-    static_df["subject_id"] = subject_id
+def collect_patient_admission_data(data: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Collects static and dynamic (binned time-series) tables of a single admission.
+    :param data: Admission dictionary with demographics, diagnoses, time_grid and binned sources.
+    :return: static DataFrame (one row), dynamic DataFrame (one row per time bin).
+    """
+    static_df = data["demographics"].copy()
+    static_df["subject_id"] = data["subject_id"]
     static_df["primary_diagnosis"] = data["primary_diagnosis"]
     static_df["diagnoses"] = ", ".join(data["diagnoses"])
-    static_df.to_csv(join(results_path, f"patient_{subject_id}_admission_{hadm_id}_static.csv"),
-                     index=False)
 
     # Dynamic features >  collect all  the time series data
     dynamic_df = data["time_grid"].copy()
 
-    for data_source in ["vitals", "labs", "medications", "procedures", "icu_procedures", "transfers"]:
-        if data_source in data and not data[data_source].empty:
-            data = data[data_source].drop(["time_point"], axis=1, errors="ignore")
-            dynamic_df = pd.merge(dynamic_df, data, how="left", on="hours_from_admission")
+    for src in mimic_iv_data_sources:
+        source_df = data.get(src["name"])
+        if source_df is not None and not source_df.empty and "hours_from_admission" in source_df.columns:
+            source_df = source_df.drop(["time_point"], axis=1, errors="ignore")
+            dynamic_df = pd.merge(dynamic_df, source_df, how="left", on="hours_from_admission")
+    return static_df, dynamic_df
+
 
+def collect_and_save_patient_admission_data(data: dict, results_path: str):
+    """Saves patient data to csv"""
+    subject_id, hadm_id = data["subject_id"], data["hadm_id"]
+    static_df, dynamic_df = collect_patient_admission_data(data)
+    static_df.to_csv(join(results_path, f"patient_{subject_id}_admission_{hadm_id}_static.csv"),
+                     index=False)
     dynamic_df.to_csv(join(results_path, f"patient_{subject_id}_admission_{hadm_id}_dynamic.csv"), index=False)
 
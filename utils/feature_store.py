@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from config.project_config import mimic_iv_data_sources
+from utils.local_timeseries_utils import generate_single_admission_time_series_data
+
+GRID_COLUMNS = ["time_point", "hours_from_admission"]
+
+
+class FeatureStore:
+    """
+    Point-in-time ("as of hour t") feature queries over binned admissions.
+
+    Every admission is stored once as cumulative matrices over its time grid:
+    bin end hours, running sums and counts of observed values, and the row index
+    of the last observed value per feature. A query is a binary search on the bin
+    ends followed by constant-time lookups, so it never re-runs the time-series pipeline.
+    Only bins that ended at or before t are visible to a query (no look-ahead).
+    """
+
+    def __init__(self):
+        self._admissions = {}
+
+    def __len__(self):
+        return len(self._admissions)
+
+    def __contains__(self, hadm_id):
+        return hadm_id in self._admissions
+
+    @property
+    def hadm_ids(self) -> list:
+        return list(self._admissions.keys())
+
+    def add_admission(self, hadm_id: int, ts_results: dict, sources: list | None = None):
+        """
+        Store the binned time-series of one admission.
+        :param hadm_id: Hospital admission ID.
+        :param ts_results: Output of generate_single_admission_time_series_data (time_grid and binned sources).
+        :param sources: Source names to store, default all sources in mimic_iv_data_sources.
+        """
+        if sources is None:
+            sources = [src["name"] for src in mimic_iv_data_sources]
+        time_grid = ts_results["time_grid"]
+        hours = time_grid["hours_from_admission"].to_numpy(dtype=np.float64)
+
+        features, columns = [], []
+        for name in sources:
+            df = ts_results.get(name)
+            if df is None or df.empty:
+                continue
+            cols = [c for c in df.columns if c not in GRID_COLUMNS]
+            features.append(df[cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64))
+            columns.extend(f"{name}__{c}" for c in cols)
+
+        values = np.hstack(features) if features else np.empty((len(hours), 0))
+        self._admissions[hadm_id] = _cumulative_matrices(hours, values, columns)
+
+    def as_of(self, hadm_id: int, hours: float, window_hours: float | None = None) -> pd.Series:
+        """
+        All features for one admission as of hour t.
+        :param hadm_id: Hospital admission ID.
+        :param hours: Query time in hours from admission.
+        :param window_hours: If given, also return sum, count and mean over bins ending in (t - window, t].
+        :return: Series indexed by feature name ("<feature>_last", and "<feature>_sum/_count/_mean" with a window).
+        """
+        result = self.batch_as_of(pd.DataFrame({"hadm_id": [hadm_id], "hours": [hours]}),
+                                  window_hours=window_hours)
+        return result.drop(columns=["hadm_id", "hours"]).iloc[0]
+
+    def batch_as_of(self, queries: pd.DataFrame, window_hours: float | None = None) -> pd.DataFrame:
+        """
+        Features for many (hadm_id, t) pairs. Queries are grouped by admission and answered with
+        one vectorized binary search per admission.
+        :param queries: DataFrame with "hadm_id" and "hours" columns, a NaN hour sees no bins.
+        :param window_hours: If given, also return sum, count and mean over bins ending in (t - window, t].
+        :return: DataFrame aligned with queries, one column per feature and aggregate.
+        """
+        missing = set(queries["hadm_id"].unique()) - set(self._admissions)
+        if missing:
+            raise KeyError(f"Admissions not in feature store: {sorted(missing)}")
+
+        # Positional index, the caller's index may have duplicates
+        positional = queries.reset_index(drop=True)
+        parts = []
+        for hadm_id, group in positional.groupby("hadm_id", sort=False):
+            store = self._admissions[hadm_id]
+            t = group["hours"].to_numpy(dtype=np.float64)
+            # Index of the last bin ending at or before t, -1 if none.
+            # searchsorted sorts a NaN hour past the last bin, it sees no bins instead
+            row = np.searchsorted(store["bin_ends"], t, side="right") - 1
+            row[np.isnan(t)] = -1
+
+            data = {}
+            n_features = len(store["columns"])
+            if len(store["bin_ends"]) == 0:
+                # Empty time grid, nothing observed
+                last = np.full((len(t), n_features), np.nan)
+            else:
+                last_idx = np.where(row[:, None] >= 0, store["last_idx"][np.maximum(row, 0)], -1)
+                last = store["values"][np.maximum(last_idx, 0), np.arange(n_features)]
+                last[last_idx < 0] = np.nan
+            for j, col in enumerate(store["columns"]):
+                data[f"{col}_last"] = last[:, j]
+
+            if window_hours is not None:
+                start = np.searchsorted(store["bin_ends"], t - window_hours, side="right")
+                end = row + 1
+                start = np.minimum(start, end)
+                sums = store["cum_sum"][end] - store["cum_sum"][start]
+                counts = store["cum_count"][end] - store["cum_count"][start]
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    means = np.where(counts > 0, sums / counts, np.nan)
+                for j, col in enumerate(store["columns"]):
+                    data[f"{col}_sum"] = sums[:, j]
+                    data[f"{col}_count"] = counts[:, j]
+                    data[f"{col}_mean"] = means[:, j]
+
+            parts.append(pd.concat([group[["hadm_id", "hours"]],
+                                    pd.DataFrame(data, index=group.index)], axis=1))
+
+        if not parts:
+            return queries[["hadm_id", "hours"]].copy()
+        result = pd.concat(parts).sort_index()
+        result.index = queries.index
+        return result
+
+
+def _cumulative_matrices(hours: np.ndarray, values: np.ndarray, columns: list) -> dict:
+    """Precompute bin ends, running sums/counts and last-observation indices for one admission."""
+    resolution = np.diff(hours).min() if len(hours) > 1 else 1.0
+    observed = ~np.isnan(values)
+
+    cum_sum = np.zeros((len(hours) + 1, values.shape[1]))
+    cum_sum[1:] = np.cumsum(np.where(observed, values, 0.0), axis=0)
+    cum_count = np.zeros((len(hours) + 1, values.shape[1]), dtype=np.int64)
+    cum_count[1:] = np.cumsum(observed, axis=0)
+
+    # Forward-filled row index of the last observed value per feature
+    last_idx = np.where(observed, np.arange(len(hours))[:, None], -1)
+    last_idx = np.maximum.accumulate(last_idx, axis=0) if len(hours) else last_idx
+
+    return {"bin_ends": hours + resolution,
+            "values": values,
+            "columns": columns,
+            "cum_sum": cum_sum,
+            "cum_count": cum_count,
+            "last_idx": last_idx}
+
+
+def build_feature_store(admissions_by_hadm_id: dict,
+                        time_resolution_hours: float,
+                        observation_window_hours: float | None = None,
+                        verbose: bool = False) -> FeatureStore:
+    """
+    Bin every admission once and load it into a FeatureStore.
+    :param admissions_by_hadm_id: Output of extract_admissions_data(..., return_as_cohort=False).
+    :param time_resolution_hours: Bin width in hours for the time grid.
+    :param observation_window_hours: Max hours to store (None for full stay).
+    :param verbose: Print time-series messages.
+    :return: FeatureStore with all admissions.
+    """
+    store = FeatureStore()
+    for hadm_id, data_dict in admissions_by_hadm_id.items():
+        ts_results, messages = generate_single_admission_time_series_data(data_dict,
+                                                                          time_resolution_hours,
+                                                                          observation_window_hours)
+        if verbose:
+            for m in messages:
+                if m is not None:
+                    print(m)
+        store.add_admission(hadm_id, ts_results)
+    return store
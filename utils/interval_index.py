@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from config.project_config import mimic_iv_data_sources
+
+
+class EventIntervalIndex:
+    """
+    Static index over interval events (medications, infusions, ICU procedures, transfers).
+
+    Intervals are sorted by start time and a running maximum of end times is kept,
+    so "active at t" (stabbing) and "active during [w0, w1)" (overlap) queries only
+    look at the candidate slice found with np.searchsorted instead of rescanning the events.
+    Intervals are half-open: an event is active at t when start <= t < end.
+    """
+
+    def __init__(self,
+                 df: pd.DataFrame,
+                 start_col: str,
+                 end_col: str,
+                 label_col: str | None = None,
+                 default_end: pd.Timestamp | None = None):
+        """
+        :param df: Events with start and end columns.
+        :param start_col: Column with event start times.
+        :param end_col: Column with event end times.
+        :param label_col: Column identifying the event label, kept for lookups.
+        :param default_end: End time for events without one (default: open-ended).
+        """
+        starts = pd.to_datetime(df[start_col]).to_numpy(dtype="datetime64[ns]")
+        ends = pd.to_datetime(df[end_col])
+        ends = ends.fillna(default_end if default_end is not None else pd.Timestamp.max)
+        ends = ends.to_numpy(dtype="datetime64[ns]")
+
+        valid = ~np.isnat(starts)
+        positions = np.flatnonzero(valid)
+        order = positions[np.argsort(starts[valid], kind="stable")]
+
+        self.positions = order  # row positions in the source dataframe, sorted by start
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.labels = df[label_col].to_numpy()[order] if label_col is not None else None
+        self._max_end = np.maximum.accumulate(self.ends) if len(order) else self.ends
+        self._sorted_ends = np.sort(self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def earliest_start(self) -> pd.Timestamp | None:
+        return pd.Timestamp(self.starts[0]) if len(self) else None
+
+    def stab(self, t) -> np.ndarray:
+        """
+        Events active at time t.
+        :param t: Query time.
+        :return: Row positions (in the source dataframe) of events with start <= t < end.
+        """
+        t = np.datetime64(pd.Timestamp(t), "ns")
+        hi = np.searchsorted(self.starts, t, side="right")
+        lo = np.searchsorted(self._max_end[:hi], t, side="right")
+        candidates = slice(lo, hi)
+        return self.positions[candidates][self.ends[candidates] > t]
+
+    def overlap(self, window_start, window_end) -> np.ndarray:
+        """
+        Events active at any point of the window [window_start, window_end).
+        :param window_start: Window start.
+        :param window_end: Window end.
+        :return: Row positions (in the source dataframe) of overlapping events.
+        """
+        window_start = np.datetime64(pd.Timestamp(window_start), "ns")
+        window_end = np.datetime64(pd.Timestamp(window_end), "ns")
+        hi = np.searchsorted(self.starts, window_end, side="left")
+        lo = np.searchsorted(self._max_end[:hi], window_start, side="right")
+        candidates = slice(lo, hi)
+        return self.positions[candidates][self.ends[candidates] > window_start]
+
+    def count_active(self, times) -> np.ndarray:
+        """
+        Number of active events at each query time, fully vectorized.
+        :param times: Array-like of query times.
+        :return: Integer array with one count per query time.
+        """
+        times = pd.to_datetime(pd.Series(times)).to_numpy(dtype="datetime64[ns]")
+        started = np.searchsorted(self.starts, times, side="right")
+        ended = np.searchsorted(self._sorted_ends, times, side="right")
+        return started - ended
+
+    def grid_ranges(self, time_points) -> tuple:
+        """
+        Grid index range [first, last) each event covers on a sorted time grid.
+        :param time_points: Sorted grid time points.
+        :return: Row positions in the source dataframe, first grid index, last grid index (exclusive).
+        """
+        time_points = pd.to_datetime(pd.Series(time_points)).to_numpy(dtype="datetime64[ns]")
+        first = np.searchsorted(time_points, self.starts, side="left")
+        last = np.searchsorted(time_points, self.ends, side="left")
+        return self.positions, first, last
+
+
+def build_interval_indexes(data_dict: dict) -> dict:
+    """
+    Build an interval index once for every interval source in mimic_iv_data_sources.
+    :param data_dict: Dictionary containing different events DataFrames.
+    :return: Dictionary {source name: EventIntervalIndex}.
+    """
+    indexes = {}
+    for src in mimic_iv_data_sources:
+        if "end_col" not in src:
+            continue
+        start_col = src.get("start_col", src.get("time_col"))
+        df = data_dict.get(src["name"])
+        if df is None or df.empty or start_col not in df.columns or src["end_col"] not in df.columns:
+            continue
+        indexes[src["name"]] = EventIntervalIndex(df, start_col, src["end_col"], src["label_col"])
+    return indexes
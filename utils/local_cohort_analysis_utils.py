@@ -1,6 +1,7 @@
 import pandas as pd
 from os.path import join
 from utils import data_utils, local_cohort_plotting_utils
+from config.project_config import age_group_labels
 
 
 def run_demographics_analysis(admissions, icu_stays, diagnoses, results_path):
@@ -57,6 +58,42 @@ def run_admission_readmission_analysis(admissions, results_path):
     print("Completed admission-readmision analysis")
 
 
+def run_cohort_analytics_plots(analytics: dict, results_path: str):
+    """
+    Plot the aggregated analyses of bq_utils.get_cohort_analytics_bq with the same plotting functions
+    as the in-memory analyses.
+    :param analytics: Dictionary returned by get_cohort_analytics_bq.
+    :param results_path: Folder to save plots.
+    """
+    for key, prefix in (("hospital_stays", "Hospital"), ("icu_stays", "ICU")):
+        stays = expand_counts(analytics[key])
+        if len(stays) > 5:
+            stays["age_group"] = pd.Categorical(stays["age_group"], categories=age_group_labels, ordered=True)
+            local_cohort_plotting_utils.plot_demographics(stays, prefix,
+                                                          join(results_path, f"{prefix}_demographics_analysis.png"))
+            local_cohort_plotting_utils.plot_length_of_stay(stays, prefix,
+                                                            join(results_path, f"{prefix}_los_analysis.png"))
+
+    patient_readmissions = expand_counts(analytics["admissions_per_patient"])
+    local_cohort_plotting_utils.plot_readmission_analysis(analytics["readmissions"],
+                                                          patient_readmissions,
+                                                          join(results_path, "Readmission_analysis.png"))
+    local_cohort_plotting_utils.plot_mortality_analysis(analytics["hosp_mortality"],
+                                                        analytics["icu_mortality"],
+                                                        join(results_path, "Mortality_analysis.png"))
+
+
+def expand_counts(df: pd.DataFrame, count_column: str = "n") -> pd.DataFrame:
+    """
+    Repeat every row of an aggregated table count_column times, so plotting functions expecting
+    one row per admission (histograms, box plots) can draw SQL aggregates.
+    :param df: Aggregated DataFrame.
+    :param count_column: Column with the number of rows each row stands for.
+    :return: DataFrame without count_column.
+    """
+    return df.loc[df.index.repeat(df[count_column])].drop(columns=[count_column]).reset_index(drop=True)
+
+
 def clean_etnicity_data(df: pd.DataFrame) -> pd.DataFrame:
     if "race" in df.columns:
         df["race_clean"] = df["race"].fillna("UNKNOWN")
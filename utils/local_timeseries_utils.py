@@ -1,44 +1,228 @@
 import pandas as pd
 import numpy as np
 from datetime import timedelta
-from utils.data_utils import (get_admit_discharge_times, clean_column_name,
-                              date_and_time_to_datetime, filter_by_time_window_consistency)
-from config.project_config import mimic_iv_data_sources
+from utils.data_utils import (get_admit_discharge_times, clean_column_names,
+                              date_and_time_to_datetime, filter_by_time_window_consistency,
+                              adjust_cohort_admittimes, filter_cohort_by_time_window_consistency,
+                              split_admissions_by_id_list)
+from utils.interval_index import EventIntervalIndex, build_interval_indexes
+from config.project_config import mimic_iv_data_sources, grid_anchors
 
 
 def generate_single_admission_time_series_data(data_dict: dict,
                                                time_resolution_hours: float,
-                                               observation_window_hours: float
+                                               observation_window_hours: float,
+                                               filter_windows: bool = True
                                                ) -> tuple:
     """
     Generate time-series data for a single admission, aligned to a common time grid.
     :param data_dict: Dictionary containing different events DataFrames.
     :param time_resolution_hours: Bin width in hours for the time grid.
     :param observation_window_hours: float
+    :param filter_windows: Apply filter_by_time_window_consistency per source. Set to False when the
+        cohort was already filtered with filter_cohort_by_time_window_consistency.
     :return: Dictionary with time grid and binned time-series for each data type.
     """
     messages = []
-    admit_time, discharge_time, message = get_admit_discharge_times(data_dict, adjust_start=True)
+    interval_indexes = build_interval_indexes(data_dict)
+    admit_time, discharge_time, message = get_admit_discharge_times(data_dict, adjust_start=True,
+                                                                    interval_indexes=interval_indexes)
     messages.append(message)
 
     time_grid = create_time_grid(data_dict, time_resolution_hours, observation_window_hours)
 
     results = {"admit_time": admit_time, "discharge_time": discharge_time, "time_grid": time_grid}
+    binned, bin_messages = bin_sources_to_time_grid(data_dict, time_grid, admit_time, discharge_time,
+                                                    filter_windows=filter_windows)
+    results.update(binned)
+    messages.extend(bin_messages)
 
+    return results, messages
+
+
+def generate_cohort_time_series_data(admissions_data: dict,
+                                     time_resolution_hours: float,
+                                     observation_window_hours: float | None
+                                     ) -> tuple:
+    """
+    Generate time-series data for every admission of a cohort.
+    Admission windows are adjusted and events are window-filtered once for the whole cohort,
+    then each admission is binned without repeating those steps.
+    :param admissions_data: Cohort dictionary from extract_admissions_data(..., return_as_cohort=True).
+    :param time_resolution_hours: Bin width in hours for the time grid.
+    :param observation_window_hours: Max hours to analyze (None for full stay).
+    :return: Dictionary {hadm_id: results dictionary}, list of messages, window filtering QC DataFrame.
+    Results hold the admission fields (demographics, diagnoses, ...), time grid and binned sources;
+    admissions_data is left unchanged.
+    """
+    windows = adjust_cohort_admittimes(admissions_data)
+    filtered, qc = filter_cohort_by_time_window_consistency(admissions_data, windows,
+                                                            start_window_col="adjusted_admittime")
+    admissions_by_hadm_id = split_admissions_by_id_list(filtered, windows[["hadm_id"]])
+    source_names = {src["name"] for src in mimic_iv_data_sources}
+
+    cohort_results, messages = {}, []
+    for row in windows.itertuples(index=False):
+        if row.qc_failed:
+            messages.append(f"{row.hadm_id} QC failed: Invalid admit_time or discharge_time")
+            continue
+        data_dict = admissions_by_hadm_id[row.hadm_id]
+        time_grid = create_time_grid_from_window(row.admittime, row.dischtime, time_resolution_hours,
+                                                 observation_window_hours)
+        results = {"admit_time": row.adjusted_admittime, "discharge_time": row.dischtime, "time_grid": time_grid}
+        binned, bin_messages = bin_sources_to_time_grid(data_dict, time_grid, row.adjusted_admittime,
+                                                        row.dischtime, filter_windows=False)
+        results.update(binned)
+        messages.extend(f"{row.hadm_id} {m}" for m in bin_messages)
+        # New dictionary: admission fields (demographics, diagnoses, ...) and binned sources, no raw events
+        static = {key: value for key, value in data_dict.items() if key not in source_names}
+        cohort_results[row.hadm_id] = {**static, **results}
+
+    return cohort_results, messages, qc
+
+
+def generate_anchored_time_series_data(data_dict: dict,
+                                       time_resolution_hours: float,
+                                       observation_window_hours: float | None,
+                                       anchor: str | dict = "icu_stay",
+                                       anchor_tables: dict | None = None
+                                       ) -> tuple:
+    """
+    Generate time-series data for every anchor episode of a single admission (e.g. each ICU stay).
+    Events are sliced to the anchor interval once, then binned with the same kernels as the admission grid.
+    :param data_dict: Dictionary containing different events DataFrames.
+    :param time_resolution_hours: Bin width in hours for the time grid.
+    :param observation_window_hours: Length of observation window in hours. If None, extends until anchor end.
+    :param anchor: "admission", "icu_stay" or a custom dictionary with "source", "id_col", "start_col", "end_col".
+    :param anchor_tables: Tables holding anchor sources missing from data_dict, e.g. icu_tables for "icu_stay".
+    :return: Dictionary {anchor_id: results dictionary} and list of messages.
+    """
+    if anchor == "admission":
+        results, messages = generate_single_admission_time_series_data(data_dict,
+                                                                       time_resolution_hours,
+                                                                       observation_window_hours)
+        return {data_dict["hadm_id"]: results}, messages
+
+    anchor_windows = get_anchor_windows(data_dict, anchor, anchor_tables)
+    anchored_results, messages = {}, []
+    for anchor_id, start_time, end_time in anchor_windows.itertuples(index=False):
+        if pd.isna(start_time) or pd.isna(end_time) or start_time >= end_time:
+            messages.append(f"anchor {anchor_id} QC failed: Invalid anchor start or end time")
+            continue
+
+        anchor_dict = slice_sources_to_window(data_dict, start_time, end_time)
+        time_grid = create_time_grid_from_window(start_time, end_time, time_resolution_hours,
+                                                 observation_window_hours)
+        results = {"admit_time": start_time, "discharge_time": end_time, "time_grid": time_grid}
+        binned, bin_messages = bin_sources_to_time_grid(anchor_dict, time_grid, start_time, end_time,
+                                                        filter_windows=False)
+        results.update(binned)
+        messages.extend(f"anchor {anchor_id} {m}" for m in bin_messages)
+        anchored_results[anchor_id] = results
+
+    return anchored_results, messages
+
+
+def get_anchor_windows(data_dict: dict, anchor: str | dict, anchor_tables: dict | None = None) -> pd.DataFrame:
+    """
+    Collect the (id, start, end) intervals a grid is anchored to.
+    :param data_dict: Dictionary containing different events DataFrames.
+    :param anchor: Key of grid_anchors or a custom dictionary with "source", "id_col", "start_col", "end_col".
+        A custom "end_col" may be None, the admission discharge time is used instead.
+    :param anchor_tables: Tables holding anchor sources missing from data_dict (e.g. icu_tables with icustays),
+        rows are restricted to the admission's hadm_id.
+    :return: DataFrame with anchor id, start time and end time columns, one row per anchor.
+    """
+    spec = grid_anchors[anchor] if isinstance(anchor, str) else anchor
+    df = data_dict.get(spec["source"])
+    if df is None and anchor_tables is not None:
+        df = anchor_tables.get(spec["source"])
+        if df is not None and "hadm_id" in df.columns:
+            df = df[df["hadm_id"] == data_dict["hadm_id"]]
+    id_col, start_col, end_col = spec["id_col"], spec["start_col"], spec.get("end_col")
+    if df is None or df.empty or start_col not in df.columns:
+        return pd.DataFrame(columns=["anchor_id", "start_time", "end_time"])
+
+    if id_col not in df.columns:
+        # One grid for the admission, anchored at the earliest row
+        df = df.assign(**{id_col: data_dict["hadm_id"]})
+    if end_col is None:
+        df = df.assign(anchor_end=data_dict["dischtime"])
+        end_col = "anchor_end"
+
+    windows = df[[id_col, start_col, end_col]].dropna(subset=[id_col])
+    windows = windows.assign(**{start_col: pd.to_datetime(windows[start_col])})
+    windows = windows.sort_values(start_col, kind="stable").drop_duplicates(subset=[id_col])
+    windows.columns = ["anchor_id", "start_time", "end_time"]
+    windows["end_time"] = pd.to_datetime(windows["end_time"])
+    return windows.sort_values("start_time").reset_index(drop=True)
+
+
+def slice_sources_to_window(data_dict: dict, start_window: pd.Timestamp, end_window: pd.Timestamp) -> dict:
+    """
+    Keep only events inside the window for every source in mimic_iv_data_sources.
+    Interval events overlapping the window are kept and clipped to it, point events must fall inside it,
+    so the sliced sources are binned without filter_by_time_window_consistency.
+    :param data_dict: Dictionary containing different events DataFrames.
+    :param start_window: Window start.
+    :param end_window: Window end.
+    :return: Shallow copy of data_dict with sliced event DataFrames.
+    """
+    sliced = dict(data_dict)
+    for src in mimic_iv_data_sources:
+        df = data_dict.get(src["name"])
+        if df is None or df.empty:
+            continue
+        if src["datatype"] == "continuous":
+            start_col, end_col = src["start_col"], src["end_col"]
+            if start_col not in df.columns or end_col not in df.columns:
+                continue
+            df = date_and_time_to_datetime(df, start_col)
+            df = date_and_time_to_datetime(df, end_col)
+            overlaps = (df[start_col] < end_window) & (df[end_col].isna() | (df[end_col] > start_window))
+            df = df[overlaps].copy()
+            df.loc[df[start_col] < start_window, start_col] = start_window
+            df.loc[df[end_col] > end_window, end_col] = end_window
+        else:
+            time_col = src["time_col"]
+            if time_col not in df.columns:
+                continue
+            df = date_and_time_to_datetime(df, time_col)
+            df = df[(df[time_col] >= start_window) & (df[time_col] <= end_window)]
+        sliced[src["name"]] = df
+    return sliced
+
+
+def bin_sources_to_time_grid(data_dict: dict,
+                             time_grid: pd.DataFrame,
+                             start_window: pd.Timestamp,
+                             end_window: pd.Timestamp,
+                             filter_windows: bool = True) -> tuple:
+    """
+    Bin every source in mimic_iv_data_sources onto a time grid.
+    :param data_dict: Dictionary containing different events DataFrames.
+    :param time_grid: Target time grid with "time_point".
+    :param start_window: Window start used for consistency filtering.
+    :param end_window: Window end used for consistency filtering.
+    :param filter_windows: Apply filter_by_time_window_consistency per source (False if already filtered).
+    :return: Dictionary with binned time-series for each data type and list of messages.
+    """
+    results, messages = {}, []
     for src in mimic_iv_data_sources:
 
         df = data_dict.get(src["name"], pd.DataFrame())
         if df is not None and not df.empty:
             if src["datatype"] == "continuous":
-                df, message = filter_by_time_window_consistency(df=df,
-                                                                start_window=admit_time,
-                                                                end_window=discharge_time,
-                                                                start_event_col=src["start_col"],
-                                                                end_event_col=src["end_col"],
-                                                                adjust_start=True,
-                                                                adjust_end=True)
-                if message:
-                    messages.append(f"{src['name']} filter_by_time_window_consistency: {message}")
+                if filter_windows:
+                    df, message = filter_by_time_window_consistency(df=df,
+                                                                    start_window=start_window,
+                                                                    end_window=end_window,
+                                                                    start_event_col=src["start_col"],
+                                                                    end_event_col=src["end_col"],
+                                                                    adjust_start=True,
+                                                                    adjust_end=True)
+                    if message:
+                        messages.append(f"{src['name']} filter_by_time_window_consistency: {message}")
                 results[src["name"]] = continuous_to_ts(df=df,
                                                         time_grid=time_grid,
                                                         start_col=src["start_col"],
@@ -47,15 +231,16 @@ def generate_single_admission_time_series_data(data_dict: dict,
                                                         value_col=src["value_col"])
 
             elif src["datatype"] == "discrete":
-                df, message = filter_by_time_window_consistency(df=df,
-                                                                start_window=admit_time,
-                                                                end_window=discharge_time,
-                                                                start_event_col=src["time_col"],
-                                                                end_event_col=None,
-                                                                adjust_start=True,
-                                                                adjust_end=False)
-                if message:
-                    messages.append(f"{src['name']} filter_by_time_window_consistency: {message}")
+                if filter_windows:
+                    df, message = filter_by_time_window_consistency(df=df,
+                                                                    start_window=start_window,
+                                                                    end_window=end_window,
+                                                                    start_event_col=src["time_col"],
+                                                                    end_event_col=None,
+                                                                    adjust_start=True,
+                                                                    adjust_end=False)
+                    if message:
+                        messages.append(f"{src['name']} filter_by_time_window_consistency: {message}")
                 results[src["name"]] = discrete_to_ts(df.copy(),
                                                       time_column=src["time_col"],
                                                       time_grid=time_grid,
@@ -87,6 +272,25 @@ def create_time_grid(data_dict: dict,
     """
     admit_time = pd.to_datetime(data_dict["admittime"])
     discharge_time = pd.to_datetime(data_dict["dischtime"])
+    return create_time_grid_from_window(admit_time, discharge_time, time_resolution_hours, observation_window_hours)
+
+
+def create_time_grid_from_window(start_time: pd.Timestamp,
+                                 end_time: pd.Timestamp,
+                                 time_resolution_hours: float,
+                                 observation_window_hours: float | None
+                                 ) -> pd.DataFrame:
+    """
+    Create a regular time grid anchored at start_time.
+    :param start_time: Grid anchor (admission time, ICU intime, ...).
+    :param end_time: Episode end (discharge time, ICU outtime, ...).
+    :param time_resolution_hours: Spacing between grid points, in hours.
+    :param observation_window_hours: Length of observation window in hours. If None, extends until end_time.
+    :return: DataFrame with "time_point" > pd.Timestamp grid points and
+         "hours_from_admission" > elapsed hours since the anchor start
+    """
+    admit_time = pd.to_datetime(start_time)
+    discharge_time = pd.to_datetime(end_time)
 
     # Determine end time: earliest of observation window or discharge
     if observation_window_hours is not None:
@@ -129,44 +333,36 @@ def continuous_to_ts(df: pd.DataFrame,
         return time_grid
 
     ts_df = time_grid.copy()
-    df = df.copy()
-    df[start_col] = pd.to_datetime(df[start_col])
-    df[end_col] = pd.to_datetime(df[end_col]).fillna(
-        time_grid["time_point"].iloc[-1] + pd.Timedelta(hours=1))
-
-    # Initialize columns
-    cols = {}
-    for label in df[label_col].dropna().unique():
-        clean_name = clean_column_name(label)
-        cols[clean_name] = default_value
+    df = df.dropna(subset=[label_col])
 
-    # Add all columns at once
-    ts_df = pd.concat([ts_df, pd.DataFrame(cols, index=ts_df.index)], axis=1)
+    # Grid index range covered by each event, ends default to one hour past the grid
+    index = EventIntervalIndex(df, start_col, end_col, label_col,
+                               default_end=time_grid["time_point"].iloc[-1] + pd.Timedelta(hours=1))
+    positions, first, last = index.grid_ranges(time_grid["time_point"])
+    last = np.maximum(first, last)
 
-    # For each time point, mark active events
     # Build mapping from labels to cleaned column names
-    label_map = {label: clean_column_name(label) for label in df[label_col].unique()}
-
-    time_points = time_grid["time_point"].to_numpy()
-
-    for label, col in label_map.items():
-        # Choose dtype depending on whether a value_col is used
-        if value_col is None:
-            ts_df[col] = np.zeros(len(time_grid), dtype=np.int8)  # categorical presence
-        else:
-            ts_df[col] = np.zeros(len(time_grid), dtype=df[value_col].dtype)  # same dtype as source
+    label_codes, labels = pd.factorize(index.labels)
+    label_map = clean_column_names(labels)
+    clean_names = np.array([label_map[label] for label in labels], dtype=object)
+    codes, cols = pd.factorize(clean_names[label_codes])
+    n_bins = len(time_grid)
 
-    # For each event interval, fill in matching time indices
-    for _, row in df.iterrows():
-        start, end, label = row[start_col], row[end_col], row[label_col]
-        col = label_map[label]
+    if value_col is None:
+        # Interval coverage by difference arrays: +1 at event start bin, -1 after its last bin
+        coverage = np.zeros((n_bins + 1, len(cols)), dtype=np.int32)
+        np.add.at(coverage, (first, codes), 1)
+        np.add.at(coverage, (last, codes), -1)
+        values = (np.cumsum(coverage, axis=0)[:-1] > 0).astype(np.int8)  # categorical presence
+    else:
+        values = np.zeros((n_bins, len(cols)), dtype=df[value_col].dtype)  # same dtype as source
+        event_values = df[value_col].to_numpy()[positions]
+        # Later events overwrite earlier ones, as in source row order
+        for i in np.argsort(positions, kind="stable"):
+            values[first[i]:last[i], codes[i]] = event_values[i]
 
-        mask = (time_points >= start) & (time_points < end)
-        if value_col is None:
-            ts_df.loc[mask, col] = 1
-        else:
-            ts_df.loc[mask, col] = np.array(row[value_col], dtype=ts_df[col].dtype)
-    return ts_df
+    cols_df = pd.DataFrame(values, columns=list(cols), index=ts_df.index)
+    return pd.concat([ts_df, cols_df], axis=1)
 
 
 def discrete_to_ts(df: pd.DataFrame,
@@ -199,8 +395,9 @@ def discrete_to_ts(df: pd.DataFrame,
     grouped = (df.groupby([label_col, "bin"])[value_col]
                .agg(["mean", "count"])
                .reset_index())
+    label_map = clean_column_names(grouped[label_col].unique())
     for label, group in grouped.groupby(label_col):
-        clean_name = clean_column_name(label)
+        clean_name = label_map[label]
         mean_series = group.set_index("bin")["mean"].reindex(range(n_bins))
         count_series = group.set_index("bin")["count"].reindex(range(n_bins), fill_value=0)
 
@@ -234,9 +431,42 @@ def categorical_to_ts(df, time_grid, event_column, time_column):
     df["bin"] = pd.cut(df["time_point"], bins=bin_edges, labels=False, right=False)
     df_ts = time_grid.copy()
 
+    label_map = clean_column_names(df["label"].unique())
     for name in df["label"].unique():
-        df_ts[clean_column_name(name)] = 0
+        df_ts[label_map[name]] = 0
         bins_with_event = df[df["label"] == name]["bin"].dropna().astype(int)
-        df_ts.loc[bins_with_event, clean_column_name(name)] = 1
+        df_ts.loc[bins_with_event, label_map[name]] = 1
 
     return df_ts
+
+
+def binned_to_ts(binned: pd.DataFrame, time_grid: pd.DataFrame, datatype: str) -> pd.DataFrame:
+    """
+    Convert one admission of a binned long table (hadm_id, bin, label, value, n), e.g. from
+    bq_utils.get_binned_time_series_bq, to the columns the local binning functions produce.
+    :param binned: Binned rows of one admission and source.
+    :param time_grid: Admission time grid with "time_point".
+    :param datatype: Source datatype ("discrete", "continuous" or "categorical").
+    :return: Time-series DataFrame aligned to time_grid, as discrete_to_ts, continuous_to_ts or categorical_to_ts.
+    """
+    ts_df = time_grid.copy().reset_index(drop=True)
+    binned = binned.dropna(subset=["label"])
+    binned = binned[(binned["bin"] >= 0) & (binned["bin"] < len(ts_df))]
+    if binned.empty:
+        return ts_df
+
+    label_map = clean_column_names(binned["label"].unique())
+    names = binned["label"].map(label_map)
+    n_bins = len(ts_df)
+    new_cols = {}
+    for name, group in binned.groupby(names, sort=False):
+        if datatype == "discrete":
+            value = group.groupby("bin")["value"].mean().reindex(range(n_bins))
+            count = group.groupby("bin")["n"].sum().reindex(range(n_bins), fill_value=0)
+            new_cols[name] = value.to_numpy()
+            new_cols[f"{name}_present"] = (count > 0).astype(int).to_numpy()
+        else:
+            present = np.zeros(n_bins, dtype=np.int8)
+            present[group["bin"].astype(int).to_numpy()] = 1
+            new_cols[name] = present
+    return pd.concat([ts_df, pd.DataFrame(new_cols, index=ts_df.index)], axis=1)
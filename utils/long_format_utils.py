@@ -0,0 +1,280 @@
+import numpy as np
+import pandas as pd
+from config.project_config import mimic_iv_data_sources
+from utils.data_utils import (clean_column_names, date_and_time_to_datetime, adjust_cohort_admittimes,
+                              filter_cohort_by_time_window_consistency)
+
+# Canonical long-format event table: one row per observed (admission, bin, feature)
+LONG_DTYPES = {"hadm_id": "int32", "bin": "int32", "feature_id": "int32", "value": "float32"}
+
+
+def cohort_events_to_long(admissions_data: dict,
+                          time_resolution_hours: float,
+                          observation_window_hours: float | None = None,
+                          windows: pd.DataFrame | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Convert every source of a cohort into the canonical long table (hadm_id, bin, feature_id, value).
+    Bins follow create_time_grid: bin k starts at admittime + k * resolution, the last bin holds dischtime
+    (or the end of the observation window). Discrete sources keep the bin mean, continuous sources
+    are expanded to every bin they are active in and categorical sources are marked present (value 1).
+    :param admissions_data: Cohort dictionary from extract_admissions_data(..., return_as_cohort=True).
+    :param time_resolution_hours: Bin width in hours.
+    :param observation_window_hours: Max hours per admission (None for full stay).
+    :param windows: Output of adjust_cohort_admittimes, computed if None.
+    :return: long events DataFrame, features DataFrame (feature_id, source, feature).
+    """
+    if windows is None:
+        windows = adjust_cohort_admittimes(admissions_data)
+    windows = windows[~windows["qc_failed"]]
+    filtered, _ = filter_cohort_by_time_window_consistency(admissions_data, windows,
+                                                           start_window_col="adjusted_admittime")
+
+    grid_start, n_bins = _time_grid(windows, time_resolution_hours, observation_window_hours)
+    resolution = pd.Timedelta(hours=time_resolution_hours)
+
+    parts, features = [], []
+    for src in mimic_iv_data_sources:
+        df = filtered.get(src["name"])
+        if df is None or df.empty or src["label_col"] not in df.columns:
+            continue
+        df = df[df["hadm_id"].isin(grid_start.index)].dropna(subset=[src["label_col"]])
+        if df.empty:
+            continue
+
+        label_map = clean_column_names(df[src["label_col"]].unique())
+        names = pd.unique(pd.Series(list(label_map.values())))
+        offset = len(features)
+        features.extend((src["name"], name) for name in names)
+        name_ids = pd.Series(np.arange(offset, offset + len(names)), index=names)
+        df = df.assign(feature_id=df[src["label_col"]].map(label_map).map(name_ids).to_numpy())
+
+        part = _source_rows(df, src, grid_start, n_bins, resolution)
+        if src["datatype"] != "continuous":
+            how = "mean" if src["datatype"] == "discrete" else "max"
+            part = part.groupby(["hadm_id", "bin", "feature_id"], as_index=False, sort=False)["value"].agg(how)
+        parts.append(part)
+
+    long_df = (pd.concat(parts, ignore_index=True) if parts
+               else pd.DataFrame(columns=list(LONG_DTYPES)))
+    long_df = long_df.astype(LONG_DTYPES).sort_values(["hadm_id", "bin", "feature_id"], ignore_index=True)
+    features_df = pd.DataFrame(features, columns=["source", "feature"]).rename_axis("feature_id").reset_index()
+    features_df = features_df.astype({"feature_id": "int32", "source": "category"})
+    return long_df, features_df
+
+
+class StreamingLongFormatBuilder:
+    """
+    Incremental cohort_events_to_long for sources arriving in batches (e.g. streamed query results):
+    every batch is filtered to its admission window, binned and pre-aggregated as it arrives
+    (sum and count for discrete sources, distinct rows otherwise), so memory holds the binned rows,
+    not the raw events. Feature ids are assigned in arrival order.
+
+    Usage:
+        builder = StreamingLongFormatBuilder(windows, time_resolution_hours=1)
+        for batch in batches:
+            builder.add("labs", batch)
+        long_df, features = builder.result()
+    """
+
+    def __init__(self,
+                 windows: pd.DataFrame,
+                 time_resolution_hours: float,
+                 observation_window_hours: float | None = None,
+                 compact_rows: int = 5_000_000):
+        """
+        :param windows: Output of adjust_cohort_admittimes (events before adjusted_admittime are dropped).
+        :param time_resolution_hours: Bin width in hours.
+        :param observation_window_hours: Max hours per admission (None for full stay).
+        :param compact_rows: Re-aggregate the buffered parts of a source once they hold more rows.
+        """
+        self.windows = windows[~windows["qc_failed"]]
+        self.grid_start, self.n_bins = _time_grid(self.windows, time_resolution_hours, observation_window_hours)
+        self.resolution = pd.Timedelta(hours=time_resolution_hours)
+        self.compact_rows = compact_rows
+        self.sources = {src["name"]: src for src in mimic_iv_data_sources}
+        self.features = []
+        self._feature_ids = {}  # (source, name) -> feature_id
+        self._label_names = {}  # source -> {label: name}
+        self._parts = {}
+        self.rows_in = 0
+
+    def add(self, source_name: str, df: pd.DataFrame):
+        """
+        Bin one batch of raw events of a source.
+        :param source_name: Name in mimic_iv_data_sources.
+        :param df: Raw events batch (same columns as the extracted source).
+        """
+        src = self.sources[source_name]
+        self.rows_in += len(df)
+        if df.empty or src["label_col"] not in df.columns:
+            return
+        df = filter_cohort_by_time_window_consistency({source_name: df}, self.windows,
+                                                      start_window_col="adjusted_admittime")[0][source_name]
+        df = df[df["hadm_id"].isin(self.grid_start.index)].dropna(subset=[src["label_col"]])
+        if df.empty:
+            return
+
+        names = self._label_names.setdefault(source_name, {})
+        new_labels = [label for label in df[src["label_col"]].unique() if label not in names]
+        if new_labels:
+            # Labels colliding with a name of an earlier batch are suffixed, earlier names are kept
+            names.update(clean_column_names(new_labels, assigned=names))
+            for name in pd.unique(pd.Series([names[label] for label in new_labels])):
+                if (source_name, name) not in self._feature_ids:
+                    self._feature_ids[(source_name, name)] = len(self.features)
+                    self.features.append((source_name, name))
+        label_ids = {label: self._feature_ids[(source_name, name)] for label, name in names.items()}
+        df = df.assign(feature_id=df[src["label_col"]].map(label_ids).to_numpy())
+
+        parts = self._parts.setdefault(source_name, [])
+        parts.append(self._aggregate(_source_rows(df, src, self.grid_start, self.n_bins, self.resolution),
+                                     src["datatype"]))
+        if sum(len(part) for part in parts) > self.compact_rows:
+            self._parts[source_name] = [self._combine(parts, src["datatype"])]
+
+    @staticmethod
+    def _aggregate(part: pd.DataFrame, datatype: str) -> pd.DataFrame:
+        """Per-batch partial aggregate: value sum and count for discrete sources, distinct rows otherwise."""
+        keys = ["hadm_id", "bin", "feature_id"]
+        if datatype == "discrete":
+            return part.groupby(keys, as_index=False, sort=False).agg(value=("value", "sum"), n=("value", "size"))
+        return part.drop_duplicates(subset=keys)
+
+    @staticmethod
+    def _combine(parts: list, datatype: str) -> pd.DataFrame:
+        """Merge partial aggregates of several batches."""
+        keys = ["hadm_id", "bin", "feature_id"]
+        part = pd.concat(parts, ignore_index=True)
+        if datatype == "discrete":
+            return part.groupby(keys, as_index=False, sort=False)[["value", "n"]].sum()
+        return part.drop_duplicates(subset=keys)
+
+    def result(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        :return: long events DataFrame, features DataFrame (feature_id, source, feature), as cohort_events_to_long.
+        """
+        parts = []
+        for source_name, source_parts in self._parts.items():
+            part = self._combine(source_parts, self.sources[source_name]["datatype"])
+            if "n" in part.columns:
+                part = part.assign(value=part["value"] / part["n"]).drop(columns=["n"])
+            parts.append(part)
+        long_df = (pd.concat(parts, ignore_index=True) if parts
+                   else pd.DataFrame(columns=list(LONG_DTYPES)))
+        long_df = long_df.astype(LONG_DTYPES).sort_values(["hadm_id", "bin", "feature_id"], ignore_index=True)
+        features_df = pd.DataFrame(self.features, columns=["source", "feature"]).rename_axis("feature_id").reset_index()
+        features_df = features_df.astype({"feature_id": "int32", "source": "category"})
+        return long_df, features_df
+
+
+def _time_grid(windows: pd.DataFrame,
+               time_resolution_hours: float,
+               observation_window_hours: float | None = None) -> tuple[pd.Series, pd.Series]:
+    """Grid start (admittime) and number of bins per hadm_id, as in create_time_grid."""
+    resolution = pd.Timedelta(hours=time_resolution_hours)
+    grid = windows.set_index("hadm_id")
+    duration = grid["dischtime"] - grid["admittime"]
+    if observation_window_hours is not None:
+        duration = duration.clip(upper=pd.Timedelta(hours=observation_window_hours))
+    return grid["admittime"], (duration // resolution).astype(int) + 1
+
+
+def _source_rows(df: pd.DataFrame,
+                 src: dict,
+                 grid_start: pd.Series,
+                 n_bins: pd.Series,
+                 resolution: pd.Timedelta) -> pd.DataFrame:
+    """
+    Long rows (hadm_id, bin, feature_id, value) of one source inside the grid, before aggregation:
+    continuous events are expanded to one row per active bin (deduplicated), discrete and categorical
+    events keep one row per event.
+    :param df: Source events with a feature_id column.
+    """
+    start = df["hadm_id"].map(grid_start)
+    hadm_ids = df["hadm_id"].to_numpy()
+    if src["datatype"] == "continuous":
+        starts = pd.to_datetime(df[src["start_col"]])
+        ends = pd.to_datetime(df[src["end_col"]])
+        # Active at grid point k when start <= point < end
+        first = np.ceil((starts - start) / resolution).to_numpy()
+        last = np.ceil((ends - start) / resolution).fillna(np.inf).to_numpy()
+        return _expand_intervals(hadm_ids, df["feature_id"].to_numpy(), first, last,
+                                 df["hadm_id"].map(n_bins).to_numpy())
+
+    time_col = src["time_col"]
+    df = date_and_time_to_datetime(df, time_col)
+    bins = np.floor((df[time_col] - df["hadm_id"].map(grid_start)) / resolution)
+    value = df[src["value_col"]] if src["datatype"] == "discrete" else 1.0
+    part = pd.DataFrame({"hadm_id": df["hadm_id"].to_numpy(),
+                         "bin": bins.to_numpy(),
+                         "feature_id": df["feature_id"].to_numpy(),
+                         "value": pd.to_numeric(value, errors="coerce") if src["datatype"] == "discrete"
+                         else value})
+    return part[(part["bin"] >= 0) & (part["bin"] < part["hadm_id"].map(n_bins))].dropna(subset=["value"])
+
+
+def _expand_intervals(hadm_ids, feature_ids, first, last, n_bins) -> pd.DataFrame:
+    """Expand [first, last) bin ranges of interval events into one row per active bin."""
+    first = np.clip(first, 0, None)
+    last = np.minimum(last, n_bins)
+    lengths = np.clip(last - first, 0, None).astype(np.int64)
+    first = first.astype(np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    # Position of every expanded row inside its interval
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    part = pd.DataFrame({"hadm_id": hadm_ids[rows],
+                         "bin": first[rows] + within,
+                         "feature_id": feature_ids[rows],
+                         "value": 1.0})
+    return part.drop_duplicates(subset=["hadm_id", "bin", "feature_id"])
+
+
+def long_to_wide(long_df: pd.DataFrame,
+                 features: pd.DataFrame,
+                 hadm_id: int,
+                 time_resolution_hours: float,
+                 n_bins: int | None = None) -> pd.DataFrame:
+    """
+    Pivot one admission of the long table back to the wide per-admission frame.
+    :param long_df: Long events table.
+    :param features: Features table (feature_id, source, feature).
+    :param hadm_id: Hospital admission ID.
+    :param time_resolution_hours: Bin width used to build the long table.
+    :param n_bins: Number of bins, default the last observed bin + 1.
+    :return: DataFrame with hours_from_admission and one column per observed feature.
+    """
+    rows = long_df[long_df["hadm_id"] == hadm_id]
+    if n_bins is None:
+        n_bins = int(rows["bin"].max()) + 1 if not rows.empty else 0
+    wide = rows.pivot_table(index="bin", columns="feature_id", values="value", aggfunc="first")
+    wide = wide.reindex(range(n_bins))
+    wide.columns = features.set_index("feature_id").loc[wide.columns, "feature"].to_numpy()
+    wide.insert(0, "hours_from_admission", np.arange(n_bins) * time_resolution_hours)
+    return wide.reset_index(drop=True)
+
+
+def long_to_tensor(long_df: pd.DataFrame,
+                   features: pd.DataFrame,
+                   hadm_ids: list | None = None,
+                   n_bins: int | None = None) -> tuple:
+    """
+    Scatter the long table into a dense (admission, bin, feature) tensor.
+    :param long_df: Long events table.
+    :param features: Features table (feature_id, source, feature).
+    :param hadm_ids: Admissions (tensor order), default all admissions in long_df.
+    :param n_bins: Number of bins, longer admissions are truncated, default the longest admission.
+    :return: values float32 array with NaN where unobserved, boolean observation mask, hadm_ids array.
+    """
+    if hadm_ids is None:
+        hadm_ids = np.sort(long_df["hadm_id"].unique())
+    hadm_ids = np.asarray(hadm_ids)
+    if n_bins is None:
+        n_bins = int(long_df["bin"].max()) + 1 if not long_df.empty else 0
+
+    position = pd.Series(np.arange(len(hadm_ids)), index=hadm_ids)
+    rows = long_df[long_df["hadm_id"].isin(hadm_ids) & (long_df["bin"] < n_bins)]
+    a = position.loc[rows["hadm_id"].to_numpy()].to_numpy()
+
+    values = np.full((len(hadm_ids), n_bins, len(features)), np.nan, dtype=np.float32)
+    values[a, rows["bin"].to_numpy(), rows["feature_id"].to_numpy()] = rows["value"].to_numpy()
+    return values, ~np.isnan(values), hadm_ids
@@ -0,0 +1,192 @@
+import shutil
+from pathlib import Path
+from os.path import join
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from utils.data_utils import collect_patient_admission_data
+# pip install pyarrow
+
+
+class AdmissionParquetWriter:
+    """
+    Appends admissions to a partitioned Parquet dataset instead of two CSV files per admission.
+
+    Layout: <dataset_path>/<table>/hadm_bucket=<hadm_id % n_buckets>/part-<flush>.parquet
+    with tables "static" (one row per admission) and "dynamic" (long or wide binned time-series).
+    Admissions are buffered and written every batch_size admissions, rows are sorted by hadm_id so
+    row group statistics let read_admission skip everything but the matching row groups.
+    """
+
+    def __init__(self,
+                 dataset_path: str,
+                 dynamic_format: str = "long",
+                 batch_size: int = 256,
+                 row_group_size: int = 128_000,
+                 n_buckets: int = 64,
+                 compression: str = "zstd"):
+        """
+        :param dataset_path: Folder of the Parquet dataset.
+        :param dynamic_format: "long" (hadm_id, hours_from_admission, feature, value) or "wide" (one column per feature).
+        :param batch_size: Number of admissions buffered before a write.
+        :param row_group_size: Max rows per Parquet row group.
+        :param n_buckets: Number of hadm_id hash partitions.
+        :param compression: Parquet compression codec.
+        """
+        if dynamic_format not in ("long", "wide"):
+            raise ValueError(f"Unknown dynamic_format: {dynamic_format}")
+        self.dataset_path = dataset_path
+        self.dynamic_format = dynamic_format
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size
+        self.n_buckets = n_buckets
+        self.compression = compression
+        self._static, self._dynamic = [], []
+        self._flushes = self._next_flush_number()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_admission(self, data: dict):
+        """
+        Buffer one admission (same dictionary as collect_and_save_patient_admission_data).
+        :param data: Admission dictionary with demographics, diagnoses, time_grid and binned sources.
+        """
+        static_df, dynamic_df = collect_patient_admission_data(data)
+        static_df["hadm_id"] = data["hadm_id"]
+        dynamic_df = dynamic_df.drop(columns=["time_point"])
+        if self.dynamic_format == "long":
+            dynamic_df = (dynamic_df.melt(id_vars="hours_from_admission", var_name="feature", value_name="value")
+                          .dropna(subset=["value"]))
+            dynamic_df["value"] = pd.to_numeric(dynamic_df["value"], errors="coerce")
+        dynamic_df.insert(0, "hadm_id", data["hadm_id"])
+
+        self._static.append(static_df)
+        self._dynamic.append(dynamic_df)
+        if len(self._static) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered admissions, one file per touched bucket."""
+        if not self._static:
+            return
+        for table, frames in (("static", self._static), ("dynamic", self._dynamic)):
+            df = pd.concat(frames, ignore_index=True)
+            df["hadm_bucket"] = df["hadm_id"] % self.n_buckets
+            for bucket, part in df.groupby("hadm_bucket"):
+                part = part.drop(columns=["hadm_bucket"]).sort_values("hadm_id", kind="stable")
+                folder = Path(self.dataset_path, table, f"hadm_bucket={bucket}")
+                folder.mkdir(parents=True, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(part, preserve_index=False),
+                               join(folder, f"part-{self._flushes:05d}.parquet"),
+                               row_group_size=self.row_group_size,
+                               compression=self.compression)
+        self._flushes += 1
+        self._static, self._dynamic = [], []
+
+    def close(self):
+        self.flush()
+
+    def _next_flush_number(self) -> int:
+        """Continue numbering after existing files so reopening a dataset appends to it."""
+        existing = list(Path(self.dataset_path).glob("*/hadm_bucket=*/part-*.parquet"))
+        if not existing:
+            return 0
+        return max(int(f.stem.split("-")[1]) for f in existing) + 1
+
+
+def save_admissions_parquet(admissions_by_hadm_id: dict, dataset_path: str, **writer_kwargs):
+    """
+    Write binned admissions (e.g. output of generate_cohort_time_series_data) to a Parquet dataset.
+    :param admissions_by_hadm_id: Dictionary {hadm_id: admission dictionary}.
+    :param dataset_path: Folder of the Parquet dataset.
+    :param writer_kwargs: AdmissionParquetWriter arguments.
+    """
+    with AdmissionParquetWriter(dataset_path, **writer_kwargs) as writer:
+        for data in admissions_by_hadm_id.values():
+            writer.add_admission(data)
+
+
+def read_admission(dataset_path: str, hadm_id: int, table: str = "dynamic", n_buckets: int = 64) -> pd.DataFrame:
+    """
+    Fetch a single admission back by hadm_id. Only files in its bucket are opened and
+    row groups whose hadm_id statistics exclude it are skipped.
+    :param dataset_path: Folder of the Parquet dataset.
+    :param hadm_id: Hospital admission ID.
+    :param table: "static", "dynamic" or "events" (long events table).
+    :param n_buckets: Number of hadm_id hash partitions used when writing.
+    :return: DataFrame with the admission rows.
+    """
+    folder = Path(dataset_path, table, f"hadm_bucket={hadm_id % n_buckets}")
+    files = sorted(str(f) for f in folder.glob("part-*.parquet"))
+    if not files:
+        return pd.DataFrame()
+    # Wide tables have a different column set per batch
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    dataset = ds.dataset(files, schema=schema, format="parquet")
+    return dataset.to_table(filter=ds.field("hadm_id") == hadm_id).to_pandas()
+
+
+def read_dataset(dataset_path: str, table: str = "static", columns: list | None = None) -> pd.DataFrame:
+    """
+    Scan a whole table of the dataset (e.g. all static rows for cohort analysis).
+    :param dataset_path: Folder of the Parquet dataset.
+    :param table: "static" or "dynamic".
+    :param columns: Columns to read, default all.
+    :return: DataFrame.
+    """
+    files = sorted(str(f) for f in Path(dataset_path, table).glob("hadm_bucket=*/part-*.parquet"))
+    if not files:
+        return pd.DataFrame()
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    return ds.dataset(files, schema=schema, format="parquet").to_table(columns=columns).to_pandas()
+
+
+def save_long_events_parquet(long_df: pd.DataFrame,
+                             features: pd.DataFrame,
+                             dataset_path: str,
+                             n_buckets: int = 64,
+                             row_group_size: int = 128_000,
+                             compression: str = "zstd"):
+    """
+    Write the canonical long events table (see long_format_utils) with the same hadm_id bucketing as
+    AdmissionParquetWriter, plus the features table, so read_admission(..., table="events") works on it.
+    The events folder of an earlier call is replaced.
+    :param long_df: Long events table (hadm_id, bin, feature_id, value).
+    :param features: Features table (feature_id, source, feature).
+    :param dataset_path: Folder of the Parquet dataset.
+    :param n_buckets: Number of hadm_id hash partitions.
+    :param row_group_size: Max rows per Parquet row group.
+    :param compression: Parquet compression codec.
+    """
+    Path(dataset_path).mkdir(parents=True, exist_ok=True)
+    # Replace the events of a previous run, buckets absent from long_df would otherwise still be read
+    shutil.rmtree(Path(dataset_path, "events"), ignore_errors=True)
+    pq.write_table(pa.Table.from_pandas(features, preserve_index=False), join(dataset_path, "features.parquet"))
+    for bucket, part in long_df.groupby(long_df["hadm_id"] % n_buckets):
+        folder = Path(dataset_path, "events", f"hadm_bucket={bucket}")
+        folder.mkdir(parents=True, exist_ok=True)
+        pq.write_table(pa.Table.from_pandas(part.sort_values(["hadm_id", "bin"]), preserve_index=False),
+                       join(folder, "part-00000.parquet"),
+                       row_group_size=row_group_size,
+                       compression=compression)
+
+
+def read_extracted_source(dataset_path: str, source: str, columns: list | None = None) -> pd.DataFrame:
+    """
+    Read one source written by bq_utils.extract_admissions_data_bq_batched.
+    :param dataset_path: Folder of the Parquet sink.
+    :param source: Source name, e.g. "labs".
+    :param columns: Columns to read, default all.
+    :return: DataFrame with the rows of all batches.
+    """
+    files = sorted(str(f) for f in Path(dataset_path, source).glob("part-*.parquet"))
+    if not files:
+        return pd.DataFrame()
+    # A column that is all NULL in one batch has a different type there
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    return ds.dataset(files, schema=schema, format="parquet").to_table(columns=columns).to_pandas()
@@ -4,19 +4,22 @@ from config.project_config import (patients_columns, vitals_keywords, transfers_
                                    diagnoses_icd_columns, d_icd_diagnoses_columns,
                                    procedureevents_columns, d_items_columns, procedures_icd_columns,
                                    d_icd_procedures_columns, prescriptions_columns, emar_columns, inputevents_columns,
-                                   labevents_columns, d_labitems_columns, icustays_columns, chartevents_columns)
+                                   labevents_columns, d_labitems_columns, icustays_columns, chartevents_columns,
+                                   age_group_bins, age_group_labels)
 
 
 def build_admissions_query(project_id: str,
                            dataset_id: str,
                            available_demographics: List[str],
-                           hadm_ids: int | list | None) -> str:
+                           hadm_ids: int | list | None,
+                           cohort_table: str | None = None) -> str:
     """
     Defines query for single or multiple admissions from BigQuery.
     :param project_id: BigQuery project name.
     :param dataset_id: BigQuery dataset name.
     :param available_demographics: list of available columns in the patients table.
     :param hadm_ids: Can be int for single admission, list for multiple admissions, None for all admissions.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     selected_demographics = [col for col in patients_columns if col in available_demographics]
@@ -36,8 +39,7 @@ def build_admissions_query(project_id: str,
         admissions_query = f"""SELECT  a.*,  
                             {demographics_str} 
                             FROM `{project_id}.{dataset_id}.admissions` AS a
-                            JOIN UNNEST(@hadm_ids) AS hadm_id
-                            ON a.hadm_id = hadm_id
+                            {build_cohort_join("a.hadm_id", cohort_table)}
                             LEFT JOIN `{project_id}.{dataset_id}.patients` AS p
                             ON a.subject_id = p.subject_id
                         """
@@ -49,7 +51,8 @@ def build_vitals_query(project_id: str,
                        available_icustays: list[str],
                        available_chartevents: list[str],
                        available_d_items,
-                       hadm_ids: list[str]) -> str:
+                       hadm_ids: list[str],
+                       cohort_table: str | None = None) -> str:
     """
     Defines query for recorded vital signs data.
     :param project_id: BigQuery project name.
@@ -58,13 +61,14 @@ def build_vitals_query(project_id: str,
     :param available_chartevents: list of available columns in the chartevents table.
     :param available_d_items: list of available column sin the d_items table.
     :param hadm_ids: list of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     events_str = prepare_column_string(available_chartevents,
                                        chartevents_columns,
                                        available_d_items,
                                        d_items_columns)
-    times_str = ", ".join([f"stays.{col}" for col in icustays_columns if col in available_icustays])
+    times_str = ", ".join([f"times.{col}" for col in icustays_columns if col in available_icustays])
     cols_str = ", ".join([events_str, times_str])
 
     # escape non-alphanumeric characters
@@ -77,8 +81,7 @@ def build_vitals_query(project_id: str,
             ON times.hadm_id = event.hadm_id
             JOIN `{project_id}.{dataset_id}.d_items` AS event_desc
                 ON event.itemid = event_desc.itemid
-            JOIN UNNEST(@hadm_ids) AS hadm_id
-                ON event.hadm_id = hadm_id
+            {build_cohort_join("event.hadm_id", cohort_table)}
             WHERE event_desc.label IS NOT NULL
                 AND REGEXP_CONTAINS(event_desc.label, '(?i){vitals_pattern}')
             """
@@ -89,7 +92,8 @@ def build_labs_query(project_id: str,
                      dataset_id: str,
                      available_labs: list[str],
                      available_d_labitems: list[str],
-                     hadm_ids: list[str]):
+                     hadm_ids: list[str],
+                     cohort_table: str | None = None):
     """
     Defines query for lab tests results.
     :param project_id: BigQuery project name.
@@ -97,6 +101,7 @@ def build_labs_query(project_id: str,
     :param available_labs: list of available columns in the labevents table.
     :param available_d_labitems: list of available columns in the d_labitems table.
     :param hadm_ids: List of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     cols_str = prepare_column_string(available_labs,
@@ -107,8 +112,7 @@ def build_labs_query(project_id: str,
                 FROM `{project_id}.{dataset_id}.labevents` AS  event
                 JOIN `{project_id}.{dataset_id}.d_labitems` AS event_desc 
                 ON event.itemid = event_desc.itemid
-                JOIN UNNEST(@hadm_ids) AS hadm_id
-                ON event.hadm_id = hadm_id
+                {build_cohort_join("event.hadm_id", cohort_table)}
             """
     return query
 
@@ -117,7 +121,8 @@ def build_infusions_query(project_id: str,
                           dataset_id: str,
                           available_inputevents: List[str],
                           available_d_items: List[str],
-                          hadm_ids: List[int]) -> str:
+                          hadm_ids: List[int],
+                          cohort_table: str | None = None) -> str:
     """
     Defines query for infusions medications.
     :param project_id: BigQuery project name.
@@ -125,6 +130,7 @@ def build_infusions_query(project_id: str,
     :param available_inputevents: list of available columns in the inputevents table.
     :param available_d_items: list of available columns in the d_items table.
     :param hadm_ids: List of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     cols_str = prepare_column_string(available_inputevents,
@@ -139,8 +145,7 @@ def build_infusions_query(project_id: str,
                     FROM `{project_id}.{dataset_id}.inputevents` AS event
                     JOIN `{project_id}.{dataset_id}.d_items` AS event_desc
                     ON event.itemid = event_desc.itemid
-                    JOIN UNNEST(@hadm_ids) AS hadm_id
-                    ON event.hadm_id = hadm_id
+                    {build_cohort_join("event.hadm_id", cohort_table)}
                     """
     return infusions_query
 
@@ -148,22 +153,23 @@ def build_infusions_query(project_id: str,
 def build_emar_query(project_id: str,
                      dataset_id: str,
                      available_emar: List[str],
-                     hadm_ids: List[int]) -> str:
+                     hadm_ids: List[int],
+                     cohort_table: str | None = None) -> str:
     """
     Defines query for EMAR records medications .
     :param project_id: BigQuery project name.
     :param dataset_id: BigQuery dataset name.
     :param available_emar: list of available columns in the emar table.
     :param hadm_ids: list of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
      """
     selected = [c for c in emar_columns if c in available_emar]
     cols_str = ", ".join([f"em.{col}" for col in selected])
     emar_query = f"""SELECT {cols_str}
                  FROM `{project_id}.{dataset_id}.emar` as em
+                 {build_cohort_join("em.hadm_id", cohort_table)}
                  WHERE medication IS NOT NULL
-                 JOIN UNNEST(@hadm_ids) AS hadm_id
-                 ON em.hadm_id = hadm_id
                  """
     return emar_query
 
@@ -171,22 +177,23 @@ def build_emar_query(project_id: str,
 def build_prescriptions_query(project_id: str,
                               dataset_id: str,
                               available_prescriptions: List[str],
-                              hadm_ids: List[int]) -> str:
+                              hadm_ids: List[int],
+                              cohort_table: str | None = None) -> str:
     """
     Defines query for prescriptions medications.
     :param project_id: BigQuery project name.
     :param dataset_id: BigQuery dataset name.
     :param available_prescriptions: list of available columns in the prescriptions table.
     :param hadm_ids: list of terget hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     selected = [c for c in prescriptions_columns if c in available_prescriptions]
     cols_str = ", ".join([f"pr.{col}" for col in selected])
-    prescriptions_query = f"""SELECT {cols_str}
+    prescriptions_query = f"""SELECT {cols_str},
                           CONCAT(drug, ' ', CAST(dose_val_rx AS STRING), ' ', dose_unit_rx) as label
                           FROM `{project_id}.{dataset_id}.prescriptions` AS pr
-                          JOIN UNNEST(@hadm_ids) AS hadm_id
-                          ON pr.hadm_id = hadm_id
+                          {build_cohort_join("pr.hadm_id", cohort_table)}
                           """
     return prescriptions_query
 
@@ -195,7 +202,8 @@ def build_procedures_query(project_id: str,
                            dataset_id: str,
                            available_procedures: List[str],
                            available_d_icd_procedures: List[str],
-                           hadm_ids: List[int]) -> str:
+                           hadm_ids: List[int],
+                           cohort_table: str | None = None) -> str:
     """
     Defines query for hospital procedures.
     :param project_id: BigQuery project name.
@@ -203,6 +211,7 @@ def build_procedures_query(project_id: str,
     :param available_procedures: list of available columns in the procedures_icd table.
     :param available_d_icd_procedures: list of available columns in the d_icd_procedures table.
     :param hadm_ids: list of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     cols_str = prepare_column_string(available_procedures,
@@ -214,8 +223,7 @@ def build_procedures_query(project_id: str,
                 JOIN `{project_id}.{dataset_id}.d_icd_procedures` event_desc 
                     ON event.icd_code = event_desc.icd_code 
                     AND event.icd_version = event_desc.icd_version
-                JOIN UNNEST(@hadm_ids) AS hadm_id
-                ON event.hadm_id = hadm_id
+                {build_cohort_join("event.hadm_id", cohort_table)}
                 """
     return query
 
@@ -224,7 +232,8 @@ def build_icu_procedures_query(project_id: str,
                                dataset_id: str,
                                available_procedureevents: List[str],
                                available_d_items: List[str],
-                               hadm_ids: List[int]) -> str:
+                               hadm_ids: List[int],
+                               cohort_table: str | None = None) -> str:
     """
     Defines query for ICU stays procedures.
     :param project_id: BigQuery project name.
@@ -232,22 +241,182 @@ def build_icu_procedures_query(project_id: str,
     :param available_procedureevents: list of available columns in the procedureevents table.
     :param available_d_items: list of available columns in the d_items table.
     :param hadm_ids: list of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     cols_str = prepare_column_string(available_procedureevents,
                                      procedureevents_columns,
                                      available_d_items,
                                      d_items_columns)
-    query = f"""SELECT {cols_str}
+    query = f"""SELECT {cols_str},
                 CONCAT(event_desc.label, ' ', CAST(event.value AS STRING), ' ', event.valueuom) as label_full
                 FROM `{project_id}.{dataset_id}.procedureevents` event
-                JOIN `{project_id}.{dataset_id}.d_items` event_desc ON event.itemid = di.itemid
-                JOIN UNNEST(@hadm_ids) AS hadm_id
-                ON event.hadm_id = hadm_id
+                JOIN `{project_id}.{dataset_id}.d_items` event_desc ON event.itemid = event_desc.itemid
+                {build_cohort_join("event.hadm_id", cohort_table)}
                """
     return query
 
 
+def build_time_grid_query(project_id: str,
+                          dataset_id: str,
+                          time_resolution_hours: float,
+                          observation_window_hours: float | None = None,
+                          cohort_table: str | None = None) -> str:
+    """
+    Defines the time grid of every cohort admission, as create_time_grid does locally:
+    bin k starts at admittime + k * resolution, the last bin holds dischtime (or the end of the observation window).
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param time_resolution_hours: Bin width in hours.
+    :param observation_window_hours: Max hours per admission (None for full stay).
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
+    :return: sql query with hadm_id, grid_start and n_bins columns.
+    """
+    resolution_seconds = int(round(time_resolution_hours * 3600))
+    end_time = "TIMESTAMP(a.dischtime)"
+    if observation_window_hours is not None:
+        end_time = (f"LEAST({end_time}, TIMESTAMP_ADD(TIMESTAMP(a.admittime), "
+                    f"INTERVAL {int(round(observation_window_hours * 3600))} SECOND))")
+    query = f"""SELECT a.hadm_id,
+                    TIMESTAMP(a.admittime) AS grid_start,
+                    DIV(TIMESTAMP_DIFF({end_time}, TIMESTAMP(a.admittime), SECOND), {resolution_seconds}) + 1 AS n_bins
+                FROM `{project_id}.{dataset_id}.admissions` AS a
+                {build_cohort_join("a.hadm_id", cohort_table)}
+                WHERE a.dischtime >= a.admittime
+                """
+    return query
+
+
+def build_binned_source_query(events_query: str,
+                              source: dict,
+                              grid_query: str,
+                              time_resolution_hours: float) -> str:
+    """
+    Wraps a source events query (e.g. build_labs_query) so BigQuery returns the binned long table
+    instead of raw events: one row per (hadm_id, bin, label) with
+      discrete sources: mean and count of the values in the bin (TIMESTAMP_DIFF bucket),
+      categorical sources: presence (value 1) in the bin of the event time,
+      continuous sources: presence in every bin the interval is active in (GENERATE_ARRAY over bins,
+      active at bin k when start <= grid point k < end), intervals starting before admittime are active
+      from bin 0 as with the adjusted admittime of cohort_events_to_long, intervals without an end time
+      are dropped (date_and_time_to_datetime drops missing times).
+    :param events_query: Source events query, must return hadm_id and the source time/label/value columns.
+    :param source: Source entry of mimic_iv_data_sources.
+    :param grid_query: Time grid query from build_time_grid_query.
+    :param time_resolution_hours: Bin width in hours.
+    :return: sql query with hadm_id, bin, label, value and n columns.
+    """
+    resolution_seconds = int(round(time_resolution_hours * 3600))
+    label = f"e.{source['label_col']}"
+
+    if source["datatype"] == "continuous":
+        start = _event_timestamp(source["start_col"])
+        end = _event_timestamp(source["end_col"])
+        first = f"CAST(CEIL(TIMESTAMP_DIFF({start}, g.grid_start, SECOND) / {resolution_seconds}) AS INT64)"
+        last = f"CAST(CEIL(TIMESTAMP_DIFF({end}, g.grid_start, SECOND) / {resolution_seconds}) AS INT64)"
+        binned = f"""SELECT e.hadm_id, bin, {label} AS label, 1.0 AS value
+                     FROM events AS e
+                     JOIN grid AS g ON e.hadm_id = g.hadm_id
+                     CROSS JOIN UNNEST(GENERATE_ARRAY(GREATEST({first}, 0),
+                                                      LEAST({last}, g.n_bins) - 1)) AS bin
+                     WHERE {label} IS NOT NULL
+                        AND {end} IS NOT NULL"""
+        aggregate = "MAX(value) AS value, COUNT(*) AS n"
+    else:
+        time = _event_timestamp(source["time_col"])
+        bucket = f"CAST(FLOOR(TIMESTAMP_DIFF({time}, g.grid_start, SECOND) / {resolution_seconds}) AS INT64)"
+        value = f"CAST(e.{source['value_col']} AS FLOAT64)" if source["datatype"] == "discrete" else "1.0"
+        binned = f"""SELECT e.hadm_id, {bucket} AS bin, {label} AS label, {value} AS value, g.n_bins
+                     FROM events AS e
+                     JOIN grid AS g ON e.hadm_id = g.hadm_id
+                     WHERE {label} IS NOT NULL"""
+        binned = f"""SELECT hadm_id, bin, label, value FROM ({binned})
+                     WHERE bin >= 0 AND bin < n_bins"""
+        aggregate = ("AVG(value) AS value, COUNT(value) AS n" if source["datatype"] == "discrete"
+                     else "MAX(value) AS value, COUNT(*) AS n")
+
+    query = f"""WITH events AS ({events_query}),
+                grid AS ({grid_query}),
+                binned AS ({binned})
+                SELECT hadm_id, bin, label, {aggregate}
+                FROM binned
+                GROUP BY hadm_id, bin, label
+                """
+    return query
+
+
+def _event_timestamp(column: str) -> str:
+    """Event time as TIMESTAMP, MIMIC stores DATETIME; date-only columns are placed at noon as in data_utils."""
+    if column == "chartdate":
+        return f"TIMESTAMP_ADD(TIMESTAMP(e.{column}), INTERVAL 12 HOUR)"
+    return f"TIMESTAMP(e.{column})"
+
+
+def build_cohort_join(id_column: str, cohort_table: str | None = None) -> str:
+    """
+    JOIN clause restricting a query to the cohort, either through the @hadm_ids array parameter
+    or through a materialized cohort table (see bq_utils.materialize_cohort_table).
+    :param id_column: Qualified hadm_id column of the event table, e.g. "event.hadm_id".
+    :param cohort_table: Cohort table name, None to use @hadm_ids.
+    :return: sql JOIN clause.
+    """
+    if cohort_table is None:
+        return f"JOIN UNNEST(@hadm_ids) AS hadm_id ON {id_column} = hadm_id"
+    return f"JOIN `{cohort_table}` AS cohort ON {id_column} = cohort.hadm_id"
+
+
+def build_cohort_table_query(table_name: str,
+                             temporary: bool = True,
+                             expiration_hours: int | None = 24,
+                             hadm_ids_query: str | None = None) -> str:
+    """
+    Query materializing the @hadm_ids array as a table clustered by hadm_id.
+    :param table_name: Table name, plain name for a session temp table, else project.dataset.table.
+    :param temporary: CREATE TEMP TABLE (must run inside a session or a script) instead of a regular table.
+    :param expiration_hours: Expiration of a regular table, None keeps it.
+    :param hadm_ids_query: Query returning a hadm_id column to materialize instead of @hadm_ids.
+    :return: sql query with @hadm_ids parameter (none with hadm_ids_query).
+    """
+    if temporary:
+        create = f"CREATE TEMP TABLE {table_name}"
+        options = ""
+    else:
+        create = f"CREATE OR REPLACE TABLE `{table_name}`"
+        options = ("" if expiration_hours is None else
+                   f"OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), "
+                   f"INTERVAL {int(expiration_hours)} HOUR))")
+    source = "UNNEST(@hadm_ids) AS hadm_id" if hadm_ids_query is None else f"({hadm_ids_query})"
+    query = f"""{create}
+                CLUSTER BY hadm_id
+                {options}
+                AS SELECT DISTINCT hadm_id FROM {source}
+                """
+    return query
+
+
+def build_extraction_script(cohort_query: str,
+                            source_queries: dict,
+                            shared_tables: dict | None = None) -> str:
+    """
+    Multi-statement script running a whole extraction as one BigQuery job: the cohort and the
+    tables read by several sources are materialized once as temp tables, then every source
+    query returns its own result set (one child job per SELECT, in source_queries order).
+    :param cohort_query: CREATE TEMP TABLE statement of the cohort (see build_cohort_table_query).
+    :param source_queries: Dictionary {source name: SELECT query joining the cohort temp table}.
+    :param shared_tables: Dictionary {project.dataset.table: temp table name}, copied once and read
+    from the copy by every source query.
+    :return: sql script.
+    """
+    statements = [cohort_query.strip()]
+    for table, temp_name in (shared_tables or {}).items():
+        statements.append(f"CREATE TEMP TABLE {temp_name} AS SELECT * FROM `{table}`")
+    for name, query in source_queries.items():
+        for table, temp_name in (shared_tables or {}).items():
+            query = query.replace(f"`{table}`", temp_name)
+        statements.append(f"-- {name}\n{query.strip()}")
+    return ";\n\n".join(statements) + ";"
+
+
 def prepare_column_string(available_events: List[str],
                           events_features: List[str],
                           available_descriptions: List[str],
@@ -265,7 +434,8 @@ def build_diagnoses_query(project_id: str,
                           dataset_id: str,
                           available_diagnoses: List[str],
                           available_d_icd_diagnoses: List[str],
-                          hadm_ids: List[int]):
+                          hadm_ids: List[int],
+                          cohort_table: str | None = None):
     """
     Defines query for hospital diagnoses.
     :param project_id: BigQuery project name.
@@ -273,6 +443,7 @@ def build_diagnoses_query(project_id: str,
     :param available_diagnoses: list of available columns in the diagnoses table.
     :param available_d_icd_diagnoses: list of available columns in the d_icd_diagnoses table.
     :param hadm_ids: list of target hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query.
     """
     cols_str = prepare_column_string(available_diagnoses,
@@ -284,8 +455,7 @@ def build_diagnoses_query(project_id: str,
                 JOIN `{project_id}.{dataset_id}.d_icd_diagnoses` event_desc
                     ON event.icd_code = event_desc.icd_code 
                     AND event.icd_version = event_desc.icd_version
-                JOIN UNNEST(@hadm_ids) AS hadm_id
-                    ON event.hadm_id = hadm_id
+                {build_cohort_join("event.hadm_id", cohort_table)}
                 ORDER BY event.hadm_id, event.seq_num
                 """
     return query
@@ -294,25 +464,288 @@ def build_diagnoses_query(project_id: str,
 def build_transfers_query(project_id: str,
                           dataset_id: str,
                           available_transfers: List[str],
-                          hadm_ids: List[int]) -> str:
+                          hadm_ids: List[int],
+                          cohort_table: str | None = None) -> str:
     """
     Retrieves transfers between the departments during the hospital stay.
     :param project_id: BigQuery project name.
     :param dataset_id: BigQuery dataset name.
     :param available_transfers: a list of available columns in the transfers table.
     :param hadm_ids: list of hadm_ids.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
     :return: sql query
     """
 
     selected = [c for c in transfers_columns if c in available_transfers]
-    cols_str = ", ".join([f"t.{col}" for col in selected])
+    cols_str = ", ".join([f"event.{col}" for col in selected])
 
     query = f"""
                 SELECT {cols_str}
                 FROM `{project_id}.{dataset_id}.transfers` AS event
-                JOIN UNNEST(@hadm_ids) AS hadm_id
-                    ON event.hadm_id = hadm_id
-                ORDER BY hadm_id, intime
+                {build_cohort_join("event.hadm_id", cohort_table)}
+                ORDER BY event.hadm_id, event.intime
+                """
+    return query
+
+
+def _cohort_filter(id_column: str, hadm_ids: list | None, cohort_table: str | None) -> str:
+    """build_cohort_join for analytics queries, which run over all admissions when no cohort is given."""
+    if hadm_ids is None and cohort_table is None:
+        return ""
+    return build_cohort_join(id_column, cohort_table)
+
+
+def _age_group_case(age_column: str) -> str:
+    """CASE expression with the age_group labels of data_utils.add_age_group_counts (right-inclusive bins)."""
+    whens = " ".join(f"WHEN {age_column} <= {upper} THEN '{label}'"
+                     for upper, label in zip(age_group_bins[1:], age_group_labels))
+    return f"CASE WHEN {age_column} <= {age_group_bins[0]} THEN NULL {whens} END"
+
+
+def build_readmissions_query(project_id: str,
+                             dataset_id: str,
+                             hadm_ids: list | None = None,
+                             cohort_table: str | None = None) -> str:
+    """
+    Readmissions of the cohort, as the readmissions table of analyze_readmissions: one row per admission
+    following another admission of the same patient, with the gap to the previous discharge (LAG over subject_id).
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param hadm_ids: list of target hadm_ids, None for all admissions.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
+    :return: sql query.
+    """
+    query = f"""WITH ordered AS (
+                    SELECT a.subject_id, a.hadm_id, a.admittime,
+                        LAG(a.dischtime) OVER patient AS prev_dischtime,
+                        LAG(a.hadm_id) OVER patient AS prev_hadm_id,
+                        ROW_NUMBER() OVER patient AS admission_number
+                    FROM `{project_id}.{dataset_id}.admissions` AS a
+                    {_cohort_filter("a.hadm_id", hadm_ids, cohort_table)}
+                    WINDOW patient AS (PARTITION BY a.subject_id ORDER BY a.admittime)
+                ),
+                gaps AS (
+                    SELECT subject_id, admission_number, prev_hadm_id, hadm_id,
+                        TIMESTAMP_DIFF(TIMESTAMP(admittime), TIMESTAMP(prev_dischtime), SECOND) / 86400
+                            AS days_between_admissions
+                    FROM ordered
+                    WHERE prev_dischtime IS NOT NULL
+                )
+                SELECT subject_id,
+                    admission_number AS readmission_number,
+                    days_between_admissions,
+                    prev_hadm_id,
+                    hadm_id AS curr_hadm_id,
+                    days_between_admissions <= 30 AS is_30_day_readmission,
+                    days_between_admissions <= 90 AS is_90_day_readmission
+                FROM gaps
+                ORDER BY subject_id, readmission_number
+                """
+    return query
+
+
+def build_admissions_per_patient_query(project_id: str,
+                                       dataset_id: str,
+                                       hadm_ids: list | None = None,
+                                       cohort_table: str | None = None) -> str:
+    """
+    Distribution of admissions per patient (the total_admissions counts of analyze_readmissions).
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param hadm_ids: list of target hadm_ids, None for all admissions.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
+    :return: sql query returning total_admissions, ever_died, n (number of patients).
+    """
+    query = f"""SELECT total_admissions, ever_died, COUNT(*) AS n
+                FROM (
+                    SELECT a.subject_id,
+                        COUNT(a.hadm_id) AS total_admissions,
+                        MAX(a.hospital_expire_flag) AS ever_died
+                    FROM `{project_id}.{dataset_id}.admissions` AS a
+                    {_cohort_filter("a.hadm_id", hadm_ids, cohort_table)}
+                    GROUP BY a.subject_id
+                )
+                GROUP BY total_admissions, ever_died
+                ORDER BY total_admissions, ever_died
+                """
+    return query
+
+
+def build_mortality_by_diagnosis_query(project_id: str,
+                                       dataset_id: str,
+                                       hadm_ids: list | None = None,
+                                       cohort_table: str | None = None,
+                                       icu: bool = False) -> str:
+    """
+    Mortality by primary diagnosis (seq_num 1), as analyze_mortality_by_condition.
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param hadm_ids: list of target hadm_ids, None for all admissions.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
+    :param icu: Count ICU stays (icu_total_cases, icu_deaths, icu_mortality_rate) instead of admissions
+    (total_cases, deaths, total_admissions, mortality_rate).
+    :return: sql query with one row per diagnosis long_title.
+    """
+    if icu:
+        cases = f"""FROM `{project_id}.{dataset_id}.icustays` AS i
+                    JOIN `{project_id}.{dataset_id}.admissions` AS a ON i.hadm_id = a.hadm_id"""
+        columns = """COUNT(a.hospital_expire_flag) AS icu_total_cases,
+                    SUM(a.hospital_expire_flag) AS icu_deaths,
+                    SAFE_DIVIDE(SUM(a.hospital_expire_flag), COUNT(a.hospital_expire_flag)) * 100 AS icu_mortality_rate"""
+    else:
+        cases = f"FROM `{project_id}.{dataset_id}.admissions` AS a"
+        columns = """COUNT(a.hospital_expire_flag) AS total_cases,
+                    SUM(a.hospital_expire_flag) AS deaths,
+                    COUNT(a.hadm_id) AS total_admissions,
+                    SAFE_DIVIDE(SUM(a.hospital_expire_flag), COUNT(a.hospital_expire_flag)) * 100 AS mortality_rate"""
+    query = f"""SELECT dx_desc.long_title,
+                    {columns}
+                {cases}
+                {_cohort_filter("a.hadm_id", hadm_ids, cohort_table)}
+                JOIN `{project_id}.{dataset_id}.diagnoses_icd` AS dx
+                    ON a.hadm_id = dx.hadm_id AND dx.seq_num = 1
+                JOIN `{project_id}.{dataset_id}.d_icd_diagnoses` AS dx_desc
+                    ON dx.icd_code = dx_desc.icd_code AND dx.icd_version = dx_desc.icd_version
+                GROUP BY dx_desc.long_title
+                ORDER BY dx_desc.long_title
+                """
+    return query
+
+
+def build_stay_distribution_query(project_id: str,
+                                  dataset_id: str,
+                                  hadm_ids: list | None = None,
+                                  cohort_table: str | None = None,
+                                  icu: bool = False,
+                                  los_resolution_days: float = 0.1) -> str:
+    """
+    Joint distribution of age, age group, gender, length of stay and in-hospital death, counted per
+    group instead of returned per admission. Hospital stays return los_days (admittime to dischtime),
+    ICU stays the icustays los of the first stay of each admission, both rounded down to los_resolution_days.
+    Expanded with local_cohort_analysis_utils.expand_counts, it feeds plot_demographics and plot_length_of_stay.
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param hadm_ids: list of target hadm_ids, None for all admissions.
+    :param cohort_table: Materialized cohort table to join instead of the @hadm_ids parameter.
+    :param icu: ICU stays instead of hospital admissions.
+    :param los_resolution_days: Length of stay bin width in days.
+    :return: sql query returning gender, anchor_age, age_group, los_days or los, hospital_expire_flag, n.
+    """
+    resolution = float(los_resolution_days)
+    if icu:
+        los_column = "los"
+        stays = f"""(SELECT * FROM `{project_id}.{dataset_id}.icustays`
+                      QUALIFY ROW_NUMBER() OVER (PARTITION BY hadm_id ORDER BY intime) = 1) AS i
+                    JOIN `{project_id}.{dataset_id}.admissions` AS a ON i.hadm_id = a.hadm_id"""
+        los = "i.los"
+    else:
+        los_column = "los_days"
+        stays = f"`{project_id}.{dataset_id}.admissions` AS a"
+        los = "TIMESTAMP_DIFF(TIMESTAMP(a.dischtime), TIMESTAMP(a.admittime), SECOND) / 86400"
+    query = f"""SELECT gender, anchor_age, age_group, {los_column}, hospital_expire_flag, COUNT(*) AS n
+                FROM (
+                    SELECT p.gender,
+                        p.anchor_age,
+                        {_age_group_case("p.anchor_age")} AS age_group,
+                        FLOOR({los} / {resolution}) * {resolution} AS {los_column},
+                        a.hospital_expire_flag
+                    FROM {stays}
+                    {_cohort_filter("a.hadm_id", hadm_ids, cohort_table)}
+                    JOIN `{project_id}.{dataset_id}.patients` AS p ON a.subject_id = p.subject_id
+                )
+                GROUP BY gender, anchor_age, age_group, {los_column}, hospital_expire_flag
+                ORDER BY gender, anchor_age, {los_column}
+                """
+    return query
+
+
+def build_cohort_definition_query(project_id: str,
+                                  dataset_id: str,
+                                  definition: dict,
+                                  parameter_prefix: str = "") -> str:
+    """
+    Query selecting the admissions matching a cohort definition (see src/cohort_definition.py).
+    Every criterion set in the definition adds one condition on a query parameter of the same name,
+    criteria set to None are left out:
+      icd_prefixes (@icd_prefixes, with @icd_version): any diagnosis code starting with a prefix
+      min_age/max_age: anchor_age bounds, inclusive
+      admission_types: admission_type in the list
+      require_icu_stay: at least one ICU stay
+      min_los_days/max_los_days: hospital length of stay bounds in days, inclusive
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param definition: Validated cohort definition.
+    :param parameter_prefix: Prefix of the parameter names, keeps several definitions apart in one query.
+    :return: sql query returning hadm_id, with the parameters of the definition.
+    """
+    p = f"@{parameter_prefix}"
+    los = "TIMESTAMP_DIFF(TIMESTAMP(a.dischtime), TIMESTAMP(a.admittime), SECOND) / 86400"
+    conditions = []
+    if definition["icd_prefixes"] is not None:
+        version = f"WHERE d.icd_version = {p}icd_version" if definition["icd_version"] is not None else ""
+        conditions.append(f"""a.hadm_id IN (
+                        SELECT d.hadm_id
+                        FROM `{project_id}.{dataset_id}.diagnoses_icd` AS d
+                        JOIN UNNEST({p}icd_prefixes) AS icd_prefix ON STARTS_WITH(d.icd_code, icd_prefix)
+                        {version})""")
+    if definition["min_age"] is not None:
+        conditions.append(f"p.anchor_age >= {p}min_age")
+    if definition["max_age"] is not None:
+        conditions.append(f"p.anchor_age <= {p}max_age")
+    if definition["admission_types"] is not None:
+        conditions.append(f"a.admission_type IN UNNEST({p}admission_types)")
+    if definition["require_icu_stay"]:
+        conditions.append(f"a.hadm_id IN (SELECT hadm_id FROM `{project_id}.{dataset_id}.icustays`)")
+    if definition["min_los_days"] is not None:
+        conditions.append(f"{los} >= {p}min_los_days")
+    if definition["max_los_days"] is not None:
+        conditions.append(f"{los} <= {p}max_los_days")
+
+    query = f"""SELECT a.hadm_id
+                FROM `{project_id}.{dataset_id}.admissions` AS a
+                JOIN `{project_id}.{dataset_id}.patients` AS p ON a.subject_id = p.subject_id
+                WHERE {" AND ".join(conditions) or "TRUE"}
+                """
+    return query
+
+
+def build_cohort_membership_query(project_id: str,
+                                  dataset_id: str,
+                                  definitions: list) -> str:
+    """
+    Query evaluating several cohort definitions at once: one row per admission in any cohort, with
+    bit i of cohort_mask set when the admission is in cohort i. The parameters of cohort i are
+    prefixed with c<i>_ (see build_cohort_definition_query).
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :param definitions: Validated cohort definitions, at most 63.
+    :return: sql query returning hadm_id, cohort_mask.
+    """
+    cohorts = "\n                    UNION ALL\n                    ".join(
+        f"SELECT hadm_id, {1 << i} AS cohort_bit "
+        f"FROM ({build_cohort_definition_query(project_id, dataset_id, definition, parameter_prefix=f'c{i}_')})"
+        for i, definition in enumerate(definitions))
+    query = f"""SELECT hadm_id, BIT_OR(cohort_bit) AS cohort_mask
+                FROM (
+                    {cohorts}
+                )
+                GROUP BY hadm_id
+                ORDER BY hadm_id
+                """
+    return query
+
+
+def build_hadm_ids_query(project_id: str,
+                         dataset_id: str) -> str:
+    """
+    Query to retrieve all hospital admission IDs.
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :return: sql query
+    """
+    query = f"""SELECT hadm_id
+                FROM `{project_id}.{dataset_id}.admissions`
+                ORDER BY hadm_id
                 """
     return query
 
@@ -330,3 +763,18 @@ def build_services_query(project_id: str,
                            """
     return services_query
 
+
+
+def build_schema_query(project_id: str,
+                       dataset_id: str) -> str:
+    """
+    Query to retrieve column names of several tables at once.
+    :param project_id: BigQuery project name.
+    :param dataset_id: BigQuery dataset name.
+    :return: sql query with @table_names parameter.
+    """
+    query = f"""SELECT table_name, column_name
+                FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS`
+                WHERE table_name IN UNNEST(@table_names)
+                """
+    return query
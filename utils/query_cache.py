@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class CachedQueryResult:
+    """
+    Query result held as an Arrow table, with the parts of the BigQuery RowIterator
+    interface the pipeline uses (to_arrow, to_dataframe, iteration over rows).
+    """
+
+    def __init__(self, table: pa.Table, cache_hit: bool):
+        self.table = table
+        self.cache_hit = cache_hit
+        self.total_rows = table.num_rows
+
+    def to_arrow(self, **kwargs) -> pa.Table:
+        return self.table
+
+    def to_dataframe(self, **kwargs):
+        return self.table.to_pandas()
+
+    def to_arrow_iterable(self, max_chunksize: int | None = None, **kwargs):
+        """Record batches of the cached table, as RowIterator.to_arrow_iterable."""
+        return iter(self.table.to_batches(max_chunksize=max_chunksize))
+
+    def __iter__(self):
+        return iter(self.table.to_pylist())
+
+
+def normalize_sql(query: str) -> str:
+    """Collapse whitespace and drop -- comments so formatting changes do not change the cache key."""
+    query = re.sub(r"--[^\n]*", " ", query)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def is_cacheable_query(query: str) -> bool:
+    """Only single read-only statements are cached (no DDL/DML, no scripts)."""
+    sql = normalize_sql(query).rstrip(";").lower()
+    return sql.startswith(("select", "with")) and ";" not in sql
+
+
+class QueryResultCache:
+    """
+    Content-addressed on-disk cache of query results, one Parquet file per key.
+    Key: sha256 of the normalized SQL, the query parameters, the job labels and the dataset version.
+    Entries expire after ttl_seconds, the least recently used entries are evicted once the
+    folder grows over max_bytes (file mtime = write time, atime = last hit).
+    """
+
+    def __init__(self,
+                 path: str,
+                 ttl_seconds: float = 7 * 24 * 60 * 60,
+                 max_bytes: int = 5 * 1024 ** 3,
+                 dataset_version: str | None = None,
+                 enabled: bool = True):
+        """
+        :param path: Cache folder.
+        :param ttl_seconds: Max age of a cached result.
+        :param max_bytes: Max total size of the cache folder.
+        :param dataset_version: Part of every key, change it to invalidate results of an older dataset release.
+        :param enabled: False disables reads and writes.
+        """
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.dataset_version = dataset_version
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def key(self, query: str, job_config=None) -> str:
+        """Hash of the normalized SQL, the query parameters, the job labels and the dataset version."""
+        parameters = [p.to_api_repr() for p in getattr(job_config, "query_parameters", None) or []]
+        payload = json.dumps({"sql": normalize_sql(query),
+                              "parameters": parameters,
+                              "labels": getattr(job_config, "labels", None) or {},
+                              "dataset_version": self.dataset_version}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> pa.Table | None:
+        """
+        Read a cached result.
+        :return: Arrow table, None on a miss or an expired entry.
+        """
+        file = self.path / f"{key}.parquet"
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        if time.time() - stat.st_mtime > self.ttl_seconds:
+            file.unlink(missing_ok=True)
+            with self._lock:
+                self.misses += 1
+            return None
+        table = pq.read_table(file)
+        # Record the access for LRU eviction, keep mtime as the write time for the TTL
+        os.utime(file, (time.time(), stat.st_mtime))
+        with self._lock:
+            self.hits += 1
+            self.bytes_read += stat.st_size
+        return table
+
+    def put(self, key: str, table: pa.Table):
+        """Store a result and evict old entries if the cache is over max_bytes."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self.path / f"{key}.parquet"
+        # Write to a temporary file first, so concurrent readers never see a partial file
+        tmp = self.path / f"{key}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, file)
+        with self._lock:
+            self.bytes_written += file.stat().st_size
+        self.evict()
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until the cache fits max_bytes."""
+        now = time.time()
+        entries = []
+        for file in self.path.glob("*.parquet"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                file.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_atime, stat.st_size, file))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, file in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        for file in self.path.glob("*.parquet"):
+            file.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        """
+        :return: Dictionary with hits, misses, hit_rate, evictions, bytes_read, bytes_written.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "bytes_read": self.bytes_read,
+                    "bytes_written": self.bytes_written}
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+import pandas as pd
+from query_cache import normalize_sql
+
+QUERY_STATS_COLUMNS = ["timestamp", "query_hash", "query_preview", "source", "job_id", "statement_type",
+                       "estimated_bytes", "bytes_processed", "bytes_billed", "slot_ms", "cache_hit",
+                       "rows", "elapsed_seconds"]
+
+
+class QueryBudgetExceeded(ValueError):
+    """Raised when the dry-run estimate of a query is above the configured scan budget."""
+
+
+class QueryStatsLog:
+    """
+    Structured per-query log: dry-run estimates and post-run job statistics (bytes processed/billed,
+    slot-ms, BigQuery cache hit, rows), one record per query. Records stay in memory (to_dataframe)
+    and are optionally appended to a JSON lines file. Thread-safe.
+    """
+
+    def __init__(self, path: str | None = None):
+        """
+        :param path: Optional JSON lines file records are appended to.
+        """
+        self.path = path
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, query: str, source: str, job=None, rows: int | None = None,
+               estimated_bytes: int | None = None, elapsed_seconds: float | None = None) -> dict:
+        """
+        Add a record.
+        :param query: sql query
+        :param source: "bigquery" (job ran), "dry_run" or "local_cache" (served from QueryResultCache).
+        :param job: Finished BigQuery QueryJob, None for local cache hits.
+        :param rows: Result row count.
+        :param estimated_bytes: Dry-run bytes estimate.
+        :param elapsed_seconds: Wall-clock time of the job.
+        :return: The record.
+        """
+        record = {"timestamp": time.time(),
+                  "query_hash": hashlib.sha256(normalize_sql(query).encode()).hexdigest()[:16],
+                  "query_preview": normalize_sql(query)[:200],
+                  "source": source,
+                  "job_id": getattr(job, "job_id", None),
+                  "statement_type": getattr(job, "statement_type", None),
+                  "estimated_bytes": estimated_bytes,
+                  "bytes_processed": getattr(job, "total_bytes_processed", None),
+                  "bytes_billed": getattr(job, "total_bytes_billed", None),
+                  "slot_ms": getattr(job, "slot_millis", None),
+                  "cache_hit": getattr(job, "cache_hit", None) if source != "local_cache" else True,
+                  "rows": rows,
+                  "elapsed_seconds": elapsed_seconds}
+        with self._lock:
+            self.records.append(record)
+            if self.path is not None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+        return record
+
+    def to_dataframe(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(self.records, columns=QUERY_STATS_COLUMNS)
+
+    def summary(self) -> dict:
+        """
+        :return: Dictionary with queries, bigquery_jobs, cache hits, total bytes processed/billed and slot-ms.
+        """
+        df = self.to_dataframe()
+        jobs = df[df["source"] == "bigquery"]
+        return {"queries": int((df["source"] != "dry_run").sum()),
+                "bigquery_jobs": len(jobs),
+                "local_cache_hits": int((df["source"] == "local_cache").sum()),
+                "bigquery_cache_hits": int(jobs["cache_hit"].eq(True).sum()),
+                "bytes_processed": int(jobs["bytes_processed"].fillna(0).sum()),
+                "bytes_billed": int(jobs["bytes_billed"].fillna(0).sum()),
+                "slot_ms": int(jobs["slot_ms"].fillna(0).sum())}
+
+    def clear(self):
+        with self._lock:
+            self.records = []
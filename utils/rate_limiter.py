@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket: up to `burst` calls go through at once, after that calls are spaced at `rate` per second.
+    The rate adapts (AIMD): it is halved when the service reports a quota error and
+    recovers additively on every successful call, up to the configured rate.
+    Thread-safe, the lock is only held while reserving tokens, waiting happens outside it.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float | None = None):
+        """
+        :param rate: Tokens added per second (steady calls per second).
+        :param burst: Bucket capacity (calls allowed back to back).
+        :param min_rate: Lowest rate adaptive backoff may reach, default rate / 16.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.throttled_seconds = 0.0
+        self.calls = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float = 1) -> float:
+        """Take tokens (the balance may go negative) and return how long the caller must wait."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            self.calls += 1
+            wait = max(0.0, -self.tokens / self.rate)
+            self.throttled_seconds += wait
+            return wait
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until tokens are available.
+        :return: Seconds spent waiting.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: float = 1) -> float:
+        """
+        Wait for tokens without blocking the event loop.
+        :return: Seconds spent waiting.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def backoff(self, delay: float = 0.0):
+        """
+        Halve the rate after a quota error.
+        :param delay: Retry delay the caller is about to sleep, counted as throttled time.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.retries += 1
+            self.throttled_seconds += delay
+
+    def recover(self):
+        """Raise the rate back towards the configured rate after a successful call."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Detect quota/rate limit errors (HTTP 429, BigQuery rateLimitExceeded/quotaExceeded reasons)
+    without importing the client library.
+    """
+    if getattr(error, "code", None) == 429:
+        return True
+    reasons = {e.get("reason") for e in getattr(error, "errors", None) or [] if isinstance(e, dict)}
+    if reasons & {"rateLimitExceeded", "quotaExceeded"}:
+        return True
+    message = str(error)
+    return "rateLimitExceeded" in message or "quotaExceeded" in message
+
+
+class AdaptiveRateLimiter:
+    """
+    One TokenBucket per operation type (e.g. "query", "metadata"), so cheap metadata calls
+    are not queued behind queries. Calls failing with a rate limit error are retried with
+    jittered exponential backoff and slow their bucket down.
+
+    Usage:
+        limiter = AdaptiveRateLimiter({"query": {"rate": 2, "burst": 8}})
+
+        @limiter.limit("query")
+        def run(...): ...
+
+    Works for sync and async functions.
+    """
+
+    def __init__(self,
+                 limits: dict,
+                 max_retries: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 default: dict | None = None):
+        """
+        :param limits: Dictionary {operation: {"rate": calls per second, "burst": capacity}}.
+        :param max_retries: Retries after a rate limit error before the error is raised.
+        :param base_delay: First retry delay in seconds, doubled on every retry.
+        :param max_delay: Max retry delay in seconds.
+        :param default: Bucket settings for operations missing from limits.
+        """
+        self.limits = limits
+        self.default = default or {"rate": 1.0, "burst": 1}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, operation: str) -> TokenBucket:
+        with self._lock:
+            if operation not in self.buckets:
+                self.buckets[operation] = TokenBucket(**self.limits.get(operation, self.default))
+            return self.buckets[operation]
+
+    def retry_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff: uniform in [0, min(max_delay, base_delay * 2^attempt)]."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, operation: str, function, *args, **kwargs):
+        """Run function(*args, **kwargs) under the operation bucket, retrying on rate limit errors."""
+        bucket = self.bucket(operation)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                bucket.backoff(delay)
+                print(f"Rate limited on {operation}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+            else:
+                bucket.recover()
+                return result
+
+    async def call_async(self, operation: str, function, *args, **kwargs):
+        """Async version of call for coroutine functions."""
+        bucket = self.bucket(operation)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire_async()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                bucket.backoff(delay)
+                print(f"Rate limited on {operation}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+            else:
+                bucket.recover()
+                return result
+
+    def limit(self, operation: str):
+        """Decorator applying call/call_async to a function."""
+        def decorator(function):
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    return await self.call_async(operation, function, *args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self.call(operation, function, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        """Drop all buckets, the next calls start with full buckets at the configured rates."""
+        with self._lock:
+            self.buckets = {}
+
+    def stats(self) -> dict:
+        """
+        Time spent throttled per operation.
+        :return: Dictionary {operation: {"calls", "retries", "throttled_seconds", "rate"}}.
+        """
+        with self._lock:
+            return {operation: {"calls": b.calls,
+                                "retries": b.retries,
+                                "throttled_seconds": round(b.throttled_seconds, 3),
+                                "rate": b.rate}
+                    for operation, b in self.buckets.items()}
@@ -0,0 +1,127 @@
+import hashlib
+import re
+import shutil
+import threading
+from pathlib import Path
+import duckdb
+# pip install duckdb
+
+# Offline stand-in for the part of a snowflake.connector connection used by snowflake_utils:
+# PUT copies files into a folder per stage, COPY INTO reads the staged Parquet files into DuckDB,
+# every other statement runs on DuckDB as is. Load metadata is kept in the warehouse (table _load_history),
+# so, as in Snowflake, COPY INTO skips files it already loaded unless FORCE = TRUE:
+#
+#     connection = EmulatedSnowflakeConnection(stage_path)
+#     snowflake_utils.export_cohort_to_snowflake(connection, admissions_data, output_dir, "@mimic_stage")
+
+PUT_PATTERN = re.compile(r"^\s*PUT\s+'?file://(?P<file>[^'\s]+)'?\s+@(?P<stage>[\w.$]+)(?P<prefix>/\S*)?(?P<options>.*)$",
+                         re.IGNORECASE | re.DOTALL)
+COPY_PATTERN = re.compile(r"^\s*COPY\s+INTO\s+(?P<table>[\w.$]+)\s+FROM\s+@(?P<stage>[\w.$]+)(?P<prefix>/\S*)?"
+                          r"(?P<options>.*)$", re.IGNORECASE | re.DOTALL)
+
+
+class EmulatedSnowflakeCursor:
+    """DB-API cursor: execute, fetchone, fetchall, description, close."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self._rows = []
+
+    def execute(self, statement: str, params=None):
+        put = PUT_PATTERN.match(statement)
+        copy = COPY_PATTERN.match(statement)
+        if put:
+            names, self._rows = self.connection._put(put["file"], put["stage"], put["prefix"], put["options"])
+        elif copy:
+            names, self._rows = self.connection._copy(copy["table"], copy["stage"], copy["prefix"], copy["options"])
+        else:
+            cursor = self.connection.db.cursor()
+            cursor.execute(statement, params)
+            names = [d[0] for d in cursor.description or []]
+            self._rows = cursor.fetchall() if cursor.description else []
+        self.description = [(name, None, None, None, None, None, None) for name in names]
+        return self
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self) -> list:
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+class EmulatedSnowflakeConnection:
+    """
+    File-system stages and a DuckDB warehouse behind the snowflake.connector connection interface.
+    Stage @name/prefix/ is the folder <stage_path>/name/prefix/.
+    """
+
+    def __init__(self, stage_path: str, database: str = ":memory:"):
+        """
+        :param stage_path: Folder holding the stages.
+        :param database: DuckDB database file, ":memory:" for an in-memory warehouse.
+        """
+        self.stage_path = Path(stage_path)
+        self.db = duckdb.connect(database)
+        self.db.execute("CREATE TABLE IF NOT EXISTS _load_history (table_name VARCHAR, file VARCHAR, md5 VARCHAR)")
+        self.puts = 0
+        self.copies = 0
+        self._lock = threading.Lock()
+
+    def cursor(self) -> EmulatedSnowflakeCursor:
+        return EmulatedSnowflakeCursor(self)
+
+    def close(self):
+        self.db.close()
+
+    def _stage_folder(self, stage: str, prefix: str | None) -> Path:
+        return Path(self.stage_path, stage.lower(), (prefix or "/").strip("/"))
+
+    def _put(self, file: str, stage: str, prefix: str | None, options: str) -> tuple[list, list]:
+        source = Path(file)
+        target = self._stage_folder(stage, prefix) / source.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        overwrite = re.search(r"OVERWRITE\s*=\s*TRUE", options, re.IGNORECASE) is not None
+        status = "SKIPPED" if target.exists() and not overwrite else "UPLOADED"
+        if status == "UPLOADED":
+            shutil.copyfile(source, target)
+        with self._lock:
+            self.puts += 1
+        size = source.stat().st_size
+        names = ["source", "target", "source_size", "target_size", "source_compression", "target_compression",
+                 "status", "message"]
+        return names, [(source.name, target.name, size, size, "PARQUET", "PARQUET", status, "")]
+
+    def _copy(self, table: str, stage: str, prefix: str | None, options: str) -> tuple[list, list]:
+        folder = self._stage_folder(stage, prefix)
+        listed = re.search(r"FILES\s*=\s*\(([^)]*)\)", options, re.IGNORECASE)
+        if listed:
+            files = [folder / name.strip().strip("'\"") for name in listed.group(1).split(",") if name.strip()]
+        else:
+            files = sorted(folder.glob("*.parquet"))
+        force = re.search(r"FORCE\s*=\s*TRUE", options, re.IGNORECASE) is not None
+
+        rows = []
+        with self._lock:
+            self.copies += 1
+            for file in files:
+                if not file.exists():
+                    raise ValueError(f"Remote file '{file.name}' was not found in stage @{stage}")
+                key = [table.lower(), file.as_posix(), hashlib.md5(file.read_bytes()).hexdigest()]
+                loaded = self.db.execute("SELECT COUNT(*) FROM _load_history WHERE table_name = ? AND file = ? "
+                                         "AND md5 = ?", key).fetchone()[0]
+                if loaded and not force:
+                    continue
+                count = self.db.execute(f"SELECT COUNT(*) FROM read_parquet('{file.as_posix()}')").fetchone()[0]
+                self.db.execute(f"INSERT INTO {table} BY NAME SELECT * FROM read_parquet('{file.as_posix()}')")
+                self.db.execute("INSERT INTO _load_history VALUES (?, ?, ?)", key)
+                rows.append((f"{stage}/{file.name}", "LOADED", count, count, 1, 0, None, None, None, None))
+        if not rows:
+            return ["status"], [("Copy executed with 0 files processed.",)]
+        names = ["file", "status", "rows_parsed", "rows_loaded", "error_limit", "errors_seen", "first_error",
+                 "first_error_line", "first_error_character", "first_error_column_name"]
+        return names, rows
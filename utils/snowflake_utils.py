@@ -1,5 +1,351 @@
-import snowflake.connector
-# def upload_to_snowflake(df, table_name, conn_params):
-# pass
-# def copy_from_gcs(stage, file_pattern, table_name):
-# pass
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from config.project_config import snowflake_export
+
+# pip install snowflake-connector-python
+# Bulk path: tables are written as Parquet chunks, staged with parallel PUTs and loaded with one COPY INTO
+# per batch instead of row inserts. Loaded batches are recorded in a manifest next to the chunks, so a
+# rerun skips them; COPY INTO also skips files it already loaded (Snowflake load metadata), so a batch
+# interrupted between COPY INTO and the manifest write is not loaded twice. A batch whose content changed
+# (re-extracted cohort) replaces the table's rows: the table is emptied and reloaded with FORCE = TRUE.
+# Offline, utils/snowflake_emulator.py provides a file-system stage and DuckDB as the warehouse.
+
+MANIFEST_FILE = "_snowflake_manifest.json"
+
+
+def load_snowflake_config(config_path: str = snowflake_export["config_path"]) -> dict:
+    """
+    Read the connection settings (account, user, warehouse, database, schema, role, stage).
+    :param config_path: YAML file, see config/snowflake_config.yaml.
+    :return: Dictionary of settings.
+    """
+    with open(config_path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def get_snowflake_connection(config: dict, password: str | None = None):
+    """
+    Open a Snowflake connection.
+    :param config: Settings from load_snowflake_config.
+    :param password: Password, default the SNOWFLAKE_PASSWORD environment variable.
+    :return: snowflake.connector connection.
+    """
+    import snowflake.connector
+
+    return snowflake.connector.connect(account=config["account"].removesuffix(".snowflakecomputing.com"),
+                                       user=config["user"],
+                                       password=password or os.environ.get("SNOWFLAKE_PASSWORD"),
+                                       warehouse=config.get("warehouse"),
+                                       database=config.get("database"),
+                                       schema=config.get("schema"),
+                                       role=config.get("role"))
+
+
+def snowflake_type(data_type: pa.DataType) -> str:
+    """Snowflake column type of an Arrow type (names DuckDB accepts as well)."""
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+    if pa.types.is_boolean(data_type):
+        return "BOOLEAN"
+    if pa.types.is_integer(data_type):
+        return "BIGINT"
+    if pa.types.is_floating(data_type) or pa.types.is_decimal(data_type):
+        return "DOUBLE"
+    if pa.types.is_timestamp(data_type):
+        return "TIMESTAMP"
+    if pa.types.is_date(data_type):
+        return "DATE"
+    return "VARCHAR"
+
+
+def build_create_table_query(table_name: str, schema: pa.Schema) -> str:
+    """
+    CREATE TABLE IF NOT EXISTS statement matching a Parquet schema.
+    :param table_name: Snowflake table name.
+    :param schema: Arrow schema of the chunks loaded into the table.
+    :return: sql query
+    """
+    columns = ",\n    ".join(f"{field.name} {snowflake_type(field.type)}" for field in schema)
+    return f"CREATE TABLE IF NOT EXISTS {table_name} (\n    {columns}\n)"
+
+
+def write_parquet_chunks(df: pd.DataFrame,
+                         output_dir: str,
+                         chunk_rows: int = snowflake_export["chunk_rows"],
+                         compression: str = snowflake_export["compression"]) -> list:
+    """
+    Write a DataFrame as Parquet chunks named after a hash of their content, so rewriting the same
+    data produces the same file names (and stage paths).
+    Timestamps are written in microseconds, the finest unit COPY INTO reads from Parquet.
+    :param df: Table to write.
+    :param output_dir: Folder of the chunks.
+    :param chunk_rows: Max rows per chunk.
+    :param compression: Parquet compression codec (snappy is read by COPY INTO with COMPRESSION = AUTO).
+    :return: Sorted list of chunk paths.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    files = []
+    for i, start in enumerate(range(0, max(table.num_rows, 1), chunk_rows)):
+        chunk = table.slice(start, chunk_rows)
+        sink = pa.BufferOutputStream()
+        pq.write_table(chunk, sink, compression=compression, coerce_timestamps="us", allow_truncated_timestamps=True)
+        data = sink.getvalue()
+        file = Path(output_dir, f"part-{i:05d}-{hashlib.sha256(data).hexdigest()[:16]}.parquet")
+        if not file.exists():
+            with open(file, "wb") as f:
+                f.write(data)
+        files.append(file)
+    return files
+
+
+def _file_digest(files: list) -> str:
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _cursor_rows(cursor) -> list:
+    """Result rows of the last statement as dictionaries with lowercase keys."""
+    names = [d[0].lower() for d in cursor.description or []]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+def stage_files(connection,
+                files: list,
+                stage: str,
+                stage_prefix: str,
+                max_parallel_puts: int = snowflake_export["max_parallel_puts"]) -> list:
+    """
+    Upload files to a stage, max_parallel_puts PUT commands at once (one cursor each).
+    Files are already compressed Parquet, so AUTO_COMPRESS is off.
+    :param connection: Snowflake (or emulated) connection.
+    :param files: Local files.
+    :param stage: Stage name, with or without @.
+    :param stage_prefix: Folder in the stage.
+    :param max_parallel_puts: Max concurrent PUT commands.
+    :return: list of PUT result rows.
+    """
+    stage = stage.lstrip("@")
+
+    def put(file: Path) -> list:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"PUT 'file://{Path(file).resolve().as_posix()}' @{stage}/{stage_prefix}/ "
+                           f"AUTO_COMPRESS = FALSE OVERWRITE = TRUE")
+            return _cursor_rows(cursor)
+        finally:
+            cursor.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_puts)) as executor:
+        return [row for rows in executor.map(put, files) for row in rows]
+
+
+def copy_into_table(connection, table_name: str, stage: str, stage_prefix: str, file_names: list,
+                    force: bool = False) -> int:
+    """
+    Load staged Parquet files into a table with COPY INTO, matching columns by name.
+    :param connection: Snowflake (or emulated) connection.
+    :param table_name: Target table.
+    :param stage: Stage name, with or without @.
+    :param stage_prefix: Folder of the files in the stage.
+    :param file_names: File names in the folder.
+    :param force: Load files even if they were loaded before (after the table was emptied).
+    :return: Rows loaded (0 when every file was loaded before).
+    """
+    files = ", ".join(f"'{name}'" for name in file_names)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"COPY INTO {table_name} FROM @{stage.lstrip('@')}/{stage_prefix}/ "
+                       f"FILES = ({files}) "
+                       f"FILE_FORMAT = (TYPE = PARQUET) "
+                       f"MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE "
+                       f"ON_ERROR = ABORT_STATEMENT"
+                       f"{' FORCE = TRUE' if force else ''}")
+        return sum(int(row.get("rows_loaded") or 0) for row in _cursor_rows(cursor))
+    finally:
+        cursor.close()
+
+
+class SnowflakeManifest:
+    """
+    Loaded batches of an export folder, <output_dir>/_snowflake_manifest.json:
+    {table: {batch key: {"digest", "files", "rows", "loaded_at"}}}. Thread-safe, saved after every change.
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = Path(output_dir, MANIFEST_FILE)
+        self.batches = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.batches = json.load(f)
+        self._lock = threading.Lock()
+
+    def loaded_digest(self, table_name: str, batch_key: str) -> str | None:
+        with self._lock:
+            return self.batches.get(table_name, {}).get(batch_key, {}).get("digest")
+
+    def record(self, table_name: str, batch_key: str, digest: str, files: list, rows: int):
+        with self._lock:
+            self.batches.setdefault(table_name, {})[batch_key] = {"digest": digest,
+                                                                  "files": [Path(f).name for f in files],
+                                                                  "rows": rows,
+                                                                  "loaded_at": time.time()}
+            self._save()
+
+    def clear(self, table_name: str):
+        with self._lock:
+            self.batches.pop(table_name, None)
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.batches, f, indent=2)
+
+
+def empty_table(connection, table_name: str, manifest: SnowflakeManifest):
+    """
+    Delete all rows of a table and its manifest entries, before reloading re-extracted batches.
+    :param connection: Snowflake (or emulated) connection.
+    :param table_name: Table to empty.
+    :param manifest: Manifest of the export folder.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"DELETE FROM {table_name}")
+    finally:
+        cursor.close()
+    manifest.clear(table_name)
+
+
+def load_parquet_batch(connection,
+                       table_name: str,
+                       files: list,
+                       stage: str,
+                       manifest: SnowflakeManifest,
+                       max_parallel_puts: int = snowflake_export["max_parallel_puts"],
+                       batch_key: str | None = None,
+                       force: bool = False) -> dict:
+    """
+    Load one batch of Parquet files into a table: create the table if needed, stage the files in
+    parallel and run one COPY INTO. Batches already in the manifest with the same content are skipped.
+    :param connection: Snowflake (or emulated) connection.
+    :param table_name: Target table.
+    :param files: Parquet files of the batch, with the same schema.
+    :param stage: Stage name, with or without @.
+    :param manifest: Manifest of the export folder.
+    :param max_parallel_puts: Max concurrent PUT commands.
+    :param batch_key: Name of the batch in the manifest, default the table name (one batch per table).
+    :param force: COPY INTO files loaded before (the table was emptied, see empty_table).
+    :return: Dictionary with table, batch digest, files, rows_loaded and skipped.
+    """
+    batch_key = batch_key or table_name
+    digest = _file_digest(files)
+    result = {"table": table_name, "batch": digest[:16], "files": len(files), "rows_loaded": 0, "skipped": True}
+    if not files or manifest.loaded_digest(table_name, batch_key) == digest:
+        return result
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(build_create_table_query(table_name, pq.read_schema(files[0])))
+    finally:
+        cursor.close()
+    stage_prefix = table_name.lower()
+    stage_files(connection, files, stage, stage_prefix, max_parallel_puts)
+    rows = copy_into_table(connection, table_name, stage, stage_prefix, [Path(f).name for f in files], force)
+    manifest.record(table_name, batch_key, digest, files, rows)
+    return {**result, "rows_loaded": rows, "skipped": False}
+
+
+def _changed_batches(manifest: SnowflakeManifest, table_name: str, batches: dict) -> list:
+    """Batch keys loaded before with a different content."""
+    changed = []
+    for batch_key, files in batches.items():
+        loaded = manifest.loaded_digest(table_name, batch_key)
+        if loaded is not None and loaded != _file_digest(files):
+            changed.append(batch_key)
+    return changed
+
+
+def export_cohort_to_snowflake(connection,
+                               admissions_data: dict,
+                               output_dir: str,
+                               stage: str,
+                               table_prefix: str = "",
+                               chunk_rows: int = snowflake_export["chunk_rows"],
+                               max_parallel_puts: int = snowflake_export["max_parallel_puts"]) -> list:
+    """
+    Export extracted cohort tables (extract_admissions_data(_bq) with return_as_cohort=True) to Snowflake,
+    one table per source, each written as Parquet chunks to <output_dir>/<source>/ and loaded as one batch.
+    Rerunning with the same data skips the loaded sources, a source whose data changed replaces the table's rows.
+    :param connection: Snowflake (or emulated) connection.
+    :param admissions_data: Dictionary {source: DataFrame}.
+    :param output_dir: Folder of the chunks and the manifest.
+    :param stage: Stage name, with or without @.
+    :param table_prefix: Prefix of the table names, e.g. "sepsis_".
+    :param chunk_rows: Max rows per chunk.
+    :param max_parallel_puts: Max concurrent PUT commands.
+    :return: list of load_parquet_batch results.
+    """
+    manifest = SnowflakeManifest(output_dir)
+    results = []
+    for source, df in admissions_data.items():
+        folder = Path(output_dir, source)
+        # Chunks of an earlier export are not part of this batch
+        for file in folder.glob("part-*.parquet"):
+            file.unlink()
+        files = write_parquet_chunks(df, str(folder), chunk_rows)
+        table_name = f"{table_prefix}{source}"
+        replace = bool(_changed_batches(manifest, table_name, {table_name: files}))
+        if replace:
+            empty_table(connection, table_name, manifest)
+        result = load_parquet_batch(connection, table_name, files, stage, manifest, max_parallel_puts, force=replace)
+        print(f"{result['table']}: {'already loaded' if result['skipped'] else str(result['rows_loaded']) + ' rows'}")
+        results.append(result)
+    return results
+
+
+def export_parquet_dataset_to_snowflake(connection,
+                                        dataset_path: str,
+                                        stage: str,
+                                        table_prefix: str = "",
+                                        max_parallel_puts: int = snowflake_export["max_parallel_puts"]) -> list:
+    """
+    Export the Parquet sink of bq_utils.extract_admissions_data_bq_batched (<dataset_path>/<source>/part-*.parquet),
+    every part file is one batch, so batches extracted later are loaded by rerunning the export.
+    If a loaded part file was re-extracted with different content, its table is emptied and every part reloaded.
+    :param connection: Snowflake (or emulated) connection.
+    :param dataset_path: Folder of the Parquet sink, the manifest is written there.
+    :param stage: Stage name, with or without @.
+    :param table_prefix: Prefix of the table names.
+    :param max_parallel_puts: Max concurrent PUT commands.
+    :return: list of load_parquet_batch results.
+    """
+    manifest = SnowflakeManifest(dataset_path)
+    results = []
+    for folder in sorted(p for p in Path(dataset_path).iterdir() if p.is_dir()):
+        table_name = f"{table_prefix}{folder.name}"
+        batches = {file.name: [file] for file in sorted(folder.glob("part-*.parquet"))}
+        changed = _changed_batches(manifest, table_name, batches)
+        if changed:
+            print(f"{table_name}: {len(changed)} re-extracted batches, reloading the table")
+            empty_table(connection, table_name, manifest)
+        for batch_key, files in batches.items():
+            results.append(load_parquet_batch(connection, table_name, files, stage, manifest, max_parallel_puts,
+                                              batch_key=batch_key, force=bool(changed)))
+    loaded = [r for r in results if not r["skipped"]]
+    print(f"Loaded {len(loaded)} of {len(results)} batches, {sum(r['rows_loaded'] for r in loaded)} rows")
+    return results
@@ -0,0 +1,112 @@
+import json
+from pathlib import Path
+from os.path import join
+import numpy as np
+import pandas as pd
+
+TENSOR_FILES = {"features": "features.npy", "mask": "mask.npy", "deltas": "deltas.npy"}
+
+
+def export_cohort_tensors(long_df: pd.DataFrame,
+                          features: pd.DataFrame,
+                          output_dir: str,
+                          time_resolution_hours: float,
+                          n_bins: int,
+                          hadm_ids: list | None = None,
+                          chunk_size: int = 1024) -> dict:
+    """
+    Export the long events table (see long_format_utils) as fixed-shape memory-mapped .npy arrays
+    for streaming model training:
+      features.npy  float32 (admission, bin, feature), unobserved values are 0
+      mask.npy      uint8   (admission, bin, feature), 1 where observed
+      deltas.npy    float32 (admission, bin, feature), hours since the last observation (GRU-D style)
+      index.json    hadm_id to row offset, lengths, feature names, shapes
+    Admissions are written chunk by chunk, so memory is bounded by chunk_size admissions.
+    :param long_df: Long events table (hadm_id, bin, feature_id, value).
+    :param features: Features table (feature_id, source, feature).
+    :param output_dir: Export folder.
+    :param time_resolution_hours: Bin width used to build the long table.
+    :param n_bins: Fixed number of bins per admission, longer admissions are truncated.
+    :param hadm_ids: Admissions to export (row order), default all admissions in long_df.
+    :param chunk_size: Admissions per write.
+    :return: Index dictionary (also saved as index.json).
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if hadm_ids is None:
+        hadm_ids = np.sort(long_df["hadm_id"].unique())
+    hadm_ids = np.asarray(hadm_ids)
+    shape = (len(hadm_ids), n_bins, len(features))
+
+    arrays = {"features": np.lib.format.open_memmap(join(output_dir, TENSOR_FILES["features"]), mode="w+",
+                                                    dtype=np.float32, shape=shape),
+              "mask": np.lib.format.open_memmap(join(output_dir, TENSOR_FILES["mask"]), mode="w+",
+                                                dtype=np.uint8, shape=shape),
+              "deltas": np.lib.format.open_memmap(join(output_dir, TENSOR_FILES["deltas"]), mode="w+",
+                                                  dtype=np.float32, shape=shape)}
+
+    rows = long_df[(long_df["bin"] < n_bins) & long_df["hadm_id"].isin(hadm_ids)]
+    lengths = rows.groupby("hadm_id")["bin"].max().add(1).reindex(hadm_ids, fill_value=0)
+    # Sort observations by output row once, every chunk is then a contiguous slice
+    row_of = pd.Series(np.arange(len(hadm_ids)), index=hadm_ids).loc[rows["hadm_id"].to_numpy()].to_numpy()
+    order = np.argsort(row_of, kind="stable")
+    row_of = row_of[order]
+    bins = rows["bin"].to_numpy()[order]
+    feature_ids = rows["feature_id"].to_numpy()[order]
+    observed = np.nan_to_num(rows["value"].to_numpy(dtype=np.float32)[order])
+
+    for start in range(0, len(hadm_ids), chunk_size):
+        n = len(hadm_ids[start:start + chunk_size])
+        lo, hi = np.searchsorted(row_of, [start, start + n])
+        a, b, f = row_of[lo:hi] - start, bins[lo:hi], feature_ids[lo:hi]
+
+        values = np.zeros((n, n_bins, len(features)), dtype=np.float32)
+        mask = np.zeros_like(values, dtype=np.uint8)
+        values[a, b, f] = observed[lo:hi]
+        mask[a, b, f] = 1
+
+        arrays["features"][start:start + n] = values
+        arrays["mask"][start:start + n] = mask
+        arrays["deltas"][start:start + n] = observation_deltas(mask, time_resolution_hours)
+
+    for array in arrays.values():
+        array.flush()
+
+    index = {"hadm_ids": hadm_ids.tolist(),
+             "offsets": {str(h): i for i, h in enumerate(hadm_ids.tolist())},
+             "lengths": lengths.astype(int).tolist(),
+             "features": features["feature"].astype(str).tolist(),
+             "sources": features["source"].astype(str).tolist(),
+             "shape": list(shape),
+             "time_resolution_hours": time_resolution_hours,
+             "files": TENSOR_FILES}
+    with open(join(output_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def observation_deltas(mask: np.ndarray, time_resolution_hours: float) -> np.ndarray:
+    """
+    Hours since the previous observation of each feature (0 at the first bin),
+    delta[t] = resolution if observed at t-1, else resolution + delta[t-1].
+    :param mask: (admission, bin, feature) observation mask.
+    :param time_resolution_hours: Bin width in hours.
+    :return: float32 array with the same shape as mask.
+    """
+    deltas = np.zeros(mask.shape, dtype=np.float32)
+    for t in range(1, mask.shape[1]):
+        deltas[:, t] = time_resolution_hours + np.where(mask[:, t - 1] > 0, 0, deltas[:, t - 1])
+    return deltas
+
+
+def load_cohort_tensors(output_dir: str, mmap_mode: str = "r") -> tuple[dict, dict]:
+    """
+    Open exported arrays without reading them into memory.
+    :param output_dir: Export folder.
+    :param mmap_mode: numpy memmap mode ("r" read-only, "c" copy-on-write).
+    :return: Dictionary of memory-mapped arrays, index dictionary.
+    """
+    with open(join(output_dir, "index.json")) as f:
+        index = json.load(f)
+    arrays = {name: np.load(join(output_dir, filename), mmap_mode=mmap_mode)
+              for name, filename in index["files"].items()}
+    return arrays, index